@@ -17,9 +17,13 @@ app.include_router(balance_sheet_router, prefix="/api", tags=["Balance Sheet Man
 app.include_router(inventory_router, prefix="/api", tags=["Inventory Management"])
 
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.responses import JSONResponse
 from pyngrok import ngrok, conf
+from services.tallyClient import close_all_clients, aclose_all_clients
+from services.syncService import stop_all_background_syncs
+from services.mirrorStore import close_mirror_connections
 
 from routes.createLedgerRoutes import router as ledger_router
 from routes.trialBalanceRoutes import router as trial_balance_router
@@ -27,8 +31,79 @@ from routes.createVoucherRoutes import router as voucher_router
 from routes.balanceSheetRoutes import router as balance_sheet_router
 from routes.groupRoutes import router as group_router
 from routes.inventoryRoutes import router as inventory_router
+from routes.tallyStatusRoutes import router as tally_status_router
+from routes.bulkMasterRoutes import router as bulk_master_router
+from routes.syncRoutes import router as sync_router
+from routes.periodRoutes import router as period_router
+from services.writeJournal import write_journal
+from services.circuitBreaker import TallyUnavailableError
+from services.metrics import current_endpoint, render_metrics
+from services.tracing import ERROR, SERVER, install_log_correlation, parse_traceparent, tracer
+from starlette.routing import Match
+from fastapi.responses import PlainTextResponse
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Replay vouchers journaled before the last shutdown and start draining them
+    write_journal.start()
+    yield
+    await write_journal.stop()
+    await stop_all_background_syncs()
+    close_mirror_connections()
+    # Release pooled keep-alive connections to every Tally host
+    close_all_clients()
+    await aclose_all_clients()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Log records carry %(trace_id)s and %(span_id)s of the request they were logged in
+install_log_correlation()
+
+# Scrapes and trace lookups would only crowd real requests out of the trace buffer
+UNTRACED_ROUTES = {"/metrics", "/api/tally/traces", "/api/tally/traces/{trace_id}"}
+
+
+@app.middleware("http")
+async def observe_request(request, call_next):
+    # Label Tally metrics with the route template, not the raw path, to keep cardinality bounded
+    endpoint = "unmatched"
+    for route in app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            endpoint = route.path
+            break
+    token = current_endpoint.set(endpoint)
+    try:
+        if endpoint in UNTRACED_ROUTES:
+            return await call_next(request)
+        # Root span of the request; continues the caller's trace when it sent a traceparent
+        trace_id, parent_id = parse_traceparent(request.headers.get("traceparent"))
+        with tracer.span(f"{request.method} {endpoint}", kind=SERVER, parent=None,
+                         trace_id=trace_id, parent_id=parent_id,
+                         attributes={"http.request.method": request.method, "http.route": endpoint}) as span:
+            response = await call_next(request)
+            span.set_attribute("http.response.status_code", response.status_code)
+            if response.status_code >= 500:
+                span.status = ERROR
+            response.headers["X-Trace-Id"] = span.trace_id
+            return response
+    finally:
+        current_endpoint.reset(token)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.exception_handler(TallyUnavailableError)
+async def tally_unavailable(request, exc: TallyUnavailableError):
+    # Circuit open: answer at once and tell the client when the next probe is due
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(int(exc.retry_after) + 1)})
 
 # Include your routers
 app.include_router(group_router, prefix="/api", tags=["Group Management"])
@@ -37,6 +112,10 @@ app.include_router(trial_balance_router, prefix="/api", tags=["Trial Balance"])
 app.include_router(voucher_router, prefix="/api", tags=["Voucher Management"])
 app.include_router(balance_sheet_router, prefix="/api", tags=["Balance Sheet Management"])
 app.include_router(inventory_router, prefix="/api", tags=["Inventory Management"])
+app.include_router(bulk_master_router, prefix="/api", tags=["Master Management"])
+app.include_router(tally_status_router, prefix="/api", tags=["Tally Status"])
+app.include_router(sync_router, prefix="/api", tags=["Sync"])
+app.include_router(period_router, prefix="/api", tags=["Period Management"])
 
 
 @app.get("/")
@@ -1,20 +1,38 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
+from typing import Optional
 from services.balanceSheetService import TallyBalanceSheetFetcher
+from services.syncService import read_mirror_async
+from services.snapshotStore import validate_period
+from services.circuitBreaker import TallyUnavailableError
 
 router = APIRouter()
 
 class BalanceSheetRequest(BaseModel):
     tally_url: str
     company_name: str
+    from_date: Optional[str] = None  # YYYYMMDD
+    to_date: Optional[str] = None  # YYYYMMDD
+    max_staleness: Optional[float] = None  # seconds; answer from the local mirror if set
 
 @router.post("/balance-sheet")
-def get_balance_sheet(request: BalanceSheetRequest):
+async def get_balance_sheet(request: BalanceSheetRequest):
     try:
+        if request.max_staleness is not None:
+            validate_period(request.from_date, request.to_date)
+            result = await read_mirror_async(
+                request.tally_url, request.company_name, request.max_staleness, "balance_sheet",
+                request.from_date, request.to_date
+            )
+            return {"message": "Balance Sheet fetched successfully", "data": result}
         balancesheetmanager = TallyBalanceSheetFetcher(request.tally_url)
-        result = balancesheetmanager.get_balance_sheet(company_name=request.company_name)
+        result = await balancesheetmanager.get_balance_sheet_async(
+            company_name=request.company_name, from_date=request.from_date, to_date=request.to_date
+        )
         return {"message": "Balance Sheet fetched successfully", "data": result}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,56 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import List, Optional
+from services.bulkMasterService import TallyBulkMasterImporter
+from services.bulkImport import TALLY_BULK_CHUNK_SIZE
+from services.circuitBreaker import TallyUnavailableError
+
+router = APIRouter()
+
+class BulkGroupItem(BaseModel):
+    group_name: str
+    parent_group: str
+    nature_of_group: Optional[str] = None
+
+class BulkLedgerItem(BaseModel):
+    ledger_name: str
+    group_name: str
+    mailing_name: Optional[str] = None
+    address_list: Optional[List[str]] = None
+    pincode: Optional[str] = None
+    state: Optional[str] = None
+    country: Optional[str] = None
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    opening_balance: Optional[str] = None
+
+class BulkMastersRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    groups: List[BulkGroupItem] = []
+    ledgers: List[BulkLedgerItem] = []
+    chunk_size: Optional[int] = None  # masters per import envelope
+
+@router.post("/masters/bulk-create")
+async def bulk_create_masters(request: BulkMastersRequest):
+    """
+    Create groups and ledgers together. Results are indexed groups first,
+    then ledgers (ledger i has index len(groups) + i).
+    """
+    if not request.groups and not request.ledgers:
+        raise HTTPException(status_code=400, detail="At least one group or ledger is required")
+    try:
+        importer = TallyBulkMasterImporter(request.tally_url)
+        result = await importer.import_masters_async(
+            request.company_name,
+            [group.dict() for group in request.groups],
+            [ledger.dict() for ledger in request.ledgers],
+            chunk_size=request.chunk_size or TALLY_BULK_CHUNK_SIZE
+        )
+        return {"message": "Bulk master import processed", "data": result}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TallyUnavailableError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
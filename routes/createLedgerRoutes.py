@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Response
 from pydantic import BaseModel
 from typing import List, Optional
 from services.createLedgerService import TallyLedgerManager
+from services.idempotencyStore import IdempotencyConflict, run_idempotent
 
 router = APIRouter()
 
@@ -20,12 +21,17 @@ class LedgerRequest(BaseModel):
     opening_balance: Optional[str] = None
 
 @router.post("/ledger/create")
-def create_ledger(data: LedgerRequest):
-    try:
+async def create_ledger(data: LedgerRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    async def create():
         ledger_manager = TallyLedgerManager(data.tally_url)
-        result = ledger_manager.save_ledger(data.dict(exclude={"tally_url"}), action="CREATE")
+        result = await ledger_manager.save_ledger_async(data.dict(exclude={"tally_url"}), action="CREATE")
         if "error" in result:
             raise HTTPException(status_code=500, detail=result["error"])
         return {"message": "Ledger processed successfully", "data": result}
+
+    try:
+        return await run_idempotent(response, "ledger/create", idempotency_key, data.dict(), create)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
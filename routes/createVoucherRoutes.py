@@ -1,11 +1,20 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional,List
+import json
 from services.createVoucherService import TallyVoucherManager
 from services.updateVoucherService import TallyVoucherUpdater
-from services.transactionLedgerService import TallyLedgerFetcher
+from services.transactionLedgerService import TallyLedgerFetcher, CursorPage
 from services.createInventoryVoucherService import TallyInventoryVoucherManager
 from services.inventorySalesVoucherService import TallySalesVoucherManager
+from services.bulkImport import TALLY_BULK_CHUNK_SIZE
+from services.syncService import read_mirror_async
+from services.snapshotStore import validate_period
+from services.idempotencyStore import IdempotencyConflict, run_idempotent
+from services.writeJournal import write_journal
+from services.circuitBreaker import TallyUnavailableError
+from services.ndjsonSpool import iter_spool, spool_ndjson
 
 router = APIRouter()
 
@@ -24,6 +33,7 @@ class SalesVoucherRequest(BaseModel):
     items: list[Item]
     date: str  # Format YYYYMMDD
     narration: str | None = None
+    async_submit: bool = False  # journal the voucher and answer 202 with a job id instead of waiting for Tally
 
 class InventoryItem(BaseModel):
     name: str
@@ -42,6 +52,7 @@ class InventoryVoucherRequest(BaseModel):
     narration: Optional[str] = None
     voucher_type: str = "Purchase"
     voucher_guid: Optional[str] = None
+    async_submit: bool = False  # journal the voucher and answer 202 with a job id
 
 class VoucherRequest(BaseModel):
     tally_url: str
@@ -53,6 +64,22 @@ class VoucherRequest(BaseModel):
     date: str  # Format: YYYYMMDD
     narration: Optional[str] = None
     voucher_guid: Optional[str] = None
+    async_submit: bool = False  # journal the voucher and answer 202 with a job id
+
+class BulkVoucherItem(BaseModel):
+    from_ledger: str
+    to_ledger: str
+    amount: float
+    voucher_type: str
+    date: str  # Format: YYYYMMDD
+    narration: Optional[str] = None
+    voucher_guid: Optional[str] = None
+
+class BulkVoucherRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    vouchers: List[BulkVoucherItem]
+    chunk_size: Optional[int] = None  # vouchers per import envelope
 
 class VoucherData(BaseModel):
     company_name: Optional[str] = None
@@ -62,24 +89,45 @@ class VoucherData(BaseModel):
     voucher_type: Optional[str] = None
     date: Optional[str] = None
     narration: Optional[str] = None
+    remote_id: Optional[str] = None  # old_voucher only: address the voucher directly, skipping the lookup
 
 class VoucherUpdateRequest(BaseModel):
     tally_url: str
     old_voucher: VoucherData
     new_voucher: VoucherData
+    mode: str = "alter"  # "alter" in place by REMOTEID, or "replace" (delete, then create)
 
 class VoucherTransactionsRequest(BaseModel):
     tally_url: str
     company_name: str
     ledger_name :str
+    from_date: Optional[str] = None  # YYYYMMDD
+    to_date: Optional[str] = None  # YYYYMMDD
+    max_staleness: Optional[float] = None  # seconds; answer from the local mirror if set
+    cursor: Optional[str] = None  # next_cursor of the previous page
+    limit: Optional[int] = None  # rows per page; paging starts when cursor or limit is set
+    stream: bool = False  # answer as NDJSON, one transaction per line, then {"next_cursor"} if paged
+    sliced: bool = False  # export from_date..to_date as parallel date windows (ignored when paging)
 
 class VoucherDeleteRequest(BaseModel):
     tally_url: str
     old_voucher: VoucherData
 
+class BulkVoucherDeleteRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    remote_ids: Optional[List[str]] = None  # either this list...
+    from_date: Optional[str] = None  # ...or any of these filters
+    to_date: Optional[str] = None
+    voucher_type: Optional[str] = None
+    ledger_name: Optional[str] = None
+    chunk_size: Optional[int] = None  # vouchers per delete envelope
+    dry_run: bool = False  # report the matches without deleting
+
 @router.post("/create-sales-voucher")
-def create_sales_voucher(request: SalesVoucherRequest):
-    try:
+async def create_sales_voucher(request: SalesVoucherRequest, response: Response,
+                               idempotency_key: Optional[str] = Header(None)):
+    async def create():
         sales_manager = TallySalesVoucherManager(request.tally_url)
         data = {
             "company_name": request.company_name,
@@ -92,10 +140,24 @@ def create_sales_voucher(request: SalesVoucherRequest):
         if request.narration is not None:
             data["narration"] = request.narration
 
-        result = sales_manager.save_voucher(data, action="Create")
+        if request.async_submit:
+            job = await write_journal.submit_async("sales_voucher", request.tally_url, data)
+            return {"message": "Sales voucher queued", "job": job}
+        result = await sales_manager.save_voucher_async(data, action="Create")
+        if "error" in result:
+            raise HTTPException(status_code=500, detail=result["error"])
         return {"message": "Sales voucher created successfully", "data": result}
+
+    if request.async_submit:
+        response.status_code = 202
+    try:
+        return await run_idempotent(response, "create-sales-voucher", idempotency_key, request.dict(), create)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except (HTTPException, TallyUnavailableError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -104,70 +166,224 @@ def create_sales_voucher(request: SalesVoucherRequest):
 
 
 @router.post("/voucher/purchase-inventory/create")
-def create_inventory_voucher(request: InventoryVoucherRequest):
-    try:
+async def create_inventory_voucher(request: InventoryVoucherRequest, response: Response,
+                                   idempotency_key: Optional[str] = Header(None)):
+    async def create():
         inventory_manager = TallyInventoryVoucherManager(request.tally_url)
-        result = inventory_manager.save_voucher(request.dict(exclude={"tally_url"}), action="Create")
+        voucher = request.dict(exclude={"tally_url", "async_submit"})
+        if request.async_submit:
+            job = await write_journal.submit_async("inventory_voucher", request.tally_url, voucher)
+            return {"message": "Inventory Purchase Voucher queued", "job": job}
+        result = await inventory_manager.save_voucher_async(voucher, action="Create")
         if "error" in result:
             raise HTTPException(status_code=500, detail=result["error"])
         return {"message": "Inventory Purchase Voucher processed successfully", "data": result}
+
+    if request.async_submit:
+        response.status_code = 202
+    try:
+        return await run_idempotent(
+            response, "voucher/purchase-inventory/create", idempotency_key, request.dict(), create
+        )
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except (HTTPException, TallyUnavailableError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
 @router.post("/voucher/create")
-def create_voucher(data: VoucherRequest):
-    try:
+async def create_voucher(data: VoucherRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    async def create():
         voucher_manager = TallyVoucherManager(data.tally_url)
-        result = voucher_manager.save_voucher(data.dict(exclude={"tally_url"}), action="Create")
+        voucher = data.dict(exclude={"tally_url", "async_submit"})
+        if data.async_submit:
+            job = await write_journal.submit_async("voucher", data.tally_url, voucher)
+            return {"message": "Voucher queued", "job": job}
+        result = await voucher_manager.save_voucher_async(voucher, action="Create")
         if "error" in result:
             raise HTTPException(status_code=500, detail=result["error"])
         return {"message": "Voucher processed successfully", "data": result}
+
+    if data.async_submit:
+        response.status_code = 202
+    try:
+        return await run_idempotent(response, "voucher/create", idempotency_key, data.dict(), create)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/voucher/jobs/{job_id}")
+async def get_voucher_job(job_id: str):
+    """Status of a voucher accepted with async_submit: queued, succeeded or failed, with Tally's outcome."""
+    job = write_journal.job_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/voucher/bulk-create")
+async def bulk_create_vouchers(request: BulkVoucherRequest):
+    if not request.vouchers:
+        raise HTTPException(status_code=400, detail="At least one voucher is required")
+    try:
+        voucher_manager = TallyVoucherManager(request.tally_url)
+        result = await voucher_manager.save_vouchers_bulk_async(
+            request.company_name,
+            [voucher.dict() for voucher in request.vouchers],
+            action="Create",
+            chunk_size=request.chunk_size or TALLY_BULK_CHUNK_SIZE
+        )
+        return {"message": "Bulk voucher import processed", "data": result}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TallyUnavailableError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
     
     
 
     
     
 @router.post("/voucher/update")
-def update_voucher(request: VoucherUpdateRequest):
+async def update_voucher(request: VoucherUpdateRequest):
     try:
         updater = TallyVoucherUpdater(tally_url=request.tally_url)
-        result = updater.update_voucher(
+        result = await updater.update_voucher_async(
             old_lookup=request.old_voucher.dict(),
-            new_data=request.new_voucher.dict()
+            new_data=request.new_voucher.dict(exclude={"remote_id"}),
+            mode=request.mode
         )
         return {"status": "success", "details": result}
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     
 
 @router.post("/voucher/delete")
-def delete_voucher(request: VoucherDeleteRequest):
+async def delete_voucher(request: VoucherDeleteRequest):
     try:
         updater = TallyVoucherUpdater(tally_url=request.tally_url)
-        result = updater.delete_voucher(
+        result = await updater.delete_voucher_async(
             old_lookup=request.old_voucher.dict()
         )
         return {"status": "success", "details": result}
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
     
 
+async def _aiter_list(rows):
+    for row in rows:
+        yield row
+
+async def _ndjson(rows, page=None):
+    try:
+        async for row in rows:
+            if page is not None and not page.accept(row):
+                break
+            if page is None or page.taken:
+                yield json.dumps(row) + "\n"
+        if page is not None and page.next_cursor:
+            yield json.dumps({"next_cursor": page.next_cursor}) + "\n"
+    except Exception as e:
+        # Headers are already sent; report the failure in-band
+        yield json.dumps({"error": str(e)}) + "\n"
+    finally:
+        await rows.aclose()
+
+@router.post("/voucher/bulk-delete")
+async def bulk_delete_vouchers(request: BulkVoucherDeleteRequest):
+    try:
+        updater = TallyVoucherUpdater(tally_url=request.tally_url)
+        filters = request.dict(include={"from_date", "to_date", "voucher_type", "ledger_name"})
+        if request.remote_ids is not None:
+            if any(filters.values()):
+                raise ValueError("Pass either remote_ids or filters, not both")
+            filters = None
+        result = await updater.delete_vouchers_bulk_async(
+            request.company_name,
+            remote_ids=request.remote_ids,
+            filters=filters,
+            chunk_size=request.chunk_size or TALLY_BULK_CHUNK_SIZE,
+            dry_run=request.dry_run
+        )
+        message = "Bulk voucher delete previewed" if request.dry_run else "Bulk voucher delete processed"
+        return {"message": message, "data": result}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TallyUnavailableError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.post("/voucher/transactions")
-def get_voucher_transactions(request: VoucherTransactionsRequest):
+async def get_voucher_transactions(request: VoucherTransactionsRequest):
     try:
+        validate_period(request.from_date, request.to_date)
+        page = None
+        if request.cursor is not None or request.limit is not None:
+            page = CursorPage(request.cursor, request.limit, collect=not request.stream)
+        from_date = page.from_date(request.from_date) if page else request.from_date
+
+        if request.max_staleness is not None:
+            result = await read_mirror_async(
+                request.tally_url, request.company_name, request.max_staleness,
+                "ledger_transactions", request.ledger_name, from_date, request.to_date
+            )
+            if request.stream:
+                return StreamingResponse(_ndjson(_aiter_list(result), page), media_type="application/x-ndjson")
+            if page is None:
+                return {"status": "success", "details": result}
+            for row in result:
+                if not page.accept(row):
+                    break
+            return {"status": "success", "details": page.rows, "next_cursor": page.next_cursor}
+
         fetcher = TallyLedgerFetcher(tally_url=request.tally_url)
-        result = fetcher.get_ledger_transactions(
+        sliced = request.sliced and page is None
+        if request.stream:
+            export = fetcher.aiter_ledger_transactions_sliced if sliced else fetcher.aiter_ledger_transactions
+            # Spooled before responding: the export's host slot is released before a slow client reads
+            spool = await spool_ndjson(export(request.company_name, request.ledger_name, from_date, request.to_date), page)
+            return StreamingResponse(iter_spool(spool), media_type="application/x-ndjson")
+        if sliced:
+            result = await fetcher.get_ledger_transactions_sliced_async(
+                company_name=request.company_name,
+                ledger_name=request.ledger_name,
+                from_date=request.from_date,
+                to_date=request.to_date
+            )
+            return {"status": "success", "details": result}
+        if page is not None:
+            result, next_cursor = await fetcher.get_ledger_transactions_page_async(
+                company_name=request.company_name,
+                ledger_name=request.ledger_name,
+                from_date=request.from_date,
+                to_date=request.to_date,
+                cursor=request.cursor,
+                limit=request.limit
+            )
+            return {"status": "success", "details": result, "next_cursor": next_cursor}
+        result = await fetcher.get_ledger_transactions_async(
             company_name=request.company_name,
-            ledger_name=request.ledger_name
+            ledger_name=request.ledger_name,
+            from_date=request.from_date,
+            to_date=request.to_date
         )
         return {"status": "success", "details": result}
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
@@ -1,6 +1,9 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Response
 from pydantic import BaseModel
+from typing import Optional
 from services.groupService import TallyGroupService
+from services.idempotencyStore import IdempotencyConflict, run_idempotent
+from services.circuitBreaker import TallyUnavailableError
 
 router = APIRouter()
 
@@ -11,8 +14,8 @@ class GroupRequest(BaseModel):
     parent_group: str | None = None  
 
 @router.post("/create-group")
-def create_group(request: GroupRequest):
-    try:
+async def create_group(request: GroupRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    async def create():
         group_manager = TallyGroupService(request.tally_url)
         data = {
             "company_name": request.company_name,
@@ -20,10 +23,19 @@ def create_group(request: GroupRequest):
             "parent_group": request.parent_group,
         }
 
-        result = group_manager.create_group(data)
+        result = await group_manager.create_group_async(data)
+        if "error" in result:
+            raise HTTPException(status_code=500, detail=result["error"])
         return {"message": "Group created successfully", "data": result}
+
+    try:
+        return await run_idempotent(response, "create-group", idempotency_key, request.dict(), create)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except (HTTPException, TallyUnavailableError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2,6 +2,9 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional, List
 from services.inventoryService import TallyInventoryManagement  
+from services.bulkImport import TALLY_BULK_CHUNK_SIZE
+from services.syncService import read_mirror_async
+from services.circuitBreaker import TallyUnavailableError
 router = APIRouter()
 
 class StockItemRequest(BaseModel):
@@ -11,19 +14,53 @@ class StockItemRequest(BaseModel):
     parent_group: str
     unit: str
     opening_balance: Optional[float] = 0
+    readback: bool = True  # set False to skip reading back the closing balance
 
 @router.post("/inventory/item/create")
-def create_stock_item(request: StockItemRequest):
+async def create_stock_item(request: StockItemRequest):
     try:
         manager = TallyInventoryManagement(request.tally_url)
-        result = manager.create_stock_item(
+        result = await manager.create_stock_item_async(
             company_name=request.company_name,
             item_name=request.item_name,
             parent_group=request.parent_group,
             unit=request.unit,
-            opening_balance=request.opening_balance
+            opening_balance=request.opening_balance,
+            readback=request.readback
         )
         return {"message": "Stock Item created successfully", "data": result}
+    except TallyUnavailableError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+class BulkStockItem(BaseModel):
+    item_name: str
+    parent_group: str
+    unit: str
+    opening_balance: Optional[float] = 0
+
+class BulkStockItemsRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    items: List[BulkStockItem]
+    chunk_size: Optional[int] = None  # stock items per import envelope
+
+@router.post("/inventory/item/bulk-create")
+async def bulk_create_stock_items(request: BulkStockItemsRequest):
+    if not request.items:
+        raise HTTPException(status_code=400, detail="At least one stock item is required")
+    try:
+        manager = TallyInventoryManagement(request.tally_url)
+        result = await manager.create_stock_items_bulk_async(
+            company_name=request.company_name,
+            items=[item.dict() for item in request.items],
+            chunk_size=request.chunk_size or TALLY_BULK_CHUNK_SIZE
+        )
+        return {"message": "Bulk stock item import processed", "data": result}
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -38,22 +75,26 @@ class StockJournalRequest(BaseModel):
     godown: Optional[str] = "Main Location"
     date: str  # YYYYMMDD
     voucher_guid: Optional[str] = None
+    readback: bool = True  # set False to skip reading back the closing balance
 
 @router.post("/inventory/journal/create")
-def create_stock_journal(request: StockJournalRequest):
+async def create_stock_journal(request: StockJournalRequest):
     "add -ve sign before quantity to add to the stock and no sign to remove from stock"
     try:
         manager = TallyInventoryManagement(request.tally_url)
-        result = manager.create_stock_journal(
+        result = await manager.create_stock_journal_async(
             company_name=request.company_name,
             narration=request.narration,
             item_name=request.item_name,
             qty=request.qty,
             unit=request.unit,
             godown=request.godown,
-            date=request.date
+            date=request.date,
+            readback=request.readback
         )
         return {"message": "Stock Journal created successfully", "data": result}
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -61,13 +102,21 @@ def create_stock_journal(request: StockJournalRequest):
 class StockItemsRequest(BaseModel):
     tally_url: str
     company_name: str
+    max_staleness: Optional[float] = None  # seconds; answer from the local mirror if set
 
 
 @router.post("/inventory/items")
-def get_all_stock_items(request: StockItemsRequest):
+async def get_all_stock_items(request: StockItemsRequest):
     try:
+        if request.max_staleness is not None:
+            stock_items = await read_mirror_async(
+                request.tally_url, request.company_name, request.max_staleness, "stock_items"
+            )
+            return {"items": stock_items}
         manager = TallyInventoryManagement(request.tally_url)
-        stock_items = manager.fetch_all_stock_items(request.company_name)
+        stock_items = await manager.fetch_all_stock_items_async(request.company_name)
         return {"items": stock_items}
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,56 @@
+import asyncio
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from services.snapshotStore import snapshot_store, validate_period
+from services.reportCache import report_cache
+
+router = APIRouter()
+
+class ClosePeriodRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    to_date: str  # YYYYMMDD; books are closed up to and including this day
+
+class ReopenPeriodRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    from_date: str  # YYYYMMDD; books are open again from this day on
+
+@router.post("/periods/close")
+async def close_period(request: ClosePeriodRequest):
+    """Mark a period closed so reports ending inside it are snapshotted and served from disk."""
+    try:
+        validate_period(to_date=request.to_date)
+        closed = await asyncio.to_thread(
+            snapshot_store.close_period, request.tally_url, request.company_name, request.to_date
+        )
+        return {"message": "Period closed", "data": {"closed_through": closed}}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/periods/reopen")
+async def reopen_period(request: ReopenPeriodRequest):
+    """Reopen the books from from_date and drop every snapshot that covers it."""
+    try:
+        validate_period(from_date=request.from_date)
+        purged = await asyncio.to_thread(
+            snapshot_store.reopen_period, request.tally_url, request.company_name, request.from_date
+        )
+        report_cache.invalidate(request.tally_url, request.company_name)
+        return {"message": "Period reopened", "data": {
+            "closed_through": snapshot_store.closed_through(request.tally_url, request.company_name),
+            "purged_snapshots": purged,
+        }}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/periods")
+async def get_periods(tally_url: str, company_name: str):
+    return {"data": {
+        "closed_through": snapshot_store.closed_through(tally_url, company_name),
+        **await asyncio.to_thread(snapshot_store.stats, tally_url, company_name),
+    }}
@@ -0,0 +1,46 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import Optional
+from services.syncService import (
+    TALLY_SYNC_INTERVAL, get_sync_engine, start_background_sync, stop_background_sync
+)
+from services.circuitBreaker import TallyUnavailableError
+
+router = APIRouter()
+
+class SyncRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    full: bool = False  # re-pull everything, reconciling deletions
+
+class BackgroundSyncRequest(BaseModel):
+    tally_url: str
+    company_name: str
+    interval: Optional[float] = None  # seconds between passes
+
+@router.post("/sync/run")
+async def run_sync(request: SyncRequest):
+    """Pull masters and vouchers altered since the last sync."""
+    try:
+        engine = get_sync_engine(request.tally_url, request.company_name)
+        result = await engine.sync_now_async(full=request.full)
+        return {"message": "Sync completed", "data": result}
+    except TallyUnavailableError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/sync/background/start")
+async def start_sync(request: BackgroundSyncRequest):
+    started = start_background_sync(request.tally_url, request.company_name, request.interval or TALLY_SYNC_INTERVAL)
+    message = "Background sync started" if started else "Background sync already running"
+    return {"message": message, "data": get_sync_engine(request.tally_url, request.company_name).status()}
+
+@router.post("/sync/background/stop")
+async def stop_sync(request: BackgroundSyncRequest):
+    stopped = await stop_background_sync(request.tally_url, request.company_name)
+    return {"message": "Background sync stopped" if stopped else "Background sync was not running"}
+
+@router.get("/sync/status")
+async def sync_status(tally_url: str, company_name: str):
+    return {"data": get_sync_engine(tally_url, company_name).status()}
@@ -0,0 +1,57 @@
+from fastapi import APIRouter, HTTPException
+from services.tallyScheduler import queue_depths
+from services.reportCache import report_cache
+from services.singleFlight import report_flights
+from services.circuitBreaker import breaker_states
+from services.timeoutPolicy import timeout_policy
+from services.tracing import breakdown, span_tree, tracer
+
+router = APIRouter()
+
+
+@router.get("/tally/queue")
+async def get_queue_depth():
+    """In-flight and queued Tally requests per host, split by priority and company."""
+    return {"hosts": queue_depths()}
+
+
+@router.get("/tally/cache")
+async def get_cache_stats():
+    """Report cache size and hit/miss counters, plus coalesced in-flight exports."""
+    return {**report_cache.stats(), "flights": report_flights.stats()}
+
+
+@router.get("/tally/breakers")
+async def get_breaker_states():
+    """Circuit state per Tally host: closed, open (failing fast) or half_open (probing)."""
+    return {"hosts": breaker_states()}
+
+
+@router.get("/tally/timeouts")
+async def get_timeouts():
+    """Current read timeout per host and operation class, with the p95/p99 latency it was derived from."""
+    return {"timeouts": timeout_policy.stats()}
+
+
+def _trace_store():
+    if tracer.memory is None:
+        raise HTTPException(status_code=404, detail="Trace buffer disabled; add 'memory' to TALLY_TRACE_EXPORTERS")
+    return tracer.memory
+
+
+@router.get("/tally/traces")
+async def get_traces(limit: int = 50):
+    """Most recent traces in the in-memory buffer, newest first."""
+    return {"traces": _trace_store().recent(limit)}
+
+
+@router.get("/tally/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """
+    One trace as a span tree, with self time per span and a breakdown of
+    where the time went (validation, build_xml, tally.post, xml.parse, ...).
+    """
+    spans = _trace_store().spans(trace_id.lower())
+    if not spans:
+        raise HTTPException(status_code=404, detail=f"Trace {trace_id} not found")
+    return {"trace_id": trace_id.lower(), "breakdown": breakdown(spans), "spans": span_tree(spans)}
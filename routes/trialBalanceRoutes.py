@@ -1,20 +1,36 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
+from typing import Optional
 from services.trialBalanceService import TallyTrialBalanceManager
+from services.syncService import read_mirror_async
+from services.snapshotStore import validate_period
+from services.circuitBreaker import TallyUnavailableError
 
 router = APIRouter()
 
 class TrialBalanceRequest(BaseModel):
     tally_url: str
     company_name: str
+    from_date: Optional[str] = None  # YYYYMMDD
+    to_date: Optional[str] = None  # YYYYMMDD
+    max_staleness: Optional[float] = None  # seconds; answer from the local mirror if set
 
 @router.post("/trial-balance")
-def get_trial_balance(request: TrialBalanceRequest):
+async def get_trial_balance(request: TrialBalanceRequest):
     try:
+        if request.max_staleness is not None:
+            validate_period(request.from_date, request.to_date)
+            result = await read_mirror_async(
+                request.tally_url, request.company_name, request.max_staleness, "trial_balance",
+                request.from_date, request.to_date
+            )
+            return {"message": "Trial balance fetched successfully", "data": result}
         manager = TallyTrialBalanceManager(request.tally_url)
-        result = manager.get_trial_balance(request.dict(exclude={"tally_url"}))
+        result = await manager.get_trial_balance_async(request.dict(exclude={"tally_url", "max_staleness"}))
         return {"message": "Trial balance fetched successfully", "data": result}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except TallyUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
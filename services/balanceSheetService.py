@@ -1,13 +1,32 @@
 import requests
 import xml.etree.ElementTree as ET
 import json
+import logging
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import REPORT_EXPORT
+from services.reportCache import report_cache
+from services.singleFlight import report_flights
+from services.snapshotStore import snapshot_store, validate_period
+from services.xmlStream import TALLY_STREAM_CHUNK_SIZE, iter_rows, aiter_rows
+from services.metrics import observe_build
+
+logger = logging.getLogger(__name__)
+
+# Sibling elements that together make one balance sheet row
+ROW_TAGS = ("BSNAME", "BSAMT")
 
 
 class TallyBalanceSheetFetcher:
     def __init__(self, tally_url: str):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
 
-    def _get_balance_sheet_xml(self,company_name:str) -> str:
+    @observe_build
+    def _get_balance_sheet_xml(self,company_name:str, from_date=None, to_date=None) -> str:
+        period_xml = "".join(
+            f"\n                    <{tag}>{value}</{tag}>"
+            for tag, value in (("SVFROMDATE", from_date), ("SVTODATE", to_date)) if value
+        )
         return f"""
 <ENVELOPE>
     <HEADER>
@@ -19,7 +38,7 @@ class TallyBalanceSheetFetcher:
                 <REPORTNAME>Balance Sheet</REPORTNAME>
                 <STATICVARIABLES>
                     <SVCURRENTCOMPANY>{company_name}</SVCURRENTCOMPANY>
-                    <EXPLODEALLLEVELS>Yes</EXPLODEALLLEVELS>
+                    <EXPLODEALLLEVELS>Yes</EXPLODEALLLEVELS>{period_xml}
                     <SVEXPORTFORMAT>$$SysName:XML</SVEXPORTFORMAT>
                 </STATICVARIABLES>
             </REQUESTDESC>
@@ -30,59 +49,146 @@ class TallyBalanceSheetFetcher:
 
     def fetch_balance_sheet(self,company_name:str) -> str | None:
         xml_request = self._get_balance_sheet_xml(company_name)
-        headers = {"Content-Type": "application/xml"}
         try:
-            response = requests.post(
-                self.tally_url, data=xml_request.encode("utf-8"),
-                headers=headers, timeout=10
+            response = self.client.post(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
             )
             if response.status_code == 200:
                 return response.text
             else:
-                print("Error from Tally:", response.status_code, response.text)
+                logger.warning("Error from Tally: %s %s", response.status_code, response.text)
                 return None
         except requests.exceptions.RequestException as e:
-            print("Failed to communicate with Tally server:", e)
+            logger.warning("Failed to communicate with Tally server: %s", e)
             return None
 
-    def parse_balance_sheet(self, xml_response: str) -> list[dict]:
+    async def fetch_balance_sheet_async(self,company_name:str) -> str | None:
+        xml_request = self._get_balance_sheet_xml(company_name)
+        try:
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            )
+            if response.status_code == 200:
+                return response.text
+            else:
+                logger.warning("Error from Tally: %s %s", response.status_code, response.text)
+                return None
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to communicate with Tally server: %s", e)
+            return None
+
+    def build_row(self, name_elem, amt_elem) -> dict:
+        """Turn one BSNAME/BSAMT pair into a balance sheet row."""
+        name_node = name_elem.find(".//DSPDISPNAME")
+        sub_amt = amt_elem.find("BSSUBAMT")
+        main_amt = amt_elem.find("BSMAINAMT")
+
+        account = name_node.text.strip() if (name_node is not None and name_node.text) else "Unknown"
+        if sub_amt is not None and sub_amt.text:
+            balance = sub_amt.text.strip()
+        elif main_amt is not None and main_amt.text:
+            balance = main_amt.text.strip()
+        else:
+            balance = "0"
+
+        return {
+            "account": account,
+            "closing_balance": balance
+        }
+
+    def parse_stream(self, chunks, encoding="utf-8") -> list[dict]:
         """
-        Parse Balance Sheet XML response into structured list of dicts.
-        Matches <BSNAME> with following <BSAMT>.
+        Parse Balance Sheet XML chunks as they arrive.
+        Matches <BSNAME> with following <BSAMT>. A cut-off or malformed
+        response raises rather than returning the rows read so far, so a
+        partial balance sheet is never cached or snapshotted.
         """
         balances = []
         try:
-            root = ET.fromstring(xml_response)
-            bs_names = root.findall("BSNAME")
-            bs_amts = root.findall("BSAMT")
-
-            for i in range(min(len(bs_names), len(bs_amts))):
-                name_node = bs_names[i].find(".//DSPDISPNAME")
-                sub_amt = bs_amts[i].find("BSSUBAMT")
-                main_amt = bs_amts[i].find("BSMAINAMT")
-
-                account = name_node.text.strip() if (name_node is not None and name_node.text) else "Unknown"
-                balance = None
-                if sub_amt is not None and sub_amt.text:
-                    balance = sub_amt.text.strip()
-                elif main_amt is not None and main_amt.text:
-                    balance = main_amt.text.strip()
-                else:
-                    balance = "0"
-
-                balances.append({
-                    "account": account,
-                    "closing_balance": balance
-                })
-
+            for row in iter_rows(chunks, ROW_TAGS, encoding, report="balance_sheet"):
+                balances.append(self.build_row(*row))
         except ET.ParseError as e:
-            print("Error parsing XML:", e)
+            raise Exception(f"Error parsing XML: {e}")
+        return balances
 
+    async def parse_stream_async(self, chunks, encoding="utf-8") -> list[dict]:
+        balances = []
+        try:
+            async for row in aiter_rows(chunks, ROW_TAGS, encoding, report="balance_sheet"):
+                balances.append(self.build_row(*row))
+        except ET.ParseError as e:
+            raise Exception(f"Error parsing XML: {e}")
         return balances
 
-    def get_balance_sheet(self,company_name:str) -> list[dict]:
-        xml_response = self.fetch_balance_sheet(company_name)
-        if xml_response:
-            return self.parse_balance_sheet(xml_response)
-        return []
+    def parse_balance_sheet(self, xml_response: str) -> list[dict]:
+        """
+        Parse Balance Sheet XML response into structured list of dicts.
+        """
+        return self.parse_stream([xml_response])
+
+    def get_balance_sheet(self,company_name:str, from_date=None, to_date=None) -> list[dict]:
+        validate_period(from_date, to_date)
+        params = {"from_date": from_date, "to_date": to_date}
+        hit, snapshot = snapshot_store.get(self.tally_url, company_name, "balance_sheet", params)
+        if hit:
+            return snapshot
+        key = report_cache.key(self.tally_url, company_name, "balance_sheet", **params)
+        hit, cached = report_cache.get(key)
+        if hit:
+            return cached
+        return report_flights.do(
+            key + (report_cache.generation(self.tally_url, company_name),),
+            lambda: self._load_balance_sheet(company_name, key, params)
+        )
+
+    def _load_balance_sheet(self, company_name: str, key, params):
+        generation = report_cache.generation(self.tally_url, company_name)
+        xml_request = self._get_balance_sheet_xml(company_name, params["from_date"], params["to_date"])
+        try:
+            with self.client.stream(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            ) as response:
+                if response.status_code != 200:
+                    logger.warning("Error from Tally: %s %s", response.status_code, response.text)
+                    return []
+                result = self.parse_stream(response.iter_content(TALLY_STREAM_CHUNK_SIZE), response.encoding or "utf-8")
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to communicate with Tally server: %s", e)
+            return []
+        report_cache.put(key, result, generation)
+        snapshot_store.put(self.tally_url, company_name, "balance_sheet", params, result)
+        return result
+
+    async def get_balance_sheet_async(self,company_name:str, from_date=None, to_date=None) -> list[dict]:
+        validate_period(from_date, to_date)
+        params = {"from_date": from_date, "to_date": to_date}
+        hit, snapshot = await snapshot_store.get_async(self.tally_url, company_name, "balance_sheet", params)
+        if hit:
+            return snapshot
+        key = report_cache.key(self.tally_url, company_name, "balance_sheet", **params)
+        hit, cached = report_cache.get(key)
+        if hit:
+            return cached
+        return await report_flights.do_async(
+            key + (report_cache.generation(self.tally_url, company_name),),
+            lambda: self._load_balance_sheet_async(company_name, key, params)
+        )
 
+    async def _load_balance_sheet_async(self, company_name: str, key, params):
+        generation = report_cache.generation(self.tally_url, company_name)
+        xml_request = self._get_balance_sheet_xml(company_name, params["from_date"], params["to_date"])
+        try:
+            async with get_async_tally_client(self.tally_url).stream(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            ) as response:
+                if response.status_code != 200:
+                    await response.read()
+                    logger.warning("Error from Tally: %s %s", response.status_code, response.text)
+                    return []
+                result = await self.parse_stream_async(response.aiter_bytes(), response.encoding)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to communicate with Tally server: %s", e)
+            return []
+        report_cache.put(key, result, generation)
+        await snapshot_store.put_async(self.tally_url, company_name, "balance_sheet", params, result)
+        return result
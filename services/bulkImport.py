@@ -0,0 +1,102 @@
+import html
+import os
+import re
+
+# Objects packed into one TALLYMESSAGE per import request
+TALLY_BULK_CHUNK_SIZE = int(os.getenv("TALLY_BULK_CHUNK_SIZE", "100"))
+
+COUNT_TAGS = ["CREATED", "ALTERED", "DELETED", "COMBINED", "IGNORED", "ERRORS", "CANCELLED", "EXCEPTIONS"]
+
+
+def chunked(items: list, size: int):
+    """Yield successive slices of items with at most size elements."""
+    size = max(1, int(size or TALLY_BULK_CHUNK_SIZE))
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def parse_import_response(response_text: str) -> dict:
+    """
+    Read the counters and LINEERROR messages out of a Tally import response.
+    Deliberately regex based: Tally echoes unescaped names into LINEERROR, which
+    regularly makes the response invalid XML.
+    """
+    summary = {}
+    for tag in COUNT_TAGS:
+        match = re.search(rf"<{tag}>\s*(-?\d+)\s*</{tag}>", response_text or "")
+        summary[tag.lower()] = int(match.group(1)) if match else 0
+    summary["line_errors"] = [
+        html.unescape(m.strip()) for m in re.findall(r"<LINEERROR>(.*?)</LINEERROR>", response_text or "", re.S)
+    ]
+    return summary
+
+
+def _mentions(message: str, identifier) -> bool:
+    """True when identifier appears in message as a whole name, not inside a longer one."""
+    if not identifier:
+        return False
+    return re.search(rf"(?<!\w){re.escape(str(identifier))}(?!\w)", message) is not None
+
+
+def map_import_results(items: list[dict], response, success_keys=("created", "altered", "combined")) -> list[dict]:
+    """
+    Turn one chunk's import response into per-item outcomes.
+
+    items: [{"index": int, "remote_id": str, "identifiers": [names to look for in LINEERROR]}]
+    response: {"status": int, "response": str} or {"error": str} as returned by post_to_tally.
+
+    Tally only reports counts, so a LINEERROR is attributed to the one item
+    whose identifiers it mentions; a message naming no item, or several, is
+    only reported as the batch error. Remaining items are reported as
+    succeeded when the success counters account for all of them, otherwise as
+    "unknown" with the batch error.
+    """
+    def outcome(item, status, error=None):
+        result = {"index": item["index"], "remote_id": item.get("remote_id"), "status": status}
+        if error:
+            result["error"] = error
+        return result
+
+    if "error" in response:
+        return [outcome(item, "error", response["error"]) for item in items]
+    if response.get("status") != 200:
+        return [outcome(item, "error", f"Tally returned {response.get('status')}") for item in items]
+
+    summary = parse_import_response(response.get("response", ""))
+    succeeded = sum(summary[key] for key in success_keys)
+    success_status = success_keys[0]
+
+    if not summary["errors"] and not summary["exceptions"] and succeeded >= len(items):
+        return [outcome(item, success_status) for item in items]
+
+    failed = {}
+    for message in summary["line_errors"]:
+        matches = [
+            item for item in items
+            if any(_mentions(message, identifier) for identifier in item.get("identifiers", []))
+        ]
+        # A message naming several items cannot be pinned on one; it stays a batch-level error
+        if len(matches) == 1:
+            failed.setdefault(matches[0]["index"], message)
+
+    remaining = [item for item in items if item["index"] not in failed]
+    remaining_status = success_status if succeeded >= len(remaining) else "unknown"
+    chunk_error = "; ".join(summary["line_errors"]) or "Tally reported errors for this batch"
+
+    results = []
+    for item in items:
+        if item["index"] in failed:
+            results.append(outcome(item, "error", failed[item["index"]]))
+        elif remaining_status == "unknown":
+            results.append(outcome(item, "unknown", chunk_error))
+        else:
+            results.append(outcome(item, success_status))
+    return results
+
+
+def summarize_results(results: list[dict]) -> dict:
+    """Count per-item outcomes by status and return them with the sorted results."""
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return {"total": len(results), "counts": counts, "results": sorted(results, key=lambda r: r["index"])}
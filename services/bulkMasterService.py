@@ -0,0 +1,175 @@
+import requests
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import MASTER_IMPORT
+from services.createLedgerService import TallyLedgerManager
+from services.groupService import TallyGroupService
+from services.bulkImport import TALLY_BULK_CHUNK_SIZE, chunked, map_import_results, summarize_results
+
+
+class TallyBulkMasterImporter:
+    """
+    Import groups and ledgers for one company in chunked All Masters requests.
+    Groups are sent parent-first and before any ledger, so ledgers that point
+    at groups created in the same batch resolve.
+    """
+
+    def __init__(self, tally_url="http://localhost:9000"):
+        self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
+        self.ledger_manager = TallyLedgerManager(tally_url)
+        self.group_service = TallyGroupService(tally_url)
+
+    def post_to_tally(self, xml_string, company_name=None, items=1):
+        try:
+            response = self.client.post(xml_string, operation=MASTER_IMPORT, company_name=company_name, items=items)
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    async def post_to_tally_async(self, xml_string, company_name=None, items=1):
+        try:
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=MASTER_IMPORT, company_name=company_name, items=items
+            )
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    def order_groups(self, groups: list[dict]):
+        """
+        Sort groups so every parent defined in the batch comes before its children.
+        Returns (ordered groups, groups caught in a parent cycle).
+        """
+        by_name = {group["group_name"]: group for group in groups}
+        ordered, visiting, done, cyclic = [], set(), set(), []
+
+        def visit(group):
+            name = group["group_name"]
+            if name in done:
+                return True
+            if name in visiting:
+                return False
+            visiting.add(name)
+            parent = by_name.get(group.get("parent_group"))
+            resolved = visit(parent) if parent is not None else True
+            visiting.discard(name)
+            done.add(name)
+            if resolved:
+                ordered.append(group)
+            else:
+                cyclic.append(group)
+            return resolved
+
+        for group in groups:
+            visit(group)
+        return ordered, cyclic
+
+    def _prepare(self, company_name, groups: list[dict], ledgers: list[dict]):
+        """Validate and order the batch; return (entries to import, invalid item results)."""
+        invalid = []
+
+        valid_groups = []
+        for index, group in enumerate(groups):
+            data = {k: v for k, v in {**group, "company_name": company_name}.items() if v is not None}
+            try:
+                self.group_service.validate_input(
+                    data, self.group_service.required_fields_create, self.group_service.all_fields_create
+                )
+            except ValueError as e:
+                invalid.append({"index": index, "type": "group", "name": group.get("group_name"),
+                                "status": "invalid", "error": str(e)})
+                continue
+            valid_groups.append({**data, "_index": index})
+
+        ordered_groups, cyclic_groups = self.order_groups(valid_groups)
+        for group in cyclic_groups:
+            invalid.append({"index": group["_index"], "type": "group", "name": group["group_name"],
+                            "status": "invalid", "error": "Group parent chain forms a cycle"})
+
+        entries = []
+        for group in ordered_groups:
+            entries.append({
+                "index": group["_index"],
+                "type": "group",
+                "name": group["group_name"],
+                "parent": group["parent_group"],
+                "identifiers": [group["group_name"]],
+                "xml": self.group_service.build_group_element(group, action="CREATE"),
+            })
+
+        offset = len(groups)
+        for position, ledger in enumerate(ledgers):
+            data = {**ledger, "company_name": company_name}
+            try:
+                self.ledger_manager.validate_input(data)
+            except ValueError as e:
+                invalid.append({"index": offset + position, "type": "ledger", "name": ledger.get("ledger_name"),
+                                "status": "invalid", "error": str(e)})
+                continue
+            entries.append({
+                "index": offset + position,
+                "type": "ledger",
+                "name": data["ledger_name"],
+                "parent": data["group_name"],
+                "identifiers": [data["ledger_name"]],
+                "xml": self.ledger_manager.build_ledger_element(data, action="CREATE"),
+            })
+
+        return entries, invalid
+
+    def _split_batch(self, batch, failed_groups):
+        """Skip objects whose parent group failed earlier; return (to send, skipped results)."""
+        to_send, skipped = [], []
+        for entry in batch:
+            if entry["parent"] in failed_groups:
+                skipped.append({"index": entry["index"], "status": "skipped",
+                                "error": f"Parent group '{entry['parent']}' was not created"})
+                if entry["type"] == "group":
+                    failed_groups.add(entry["name"])
+            else:
+                to_send.append(entry)
+        return to_send, skipped
+
+    def _record(self, batch, outcomes, failed_groups):
+        by_index = {entry["index"]: entry for entry in batch}
+        for outcome in outcomes:
+            entry = by_index[outcome["index"]]
+            outcome.pop("remote_id", None)
+            if outcome["status"] != "created" and entry["type"] == "group":
+                failed_groups.add(entry["name"])
+        return outcomes
+
+    def _label(self, results, entries, invalid):
+        names = {entry["index"]: (entry["type"], entry["name"]) for entry in entries}
+        for result in results:
+            if result["index"] in names:
+                result["type"], result["name"] = names[result["index"]]
+        return summarize_results(results + invalid)
+
+    def import_masters(self, company_name, groups: list[dict], ledgers: list[dict], chunk_size=TALLY_BULK_CHUNK_SIZE):
+        """Create groups then ledgers, chunk_size objects per All Masters request."""
+        entries, invalid = self._prepare(company_name, groups, ledgers)
+        results, failed_groups = [], set()
+        for batch in chunked(entries, chunk_size):
+            to_send, skipped = self._split_batch(batch, failed_groups)
+            results.extend(skipped)
+            if not to_send:
+                continue
+            xml_payload = self.ledger_manager.build_envelope(company_name, "".join(e["xml"] for e in to_send))
+            response = self.post_to_tally(xml_payload, company_name, len(to_send))
+            results.extend(self._record(to_send, map_import_results(to_send, response), failed_groups))
+        return self._label(results, entries, invalid)
+
+    async def import_masters_async(self, company_name, groups: list[dict], ledgers: list[dict],
+                                   chunk_size=TALLY_BULK_CHUNK_SIZE):
+        entries, invalid = self._prepare(company_name, groups, ledgers)
+        results, failed_groups = [], set()
+        for batch in chunked(entries, chunk_size):
+            to_send, skipped = self._split_batch(batch, failed_groups)
+            results.extend(skipped)
+            if not to_send:
+                continue
+            xml_payload = self.ledger_manager.build_envelope(company_name, "".join(e["xml"] for e in to_send))
+            response = await self.post_to_tally_async(xml_payload, company_name, len(to_send))
+            results.extend(self._record(to_send, map_import_results(to_send, response), failed_groups))
+        return self._label(results, entries, invalid)
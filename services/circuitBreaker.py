@@ -0,0 +1,175 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from services.tallyScheduler import TallyQueueTimeout
+
+# Consecutive connection failures or timeouts that open a host's circuit
+TALLY_BREAKER_THRESHOLD = int(os.getenv("TALLY_BREAKER_THRESHOLD", "5"))
+# Seconds an open circuit rejects requests before letting a probe through
+TALLY_BREAKER_COOLDOWN = float(os.getenv("TALLY_BREAKER_COOLDOWN", "15"))
+# Probe requests allowed at once while half-open
+TALLY_BREAKER_PROBES = int(os.getenv("TALLY_BREAKER_PROBES", "1"))
+# Extra attempts for exports (reads are safe to repeat) and the backoff base/cap in seconds
+TALLY_EXPORT_RETRIES = int(os.getenv("TALLY_EXPORT_RETRIES", "2"))
+TALLY_RETRY_BACKOFF = float(os.getenv("TALLY_RETRY_BACKOFF", "0.2"))
+TALLY_RETRY_BACKOFF_MAX = float(os.getenv("TALLY_RETRY_BACKOFF_MAX", "2"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Transport failures that say the host is down or stuck. A queue timeout is
+# local congestion, not a verdict on Tally, so it is left out.
+FAILURES = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class TallyUnavailableError(Exception):
+    """
+    Raised without contacting Tally while its circuit is open. Deliberately not
+    a RequestException, so it is not folded into the {"error": ...} results of
+    the services and reaches the route as a 503.
+    """
+
+    def __init__(self, tally_url: str, retry_after: float):
+        super().__init__(f"Tally at {tally_url} is unavailable; retry in {retry_after:.0f}s")
+        self.tally_url = tally_url
+        self.retry_after = retry_after
+
+
+def is_failure(error) -> bool:
+    return isinstance(error, FAILURES) and not isinstance(error, TallyQueueTimeout)
+
+
+def is_retryable(error) -> bool:
+    """
+    Only connection failures (including connect timeouts) are retried. A read
+    timeout has already spent the whole budget on a busy Tally, and asking
+    again would only add to its load.
+    """
+    return isinstance(error, requests.exceptions.ConnectionError)
+
+
+def backoff_delay(attempt: int, base: float = TALLY_RETRY_BACKOFF, cap: float = TALLY_RETRY_BACKOFF_MAX) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker.
+
+    Closed: requests flow and consecutive transport failures are counted.
+    Open: after threshold failures every request fails at once with
+    TallyUnavailableError for cooldown seconds. Half-open: up to probes
+    requests are let through; a success closes the circuit, a failure
+    opens it for another cooldown.
+    """
+
+    def __init__(self, tally_url: str, threshold: int = TALLY_BREAKER_THRESHOLD,
+                 cooldown: float = TALLY_BREAKER_COOLDOWN, probes: int = TALLY_BREAKER_PROBES):
+        self.tally_url = tally_url
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.probes = max(1, probes)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = 0
+        self.rejected = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def _retry_after(self, now):
+        return max(0.0, self.opened_at + self.cooldown - now)
+
+    def acquire(self) -> bool:
+        """Admit a request or raise TallyUnavailableError; returns True if it is a half-open probe."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now < self.opened_at + self.cooldown:
+                    self.rejected += 1
+                    raise TallyUnavailableError(self.tally_url, self._retry_after(now))
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self.probing >= self.probes:
+                    self.rejected += 1
+                    raise TallyUnavailableError(self.tally_url, self.cooldown)
+                self.probing += 1
+                return True
+            return False
+
+    def check(self):
+        """Raise TallyUnavailableError if acquire() would; lets callers shed load before queueing for a slot."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now < self.opened_at + self.cooldown:
+                self.rejected += 1
+                raise TallyUnavailableError(self.tally_url, self._retry_after(now))
+            if self.state == HALF_OPEN and self.probing >= self.probes:
+                self.rejected += 1
+                raise TallyUnavailableError(self.tally_url, self.cooldown)
+
+    def record(self, probe: bool, error=None):
+        """Settle an admitted request: error=None for a response, otherwise the exception it raised."""
+        with self._lock:
+            if probe:
+                self.probing -= 1
+            if error is None:
+                self.failures = 0
+                self.state = CLOSED
+                return
+            if not is_failure(error):
+                return
+            self.failures += 1
+            if probe or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self):
+        """Admit one request and settle it on exit; never blocks, so it also wraps awaits."""
+        probe = self.acquire()
+        try:
+            yield probe
+        except BaseException as e:
+            self.record(probe, e)
+            raise
+        self.record(probe)
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "tally_url": self.tally_url,
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_after": self._retry_after(now) if self.state == OPEN else 0.0,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(tally_url: str) -> CircuitBreaker:
+    """Return the shared breaker for tally_url, creating it on first use."""
+    breaker = _breakers.get(tally_url)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(tally_url)
+            if breaker is None:
+                breaker = CircuitBreaker(tally_url)
+                _breakers[tally_url] = breaker
+    return breaker
+
+
+def breaker_states() -> list[dict]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [breaker.stats() for breaker in breakers]
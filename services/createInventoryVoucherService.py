@@ -1,9 +1,14 @@
 import requests
 import re
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import VOUCHER_IMPORT
+from services.metrics import observe_build
+from services.tracing import traced
 
 class TallyInventoryVoucherManager:
     def __init__(self, tally_url="http://localhost:9000"):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
         self.required_fields = [
             "company_name", "party_ledger", "purchase_ledger",
             "items", "date", "voucher_type"
@@ -18,6 +23,7 @@ class TallyInventoryVoucherManager:
         return value.lower()
 
     # ---------- Validation ----------
+    @traced()
     def validate_input(self, data: dict):
         for field in self.required_fields:
             if field not in data or not data[field]:
@@ -45,13 +51,21 @@ class TallyInventoryVoucherManager:
     def build_voucher_guid(self, party_ledger, purchase_ledger, total_amount, voucher_type, date):
         return f"{self.to_snake_case(party_ledger)}_{self.to_snake_case(purchase_ledger)}_{total_amount}_{voucher_type}_{date}"
 
-    # ---------- XML Builder ----------
-    def build_xml(self, data: dict, action="Create"):
-        total_amount = sum(item["qty"] * item["rate"] for item in data["items"])
-        voucher_guid = data.get("voucher_guid") or self.build_voucher_guid(
+    def _remote_id(self, data: dict):
+        # Rounded so float noise (0.1 * 3) cannot give a retry a different REMOTEID
+        total_amount = round(sum(item["qty"] * item["rate"] for item in data["items"]), 2)
+        return data.get("voucher_guid") or self.build_voucher_guid(
             data["party_ledger"], data["purchase_ledger"], total_amount, data["voucher_type"], data["date"]
         )
 
+    def _identifiers(self, data: dict):
+        # Only the REMOTEID: ledger and item names are shared by other vouchers in the batch
+        return [self._remote_id(data)]
+
+    # ---------- XML Builder ----------
+    def build_voucher_element(self, data: dict, action="Create"):
+        voucher_guid = self._remote_id(data)
+
         narration = data.get("narration") or f"Purchase from {data['party_ledger']}"
 
         # Build inventory entries XML
@@ -80,6 +94,21 @@ class TallyInventoryVoucherManager:
             </ALLINVENTORYENTRIES.LIST>
             """
 
+        return f"""
+                    <VOUCHER REMOTEID="{voucher_guid}" 
+                             VCHTYPE="{data['voucher_type']}" 
+                             ACTION="{action.capitalize()}" 
+                             OBJVIEW="Inventory Voucher View">
+                        <DATE>{data['date']}</DATE>
+                        <EFFECTIVEDATE>{data['date']}</EFFECTIVEDATE>
+                        <VOUCHERTYPENAME>{data['voucher_type']}</VOUCHERTYPENAME>
+                        <PARTYLEDGERNAME>{data['party_ledger']}</PARTYLEDGERNAME>
+                        <NARRATION>{narration}</NARRATION>
+                        
+                        {inventory_xml}
+                    </VOUCHER>"""
+
+    def build_envelope(self, company_name, vouchers_xml):
         # Complete XML
         xml = f"""
 <ENVELOPE>
@@ -91,23 +120,11 @@ class TallyInventoryVoucherManager:
             <REQUESTDESC>
                 <REPORTNAME>Vouchers</REPORTNAME>
                 <STATICVARIABLES>
-                    <SVCURRENTCOMPANY>{data['company_name']}</SVCURRENTCOMPANY>
+                    <SVCURRENTCOMPANY>{company_name}</SVCURRENTCOMPANY>
                 </STATICVARIABLES>
             </REQUESTDESC>
             <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <VOUCHER REMOTEID="{voucher_guid}" 
-                             VCHTYPE="{data['voucher_type']}" 
-                             ACTION="{action.capitalize()}" 
-                             OBJVIEW="Inventory Voucher View">
-                        <DATE>{data['date']}</DATE>
-                        <EFFECTIVEDATE>{data['date']}</EFFECTIVEDATE>
-                        <VOUCHERTYPENAME>{data['voucher_type']}</VOUCHERTYPENAME>
-                        <PARTYLEDGERNAME>{data['party_ledger']}</PARTYLEDGERNAME>
-                        <NARRATION>{narration}</NARRATION>
-                        
-                        {inventory_xml}
-                    </VOUCHER>
+                <TALLYMESSAGE xmlns:UDF="TallyUDF">{vouchers_xml}
                 </TALLYMESSAGE>
             </REQUESTDATA>
         </IMPORTDATA>
@@ -116,15 +133,26 @@ class TallyInventoryVoucherManager:
 """
         return xml.strip()
 
+    @observe_build
+    def build_xml(self, data: dict, action="Create"):
+        return self.build_envelope(data["company_name"], self.build_voucher_element(data, action=action))
+
+    @observe_build
+    def build_bulk_xml(self, company_name, vouchers: list[dict], action="Create"):
+        return self.build_envelope(company_name, "".join(self.build_voucher_element(v, action=action) for v in vouchers))
+
     # ---------- Post to Tally ----------
-    def post_to_tally(self, xml_string):
-        headers = {"Content-Type": "application/xml"}
+    def post_to_tally(self, xml_string, company_name=None, items=1):
         try:
-            response = requests.post(
-                self.tally_url,
-                data=xml_string.encode("utf-8"),
-                headers=headers,
-                timeout=10
+            response = self.client.post(xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items)
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    async def post_to_tally_async(self, xml_string, company_name=None, items=1):
+        try:
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items
             )
             return {"status": response.status_code, "response": response.text}
         except requests.exceptions.RequestException as e:
@@ -134,7 +162,12 @@ class TallyInventoryVoucherManager:
     def save_voucher(self, data: dict, action="Create"):
         self.validate_input(data)
         xml_payload = self.build_xml(data, action=action)
-        return self.post_to_tally(xml_payload)
+        return self.post_to_tally(xml_payload, data["company_name"])
+
+    async def save_voucher_async(self, data: dict, action="Create"):
+        self.validate_input(data)
+        xml_payload = self.build_xml(data, action=action)
+        return await self.post_to_tally_async(xml_payload, data["company_name"])
 
 
 # ---------- Example Usage ----------
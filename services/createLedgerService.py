@@ -1,15 +1,21 @@
 import requests
 import re
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import MASTER_IMPORT
+from services.metrics import observe_build
+from services.tracing import traced
 
 class TallyLedgerManager:
     def __init__(self, tally_url="http://localhost:9000"):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
         self.required_fields = ["ledger_name", "group_name", "company_name"]
         self.all_fields = [
             "ledger_name", "group_name", "company_name", "mailing_name", "address_list",
             "pincode", "state", "country", "email", "phone", "opening_balance"
         ]
 
+    @traced()
     def validate_input(self, data: dict):
         for field in self.required_fields:
             if field not in data or not data[field]:
@@ -28,7 +34,8 @@ class TallyLedgerManager:
                 raise ValueError("Opening balance must be a number")
         return True
 
-    def build_xml(self, data: dict, action="CREATE"):
+    def build_ledger_element(self, data: dict, action="CREATE"):
+        """Build the <LEDGER> element for one ledger master."""
         mailing_details_xml = ""
         if data.get("mailing_name"):
             mailing_details_xml += f"""
@@ -54,6 +61,18 @@ class TallyLedgerManager:
         if data.get("opening_balance"):
             mailing_details_xml += f"<OPENINGBALANCE>{data['opening_balance']}</OPENINGBALANCE>\n"
 
+        return f"""
+                    <LEDGER NAME="{data['ledger_name']}" ACTION="{action}">
+                        <NAME>{data['ledger_name']}</NAME>
+                        <PARENT>{data['group_name']}</PARENT>
+                        <ISBILLWISEON>No</ISBILLWISEON>
+                        <AFFECTSSTOCK>No</AFFECTSSTOCK>
+                        <ISDEEMEDPOSITIVE>No</ISDEEMEDPOSITIVE>
+                        {mailing_details_xml}
+                    </LEDGER>"""
+
+    def build_envelope(self, company_name, masters_xml):
+        """Wrap one or more master elements in an All Masters import envelope."""
         xml = f"""
 <ENVELOPE>
     <HEADER>
@@ -64,19 +83,11 @@ class TallyLedgerManager:
             <REQUESTDESC>
                 <REPORTNAME>All Masters</REPORTNAME>
                 <STATICVARIABLES>
-                    <SVCURRENTCOMPANY>{data.get("company_name", "")}</SVCURRENTCOMPANY>
+                    <SVCURRENTCOMPANY>{company_name}</SVCURRENTCOMPANY>
                 </STATICVARIABLES>
             </REQUESTDESC>
             <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <LEDGER NAME="{data['ledger_name']}" ACTION="{action}">
-                        <NAME>{data['ledger_name']}</NAME>
-                        <PARENT>{data['group_name']}</PARENT>
-                        <ISBILLWISEON>No</ISBILLWISEON>
-                        <AFFECTSSTOCK>No</AFFECTSSTOCK>
-                        <ISDEEMEDPOSITIVE>No</ISDEEMEDPOSITIVE>
-                        {mailing_details_xml}
-                    </LEDGER>
+                <TALLYMESSAGE xmlns:UDF="TallyUDF">{masters_xml}
                 </TALLYMESSAGE>
             </REQUESTDATA>
         </IMPORTDATA>
@@ -85,10 +96,22 @@ class TallyLedgerManager:
 """
         return xml.strip()
 
-    def post_to_tally(self, xml_string):
-        headers = {"Content-Type": "application/xml"}
+    @observe_build
+    def build_xml(self, data: dict, action="CREATE"):
+        return self.build_envelope(data.get("company_name", ""), self.build_ledger_element(data, action=action))
+
+    def post_to_tally(self, xml_string, company_name=None):
         try:
-            response = requests.post(self.tally_url, data=xml_string.encode("utf-8"), headers=headers, timeout=10)
+            response = self.client.post(xml_string, operation=MASTER_IMPORT, company_name=company_name)
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    async def post_to_tally_async(self, xml_string, company_name=None):
+        try:
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=MASTER_IMPORT, company_name=company_name
+            )
             return {"status": response.status_code, "response": response.text}
         except requests.exceptions.RequestException as e:
             return {"error": str(e)}
@@ -96,4 +119,9 @@ class TallyLedgerManager:
     def save_ledger(self, data: dict, action="CREATE"):
         self.validate_input(data)
         xml_payload = self.build_xml(data, action=action)
-        return self.post_to_tally(xml_payload)
+        return self.post_to_tally(xml_payload, data["company_name"])
+
+    async def save_ledger_async(self, data: dict, action="CREATE"):
+        self.validate_input(data)
+        xml_payload = self.build_xml(data, action=action)
+        return await self.post_to_tally_async(xml_payload, data["company_name"])
@@ -1,15 +1,25 @@
 import requests
 import re
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import VOUCHER_IMPORT
+from services.bulkImport import (
+    TALLY_BULK_CHUNK_SIZE, chunked, map_import_results, parse_import_response, summarize_results
+)
+from services.voucherIndex import details_from_voucher_data, get_voucher_index
+from services.metrics import observe_build
+from services.tracing import traced
 
 class TallyVoucherManager:
     def __init__(self, tally_url="http://localhost:9000"):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
         self.required_fields = [
             "company_name", "from_ledger", "to_ledger",
             "amount", "voucher_type", "date"
         ]
         self.all_fields = self.required_fields + ["narration", "voucher_guid"]
 
+    @traced()
     def validate_input(self, data: dict):
         for field in self.required_fields:
             if field not in data or not data[field]:
@@ -28,7 +38,8 @@ class TallyVoucherManager:
     def build_voucher_guid(self, from_ledger, to_ledger, amount, voucher_type, date):
         return f"{from_ledger}_{to_ledger}_{amount}_{voucher_type}_{date}"
 
-    def build_xml(self, data: dict, action="Create"):
+    def build_voucher_element(self, data: dict, action="Create"):
+        """Build the <VOUCHER> element for one accounting voucher."""
         voucher_guid = data.get("voucher_guid") or self.build_voucher_guid(
             data["from_ledger"], data["to_ledger"],
             data["amount"], data["voucher_type"], data["date"]
@@ -36,21 +47,7 @@ class TallyVoucherManager:
 
         narration = data.get("narration") or f"Transfer from {data['from_ledger']} to {data['to_ledger']}"
 
-        xml = f"""
-<ENVELOPE>
-    <HEADER>
-        <TALLYREQUEST>Import Data</TALLYREQUEST>
-    </HEADER>
-    <BODY>
-        <IMPORTDATA>
-            <REQUESTDESC>
-                <REPORTNAME>Vouchers</REPORTNAME>
-                <STATICVARIABLES>
-                    <SVCURRENTCOMPANY>{data['company_name']}</SVCURRENTCOMPANY>
-                </STATICVARIABLES> 
-            </REQUESTDESC>
-            <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
+        return f"""
                     <VOUCHER REMOTEID="{voucher_guid}" 
                              VCHTYPE="{data['voucher_type']}" ACTION="{action.capitalize()}"
                              OBJVIEW="Accounting Voucher View">
@@ -72,7 +69,25 @@ class TallyVoucherManager:
                             <ISDEEMEDPOSITIVE>No</ISDEEMEDPOSITIVE>
                             <AMOUNT>{data['amount']}</AMOUNT>
                         </ALLLEDGERENTRIES.LIST>
-                    </VOUCHER>
+                    </VOUCHER>"""
+
+    def build_envelope(self, company_name, vouchers_xml):
+        """Wrap one or more <VOUCHER> elements in a Vouchers import envelope."""
+        xml = f"""
+<ENVELOPE>
+    <HEADER>
+        <TALLYREQUEST>Import Data</TALLYREQUEST>
+    </HEADER>
+    <BODY>
+        <IMPORTDATA>
+            <REQUESTDESC>
+                <REPORTNAME>Vouchers</REPORTNAME>
+                <STATICVARIABLES>
+                    <SVCURRENTCOMPANY>{company_name}</SVCURRENTCOMPANY>
+                </STATICVARIABLES> 
+            </REQUESTDESC>
+            <REQUESTDATA>
+                <TALLYMESSAGE xmlns:UDF="TallyUDF">{vouchers_xml}
                 </TALLYMESSAGE>
             </REQUESTDATA>
         </IMPORTDATA>
@@ -81,20 +96,111 @@ class TallyVoucherManager:
 """
         return xml.strip()
 
-    def post_to_tally(self, xml_string):
-        headers = {"Content-Type": "application/xml"}
+    @observe_build
+    def build_xml(self, data: dict, action="Create"):
+        return self.build_envelope(data["company_name"], self.build_voucher_element(data, action=action))
+
+    @observe_build
+    def build_bulk_xml(self, company_name, vouchers: list[dict], action="Create"):
+        """Pack many vouchers as sibling <VOUCHER> elements of one TALLYMESSAGE."""
+        vouchers_xml = "".join(self.build_voucher_element(v, action=action) for v in vouchers)
+        return self.build_envelope(company_name, vouchers_xml)
+
+    def post_to_tally(self, xml_string, company_name=None, items=1):
+        try:
+            response = self.client.post(xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items)
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    async def post_to_tally_async(self, xml_string, company_name=None, items=1):
         try:
-            response = requests.post(
-                self.tally_url,
-                data=xml_string.encode("utf-8"),
-                headers=headers,
-                timeout=10
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items
             )
             return {"status": response.status_code, "response": response.text}
         except requests.exceptions.RequestException as e:
             return {"error": str(e)}
 
+    def _remote_id(self, data: dict):
+        return data.get("voucher_guid") or self.build_voucher_guid(
+            data["from_ledger"], data["to_ledger"], data["amount"], data["voucher_type"], data["date"]
+        )
+
+    def _identifiers(self, data: dict):
+        # Only the REMOTEID: ledger names are shared by other vouchers in the batch
+        return [self._remote_id(data)]
+
+    def _track(self, data: dict, response):
+        """Record a voucher Tally accepted in the company's voucher index."""
+        if response.get("status") != 200:
+            return
+        summary = parse_import_response(response.get("response", ""))
+        if summary["created"] or summary["altered"]:
+            remote_id = self._remote_id(data)
+            get_voucher_index(self.tally_url, data["company_name"]).add(
+                details_from_voucher_data(data["company_name"], remote_id, data)
+            )
+
     def save_voucher(self, data: dict, action="Create"):
         self.validate_input(data)
         xml_payload = self.build_xml(data, action=action)
-        return self.post_to_tally(xml_payload)
\ No newline at end of file
+        response = self.post_to_tally(xml_payload, data["company_name"])
+        self._track(data, response)
+        return response
+
+    async def save_voucher_async(self, data: dict, action="Create"):
+        self.validate_input(data)
+        xml_payload = self.build_xml(data, action=action)
+        response = await self.post_to_tally_async(xml_payload, data["company_name"])
+        self._track(data, response)
+        return response
+
+    def _prepare_bulk(self, company_name, vouchers: list[dict]):
+        """Validate every voucher; return (valid batch entries, invalid item results)."""
+        prepared, invalid = [], []
+        for index, voucher in enumerate(vouchers):
+            data = {**voucher, "company_name": company_name}
+            try:
+                self.validate_input(data)
+            except ValueError as e:
+                invalid.append({"index": index, "remote_id": data.get("voucher_guid"), "status": "invalid", "error": str(e)})
+                continue
+            remote_id = self._remote_id(data)
+            prepared.append({
+                "index": index,
+                "remote_id": remote_id,
+                "identifiers": self._identifiers(data),
+                "data": data,
+            })
+        return prepared, invalid
+
+    def _track_bulk(self, company_name, batch, outcomes):
+        index = get_voucher_index(self.tally_url, company_name)
+        by_index = {entry["index"]: entry for entry in batch}
+        for outcome in outcomes:
+            if outcome["status"] in ("created", "altered", "combined"):
+                entry = by_index[outcome["index"]]
+                index.add(details_from_voucher_data(company_name, entry["remote_id"], entry["data"]))
+        return outcomes
+
+    def save_vouchers_bulk(self, company_name, vouchers: list[dict], action="Create", chunk_size=TALLY_BULK_CHUNK_SIZE):
+        """
+        Import many vouchers with one request per chunk instead of one per voucher.
+        Returns per-item outcomes in input order.
+        """
+        prepared, results = self._prepare_bulk(company_name, vouchers)
+        for batch in chunked(prepared, chunk_size):
+            xml_payload = self.build_bulk_xml(company_name, [entry["data"] for entry in batch], action=action)
+            response = self.post_to_tally(xml_payload, company_name, len(batch))
+            results.extend(self._track_bulk(company_name, batch, map_import_results(batch, response)))
+        return summarize_results(results)
+
+    async def save_vouchers_bulk_async(self, company_name, vouchers: list[dict], action="Create",
+                                       chunk_size=TALLY_BULK_CHUNK_SIZE):
+        prepared, results = self._prepare_bulk(company_name, vouchers)
+        for batch in chunked(prepared, chunk_size):
+            xml_payload = self.build_bulk_xml(company_name, [entry["data"] for entry in batch], action=action)
+            response = await self.post_to_tally_async(xml_payload, company_name, len(batch))
+            results.extend(self._track_bulk(company_name, batch, map_import_results(batch, response)))
+        return summarize_results(results)
@@ -1,13 +1,19 @@
 import requests
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import MASTER_IMPORT
+from services.metrics import observe_build
+from services.tracing import traced
 
 class TallyGroupService:
     def __init__(self, tally_url="http://localhost:9000"):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
         self.required_fields_create = ["company_name", "group_name", "parent_group"]
         self.required_fields_delete = ["company_name", "group_name"]
         self.all_fields_create = ["company_name", "group_name", "parent_group", "nature_of_group"]
         self.all_fields_delete = ["company_name", "group_name"]
 
+    @traced()
     def validate_input(self, data: dict, required_fields: list, all_fields: list):
         """
         Validate required and allowed fields
@@ -22,38 +28,30 @@ class TallyGroupService:
 
         return True
 
-    def build_xml(self, data: dict, action="CREATE"):
+    def build_group_element(self, data: dict, action="CREATE"):
         """
-        Build XML payload for CREATE, DELETE or ALTER
+        Build the <GROUP> element for CREATE, DELETE or ALTER
         """
         if action.upper() == "DELETE":
-            xml = f"""
-<ENVELOPE>
-    <HEADER>
-        <TALLYREQUEST>Import Data</TALLYREQUEST>
-    </HEADER>
-    <BODY>
-        <IMPORTDATA>
-            <REQUESTDESC>
-                <REPORTNAME>All Masters</REPORTNAME>
-                <STATICVARIABLES>
-                    <SVCURRENTCOMPANY>{data['company_name']}</SVCURRENTCOMPANY>
-                </STATICVARIABLES>
-            </REQUESTDESC>
-            <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
+            return f"""
                     <GROUP NAME="{data['group_name']}" ACTION="Delete">
                         <NAME>{data['group_name']}</NAME>
-                    </GROUP>
-                </TALLYMESSAGE>
-            </REQUESTDATA>
-        </IMPORTDATA>
-    </BODY>
-</ENVELOPE>
-"""
-        else:  # CREATE or ALTER
-            nature_of_group = data.get("nature_of_group", "Assets")
-            xml = f"""
+                    </GROUP>"""
+
+        # CREATE or ALTER
+        nature_of_group = data.get("nature_of_group") or "Assets"
+        return f"""
+                    <GROUP NAME="{data['group_name']}" ACTION="{action}">
+                        <NAME>{data['group_name']}</NAME>
+                        <PARENT>{data['parent_group']}</PARENT>
+                        <NATUREOFGROUP>{nature_of_group}</NATUREOFGROUP>
+                    </GROUP>"""
+
+    def build_envelope(self, company_name, groups_xml):
+        """
+        Wrap one or more <GROUP> elements in an All Masters import envelope
+        """
+        xml = f"""
 <ENVELOPE>
     <HEADER>
         <TALLYREQUEST>Import Data</TALLYREQUEST>
@@ -63,16 +61,11 @@ class TallyGroupService:
             <REQUESTDESC>
                 <REPORTNAME>All Masters</REPORTNAME>
                 <STATICVARIABLES>
-                    <SVCURRENTCOMPANY>{data['company_name']}</SVCURRENTCOMPANY>
+                    <SVCURRENTCOMPANY>{company_name}</SVCURRENTCOMPANY>
                 </STATICVARIABLES>
             </REQUESTDESC>
             <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <GROUP NAME="{data['group_name']}" ACTION="{action}">
-                        <NAME>{data['group_name']}</NAME>
-                        <PARENT>{data['parent_group']}</PARENT>
-                        <NATUREOFGROUP>{nature_of_group}</NATUREOFGROUP>
-                    </GROUP>
+                <TALLYMESSAGE xmlns:UDF="TallyUDF">{groups_xml}
                 </TALLYMESSAGE>
             </REQUESTDATA>
         </IMPORTDATA>
@@ -81,14 +74,24 @@ class TallyGroupService:
 """
         return xml.strip()
 
-    def post_to_tally(self, xml_string):
-        headers = {"Content-Type": "application/xml"}
+    @observe_build
+    def build_xml(self, data: dict, action="CREATE"):
+        """
+        Build XML payload for CREATE, DELETE or ALTER
+        """
+        return self.build_envelope(data["company_name"], self.build_group_element(data, action=action))
+
+    def post_to_tally(self, xml_string, company_name=None):
+        try:
+            response = self.client.post(xml_string, operation=MASTER_IMPORT, company_name=company_name)
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    async def post_to_tally_async(self, xml_string, company_name=None):
         try:
-            response = requests.post(
-                self.tally_url,
-                data=xml_string.encode("utf-8"),
-                headers=headers,
-                timeout=10
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=MASTER_IMPORT, company_name=company_name
             )
             return {"status": response.status_code, "response": response.text}
         except requests.exceptions.RequestException as e:
@@ -100,7 +103,15 @@ class TallyGroupService:
         """
         self.validate_input(data, self.required_fields_create, self.all_fields_create)
         xml_payload = self.build_xml(data, action=action)
-        return self.post_to_tally(xml_payload)
+        return self.post_to_tally(xml_payload, data["company_name"])
+
+    async def create_group_async(self, data: dict, action="CREATE"):
+        """
+        Create a Group without blocking the event loop
+        """
+        self.validate_input(data, self.required_fields_create, self.all_fields_create)
+        xml_payload = self.build_xml(data, action=action)
+        return await self.post_to_tally_async(xml_payload, data["company_name"])
 
     def delete_group(self, data: dict):
         """
@@ -108,4 +119,12 @@ class TallyGroupService:
         """
         self.validate_input(data, self.required_fields_delete, self.all_fields_delete)
         xml_payload = self.build_xml(data, action="DELETE")
-        return self.post_to_tally(xml_payload)
+        return self.post_to_tally(xml_payload, data["company_name"])
+
+    async def delete_group_async(self, data: dict):
+        """
+        Delete a Group without blocking the event loop
+        """
+        self.validate_input(data, self.required_fields_delete, self.all_fields_delete)
+        xml_payload = self.build_xml(data, action="DELETE")
+        return await self.post_to_tally_async(xml_payload, data["company_name"])
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from services.singleFlight import SingleFlight
+
+# How long a create response is replayed for a repeated Idempotency-Key, and how many are kept
+TALLY_IDEMPOTENCY_TTL = float(os.getenv("TALLY_IDEMPOTENCY_TTL", "86400"))
+TALLY_IDEMPOTENCY_SIZE = int(os.getenv("TALLY_IDEMPOTENCY_SIZE", "10000"))
+
+
+class IdempotencyConflict(ValueError):
+    """Raised when an Idempotency-Key is reused with a different request body."""
+
+
+def fingerprint(payload) -> str:
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def is_transport_failure(response) -> bool:
+    """
+    True for a create response that carries a service-level {"error": ...},
+    at the top or under "data": Tally was never reached or never answered, so
+    a retry must go to Tally again rather than be replayed.
+    """
+    if not isinstance(response, dict):
+        return False
+    data = response.get("data")
+    return "error" in response or (isinstance(data, dict) and "error" in data)
+
+
+class IdempotencyStore:
+    """
+    Remembers the response to each (scope, Idempotency-Key) so a client retry
+    is answered locally instead of being imported into Tally again.
+
+    Entries expire after ttl seconds and the oldest are evicted beyond
+    max_entries. A retry that arrives while the first attempt is still
+    running waits for it and gets the same response. Only completed
+    responses are stored; an attempt that raised or returned a transport
+    error can be retried for real.
+    """
+
+    def __init__(self, ttl: float = TALLY_IDEMPOTENCY_TTL, max_entries: int = TALLY_IDEMPOTENCY_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[tuple, tuple] = OrderedDict()  # key -> (expires_at, fingerprint, response)
+        self.flights = SingleFlight()
+        self.replays = 0
+        self.conflicts = 0
+
+    def get(self, key, request_fingerprint):
+        """Return (hit, response) for key; raise IdempotencyConflict if it was used for another request."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, stored_fingerprint, response = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return False, None
+            if stored_fingerprint != request_fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflict("Idempotency-Key was already used with a different request")
+            self.replays += 1
+            return True, response
+
+    def put(self, key, request_fingerprint, response):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, request_fingerprint, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    async def run_async(self, scope: str, idempotency_key, payload, fn):
+        """
+        Return (replayed, response). fn() returns an awaitable and runs only
+        for the first request with this key; without a key it always runs.
+        """
+        if not idempotency_key:
+            return False, await fn()
+        key = (scope, idempotency_key)
+        request_fingerprint = fingerprint(payload)
+        hit, response = self.get(key, request_fingerprint)
+        if hit:
+            return True, response
+
+        led, executed = [], []
+
+        async def first():
+            led.append(True)
+            hit, response = self.get(key, request_fingerprint)
+            if hit:
+                return response
+            executed.append(True)
+            response = await fn()
+            if not is_transport_failure(response):
+                self.put(key, request_fingerprint, response)
+            return response
+
+        response = await self.flights.do_async(key + (request_fingerprint,), first)
+        if not led:
+            # Waited on a concurrent first attempt
+            with self.lock:
+                self.replays += 1
+        return not executed, response
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_entries": self.max_entries, "ttl": self.ttl,
+                    "replays": self.replays, "conflicts": self.conflicts}
+
+
+idempotency_store = IdempotencyStore()
+
+
+async def run_idempotent(response, scope: str, idempotency_key, payload, fn):
+    """Route helper: run fn through idempotency_store and mark replays with an Idempotent-Replayed header."""
+    replayed, result = await idempotency_store.run_async(scope, idempotency_key, payload, fn)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
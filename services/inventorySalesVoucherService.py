@@ -1,15 +1,21 @@
 import requests
 import re
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import VOUCHER_IMPORT
+from services.metrics import observe_build
+from services.tracing import traced
 
 class TallySalesVoucherManager:
     def __init__(self, tally_url="http://localhost:9000"):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
         self.required_fields = [
             "company_name", "customer_ledger", "sales_ledger",
             "items", "date"
         ]
         self.all_fields = self.required_fields + ["narration", "voucher_guid"]
 
+    @traced()
     def validate_input(self, data: dict):
         """Validate required input fields for sales voucher."""
         for field in self.required_fields:
@@ -37,15 +43,22 @@ class TallySalesVoucherManager:
     def build_voucher_guid(self, customer_ledger, sales_ledger, total_amount, date):
         return f"{customer_ledger}_{sales_ledger}_{total_amount}_Sales_{date}"
 
-    def build_xml(self, data: dict, action="Create"):
-        """Build XML request for Sales Voucher with inventory."""
-        # Calculate total amount
-        total_amount = sum(item["qty"] * item["rate"] for item in data["items"])
-
-        voucher_guid = data.get("voucher_guid") or self.build_voucher_guid(
+    def _remote_id(self, data: dict):
+        # Rounded so float noise (0.1 * 3) cannot give a retry a different REMOTEID
+        total_amount = round(sum(item["qty"] * item["rate"] for item in data["items"]), 2)
+        return data.get("voucher_guid") or self.build_voucher_guid(
             data["customer_ledger"], data["sales_ledger"], total_amount, data["date"]
         )
 
+    def _identifiers(self, data: dict):
+        """Names a LINEERROR may mention for this voucher, used to attribute batch errors."""
+        # Only the REMOTEID: ledger and item names are shared by other vouchers in the batch
+        return [self._remote_id(data)]
+
+    def build_voucher_element(self, data: dict, action="Create"):
+        """Build the <VOUCHER> element for one Sales voucher with inventory."""
+        voucher_guid = self._remote_id(data)
+
         narration = data.get("narration") or f"Sales to {data['customer_ledger']}"
 
         # Build inventory XML
@@ -76,7 +89,19 @@ class TallySalesVoucherManager:
             </ALLINVENTORYENTRIES.LIST>
             """
 
-        # Complete XML envelope
+        return f"""
+                    <VOUCHER REMOTEID="{voucher_guid}" VCHTYPE="Sales"
+                             ACTION="{action.capitalize()}" OBJVIEW="Inventory Voucher View">
+                        <DATE>{data['date']}</DATE>
+                        <EFFECTIVEDATE>{data['date']}</EFFECTIVEDATE>
+                        <VOUCHERTYPENAME>Sales</VOUCHERTYPENAME>
+                        <NARRATION>{narration}</NARRATION>
+                        <PARTYLEDGERNAME>{data['customer_ledger']}</PARTYLEDGERNAME>
+                        {inventory_xml}
+                    </VOUCHER>"""
+
+    def build_envelope(self, company_name, vouchers_xml):
+        """Complete XML envelope around one or more <VOUCHER> elements."""
         xml = f"""
 <ENVELOPE>
     <HEADER>
@@ -87,20 +112,11 @@ class TallySalesVoucherManager:
             <REQUESTDESC>
                 <REPORTNAME>Vouchers</REPORTNAME>
                 <STATICVARIABLES>
-                    <SVCURRENTCOMPANY>{data['company_name']}</SVCURRENTCOMPANY>
+                    <SVCURRENTCOMPANY>{company_name}</SVCURRENTCOMPANY>
                 </STATICVARIABLES>
             </REQUESTDESC>
             <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <VOUCHER REMOTEID="{voucher_guid}" VCHTYPE="Sales"
-                             ACTION="{action.capitalize()}" OBJVIEW="Inventory Voucher View">
-                        <DATE>{data['date']}</DATE>
-                        <EFFECTIVEDATE>{data['date']}</EFFECTIVEDATE>
-                        <VOUCHERTYPENAME>Sales</VOUCHERTYPENAME>
-                        <NARRATION>{narration}</NARRATION>
-                        <PARTYLEDGERNAME>{data['customer_ledger']}</PARTYLEDGERNAME>
-                        {inventory_xml}
-                    </VOUCHER>
+                <TALLYMESSAGE xmlns:UDF="TallyUDF">{vouchers_xml}
                 </TALLYMESSAGE>
             </REQUESTDATA>
         </IMPORTDATA>
@@ -109,14 +125,26 @@ class TallySalesVoucherManager:
 """
         return xml.strip()
 
-    def post_to_tally(self, xml_string):
-        headers = {"Content-Type": "application/xml"}
+    @observe_build
+    def build_xml(self, data: dict, action="Create"):
+        """Build XML request for Sales Voucher with inventory."""
+        return self.build_envelope(data["company_name"], self.build_voucher_element(data, action=action))
+
+    @observe_build
+    def build_bulk_xml(self, company_name, vouchers: list[dict], action="Create"):
+        return self.build_envelope(company_name, "".join(self.build_voucher_element(v, action=action) for v in vouchers))
+
+    def post_to_tally(self, xml_string, company_name=None, items=1):
         try:
-            response = requests.post(
-                self.tally_url,
-                data=xml_string.encode("utf-8"),
-                headers=headers,
-                timeout=10
+            response = self.client.post(xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items)
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    async def post_to_tally_async(self, xml_string, company_name=None, items=1):
+        try:
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items
             )
             return {"status": response.status_code, "response": response.text}
         except requests.exceptions.RequestException as e:
@@ -125,7 +153,12 @@ class TallySalesVoucherManager:
     def save_voucher(self, data: dict, action="Create"):
         self.validate_input(data)
         xml_payload = self.build_xml(data, action=action)
-        return self.post_to_tally(xml_payload)
+        return self.post_to_tally(xml_payload, data["company_name"])
+
+    async def save_voucher_async(self, data: dict, action="Create"):
+        self.validate_input(data)
+        xml_payload = self.build_xml(data, action=action)
+        return await self.post_to_tally_async(xml_payload, data["company_name"])
 
 
 # if __name__ == "__main__":
@@ -1,12 +1,22 @@
 import requests
 import re
-import xml.etree.ElementTree as ET
+import os
 from datetime import datetime
+from xml.sax.saxutils import escape
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import COLLECTION_EXPORT, MASTER_IMPORT, VOUCHER_IMPORT
+from services.xmlStream import TALLY_STREAM_CHUNK_SIZE, iter_elements, aiter_elements
+from services.bulkImport import TALLY_BULK_CHUNK_SIZE, chunked, map_import_results, summarize_results
+from services.metrics import observe_build
+
+# Above this many names a filtered readback is replaced by one full stock export
+TALLY_FILTER_MAX_NAMES = int(os.getenv("TALLY_FILTER_MAX_NAMES", "200"))
 
 
 class TallyInventoryManagement:
     def __init__(self, tally_url="http://localhost:9000"):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
 
     # ---------- Utilities ----------
     def to_snake_case(self, value: str) -> str:
@@ -20,24 +30,39 @@ class TallyInventoryManagement:
         item_key = self.to_snake_case(item_name)
         return f"{item_key}_{date}"
 
-    def post_to_tally(self, xml_string: str):
+    def post_to_tally(self, xml_string: str, company_name=None, operation=VOUCHER_IMPORT, items=1):
         """Send XML payload to Tally"""
-        headers = {"Content-Type": "application/xml"}
         try:
-            response = requests.post(
-                self.tally_url, data=xml_string.encode("utf-8"), headers=headers, timeout=10
-            )
+            response = self.client.post(xml_string, operation=operation, company_name=company_name, items=items)
             return {"status": response.status_code, "response": response.text}
         except requests.exceptions.RequestException as e:
             return {"error": str(e)}
 
-    def clean_invalid_xml_chars(self, xml_str):
-        """Remove invalid XML control characters like &#4; that Tally sometimes sends."""
-        return re.sub(r"&#\d+;", "", xml_str)
+    async def post_to_tally_async(self, xml_string: str, company_name=None, operation=VOUCHER_IMPORT, items=1):
+        """Send XML payload to Tally over the async transport"""
+        try:
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=operation, company_name=company_name, items=items
+            )
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
 
     # ---------- Stock Item ----------
-    def create_stock_item(self, company_name, item_name, parent_group, unit, opening_balance=0):
-        """Create a stock item in Tally"""
+    def build_stock_item_element(self, item_name, parent_group, unit, opening_balance=0):
+        """Build the <STOCKITEM> element for one stock item"""
+        return f"""
+                            <STOCKITEM NAME="{item_name}" ACTION="Create">
+                                <NAME.LIST>
+                                    <NAME>{item_name}</NAME>
+                                </NAME.LIST>
+                                <PARENT>{parent_group}</PARENT>
+                                <BASEUNITS>{unit}</BASEUNITS>
+                                <OPENINGBALANCE>{opening_balance}</OPENINGBALANCE>
+                            </STOCKITEM>"""
+
+    def build_masters_envelope(self, company_name, masters_xml):
+        """Wrap one or more stock item elements in an All Masters import envelope"""
         xml_request = f"""
         <ENVELOPE>
             <HEADER>
@@ -52,37 +77,43 @@ class TallyInventoryManagement:
                         </STATICVARIABLES>
                     </REQUESTDESC>
                     <REQUESTDATA>
-                        <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                            <STOCKITEM NAME="{item_name}" ACTION="Create">
-                                <NAME.LIST>
-                                    <NAME>{item_name}</NAME>
-                                </NAME.LIST>
-                                <PARENT>{parent_group}</PARENT>
-                                <BASEUNITS>{unit}</BASEUNITS>
-                                <OPENINGBALANCE>{opening_balance}</OPENINGBALANCE>
-                            </STOCKITEM>
+                        <TALLYMESSAGE xmlns:UDF="TallyUDF">{masters_xml}
                         </TALLYMESSAGE>
                     </REQUESTDATA>
                 </IMPORTDATA>
             </BODY>
         </ENVELOPE>
         """
-        result = self.post_to_tally(xml_request.strip())
+        return xml_request.strip()
+
+    @observe_build
+    def build_stock_item_xml(self, company_name, item_name, parent_group, unit, opening_balance=0):
+        """Build the import envelope for a single stock item"""
+        return self.build_masters_envelope(
+            company_name, self.build_stock_item_element(item_name, parent_group, unit, opening_balance)
+        )
 
-        # Fetch updated stock for this item
-        stock_items = self.fetch_all_stock_items(company_name)
-        latest_qty = next((i["closing_balance"] for i in stock_items if i["name"] == item_name), None)
+    def create_stock_item(self, company_name, item_name, parent_group, unit, opening_balance=0, readback=True):
+        """Create a stock item in Tally; readback=False skips the closing balance lookup"""
+        xml_request = self.build_stock_item_xml(company_name, item_name, parent_group, unit, opening_balance)
+        result = self.post_to_tally(xml_request, company_name, operation=MASTER_IMPORT)
 
+        latest_qty = self.fetch_closing_balance(company_name, item_name) if readback else None
         return {"tally_response": result, "closing_balance": latest_qty}
 
-    # ---------- Stock Journal ----------
-    def create_stock_journal(
-        self, company_name, narration, item_name, qty, unit, godown="Main Location", date=None
-    ):
-        """Create a stock journal entry in Tally with auto-generated GUID"""
-        if not date:
-            date = datetime.now().strftime("%Y%m%d")
+    async def create_stock_item_async(self, company_name, item_name, parent_group, unit, opening_balance=0,
+                                      readback=True):
+        """Create a stock item in Tally without blocking the event loop"""
+        xml_request = self.build_stock_item_xml(company_name, item_name, parent_group, unit, opening_balance)
+        result = await self.post_to_tally_async(xml_request, company_name, operation=MASTER_IMPORT)
+
+        latest_qty = await self.fetch_closing_balance_async(company_name, item_name) if readback else None
+        return {"tally_response": result, "closing_balance": latest_qty}
 
+    # ---------- Stock Journal ----------
+    @observe_build
+    def build_stock_journal_xml(self, company_name, narration, item_name, qty, unit, godown, date):
+        """Build the import envelope for a stock journal with auto-generated GUID"""
         voucher_guid = self.generate_guid(item_name, date)
 
         xml_request = f"""
@@ -127,18 +158,50 @@ class TallyInventoryManagement:
             </BODY>
         </ENVELOPE>
         """
-        result = self.post_to_tally(xml_request.strip())
+        return xml_request.strip()
+
+    def create_stock_journal(
+        self, company_name, narration, item_name, qty, unit, godown="Main Location", date=None, readback=True
+    ):
+        """Create a stock journal entry in Tally with auto-generated GUID; readback=False skips the balance lookup"""
+        if not date:
+            date = datetime.now().strftime("%Y%m%d")
 
-        # Fetch updated stock for this item
-        stock_items = self.fetch_all_stock_items(company_name)
-        latest_qty = next((i["closing_balance"] for i in stock_items if i["name"] == item_name), None)
+        xml_request = self.build_stock_journal_xml(company_name, narration, item_name, qty, unit, godown, date)
+        result = self.post_to_tally(xml_request, company_name)
 
+        latest_qty = self.fetch_closing_balance(company_name, item_name) if readback else None
+        return {"tally_response": result, "closing_balance": latest_qty}
+
+    async def create_stock_journal_async(
+        self, company_name, narration, item_name, qty, unit, godown="Main Location", date=None, readback=True
+    ):
+        """Create a stock journal entry in Tally without blocking the event loop"""
+        if not date:
+            date = datetime.now().strftime("%Y%m%d")
+
+        xml_request = self.build_stock_journal_xml(company_name, narration, item_name, qty, unit, godown, date)
+        result = await self.post_to_tally_async(xml_request, company_name)
+
+        latest_qty = await self.fetch_closing_balance_async(company_name, item_name) if readback else None
         return {"tally_response": result, "closing_balance": latest_qty}
 
     # ---------- Fetch Stock Items ----------
-    def fetch_all_stock_items(self, company_name):
-        """Fetch all stock items from Tally with closing balance"""
-        xml_request = f"""
+    @observe_build
+    def build_stock_items_xml(self, company_name, item_names=None):
+        """
+        Build the collection export request for stock items.
+        With item_names the collection is filtered inside Tally to just those items.
+        """
+        filters_xml, formula_xml = "", ""
+        if item_names:
+            names = (escape(name).replace('"', "&quot;") for name in item_names)
+            formula = " OR ".join(f'$Name = "{name}"' for name in names)
+            filters_xml = "\n                                <FILTERS>SelectedItems</FILTERS>"
+            formula_xml = f"""
+                            <SYSTEM TYPE="Formulae" NAME="SelectedItems">{formula}</SYSTEM>"""
+
+        return f"""
         <ENVELOPE>
             <HEADER>
                 <VERSION>1</VERSION>
@@ -156,8 +219,8 @@ class TallyInventoryManagement:
                         <TDLMESSAGE>
                             <COLLECTION NAME="StockItems" ISMODIFY="No" ISFIXED="No" ISINITIALIZE="No" ISOPTION="No" ISINTERNAL="No">
                                 <TYPE>Stock Item</TYPE>
-                                <FETCH>Name,Parent,ClosingBalance,BaseUnits</FETCH>
-                            </COLLECTION>
+                                <FETCH>Name,Parent,ClosingBalance,BaseUnits</FETCH>{filters_xml}
+                            </COLLECTION>{formula_xml}
                         </TDLMESSAGE>
                     </TDL>
                 </DESC>
@@ -165,21 +228,125 @@ class TallyInventoryManagement:
         </ENVELOPE>
         """
 
-        response = requests.post(self.tally_url, data=xml_request.encode("utf-8"))
+    def build_stock_item_row(self, item):
+        """Turn one STOCKITEM element into a dict"""
+        return {
+            "name": item.get("NAME"),
+            "parent": item.findtext("PARENT"),
+            "unit": item.findtext("BASEUNITS"),
+            "closing_balance": item.findtext("CLOSINGBALANCE")
+        }
+
+    def _readback_names(self, item_names):
+        """
+        Names to filter on in Tally, or None when a single full export is
+        cheaper - or safer: a TDL string literal cannot hold a double quote.
+        """
+        if item_names is None or len(item_names) > TALLY_FILTER_MAX_NAMES:
+            return None
+        if any('"' in name for name in item_names):
+            return None
+        return item_names
+
+    def fetch_stock_items(self, company_name, item_names=None):
+        """Fetch stock items with closing balance, optionally only the named ones"""
+        names = self._readback_names(item_names)
+        with self.client.stream(
+            self.build_stock_items_xml(company_name, names),
+            operation=COLLECTION_EXPORT, company_name=company_name
+        ) as response:
+            stock_items = []
+            if response.status_code == 200:
+                chunks = response.iter_content(TALLY_STREAM_CHUNK_SIZE)
+                for item in iter_elements(chunks, ["STOCKITEM"], response.encoding or "utf-8", report="stock_items"):
+                    stock_items.append(self.build_stock_item_row(item))
+        if item_names is not None:
+            wanted = set(item_names)
+            stock_items = [i for i in stock_items if i["name"] in wanted]
+        return stock_items
 
-        if response.status_code == 200 and response.text.strip() != "<ENVELOPE></ENVELOPE>":
-            cleaned_xml = self.clean_invalid_xml_chars(response.text)
-            root = ET.fromstring(cleaned_xml)
+    async def fetch_stock_items_async(self, company_name, item_names=None):
+        """Fetch stock items over the async transport, optionally only the named ones"""
+        names = self._readback_names(item_names)
+        async with get_async_tally_client(self.tally_url).stream(
+            self.build_stock_items_xml(company_name, names),
+            operation=COLLECTION_EXPORT, company_name=company_name
+        ) as response:
             stock_items = []
+            if response.status_code == 200:
+                async for item in aiter_elements(response.aiter_bytes(), ["STOCKITEM"], response.encoding, report="stock_items"):
+                    stock_items.append(self.build_stock_item_row(item))
+        if item_names is not None:
+            wanted = set(item_names)
+            stock_items = [i for i in stock_items if i["name"] in wanted]
+        return stock_items
+
+    def fetch_closing_balance(self, company_name, item_name):
+        """Read back one item's closing balance through a collection filtered to that item"""
+        stock_items = self.fetch_stock_items(company_name, [item_name])
+        return stock_items[0]["closing_balance"] if stock_items else None
+
+    async def fetch_closing_balance_async(self, company_name, item_name):
+        stock_items = await self.fetch_stock_items_async(company_name, [item_name])
+        return stock_items[0]["closing_balance"] if stock_items else None
+
+    def fetch_all_stock_items(self, company_name):
+        """Fetch all stock items from Tally with closing balance"""
+        return self.fetch_stock_items(company_name)
+
+    async def fetch_all_stock_items_async(self, company_name):
+        """Fetch all stock items from Tally over the async transport"""
+        return await self.fetch_stock_items_async(company_name)
+
+    # ---------- Bulk Stock Items ----------
+    def _prepare_bulk_items(self, items: list[dict]):
+        prepared, invalid = [], []
+        for index, item in enumerate(items):
+            missing = [f for f in ("item_name", "parent_group", "unit") if not item.get(f)]
+            if missing:
+                invalid.append({"index": index, "name": item.get("item_name"), "status": "invalid",
+                                "error": f"Missing required fields: {', '.join(missing)}"})
+                continue
+            prepared.append({
+                "index": index,
+                "name": item["item_name"],
+                "identifiers": [item["item_name"]],
+                "xml": self.build_stock_item_element(
+                    item["item_name"], item["parent_group"], item["unit"], item.get("opening_balance") or 0
+                ),
+            })
+        return prepared, invalid
+
+    def _merge_readback(self, prepared, results, stock_items):
+        names = {entry["index"]: entry["name"] for entry in prepared}
+        balances = {i["name"]: i["closing_balance"] for i in stock_items}
+        for result in results:
+            result.pop("remote_id", None)
+            if result["index"] in names:
+                result["name"] = names[result["index"]]
+                result["closing_balance"] = balances.get(result["name"])
+        return summarize_results(results)
+
+    def create_stock_items_bulk(self, company_name, items: list[dict], chunk_size=TALLY_BULK_CHUNK_SIZE):
+        """
+        Create many stock items with one All Masters request per chunk, then read
+        back closing balances for just the affected items in a single export.
+        """
+        prepared, results = self._prepare_bulk_items(items)
+        for batch in chunked(prepared, chunk_size):
+            xml_request = self.build_masters_envelope(company_name, "".join(e["xml"] for e in batch))
+            response = self.post_to_tally(xml_request, company_name, operation=MASTER_IMPORT, items=len(batch))
+            results.extend(map_import_results(batch, response))
+
+        stock_items = self.fetch_stock_items(company_name, [e["name"] for e in prepared]) if prepared else []
+        return self._merge_readback(prepared, results, stock_items)
+
+    async def create_stock_items_bulk_async(self, company_name, items: list[dict], chunk_size=TALLY_BULK_CHUNK_SIZE):
+        prepared, results = self._prepare_bulk_items(items)
+        for batch in chunked(prepared, chunk_size):
+            xml_request = self.build_masters_envelope(company_name, "".join(e["xml"] for e in batch))
+            response = await self.post_to_tally_async(xml_request, company_name, operation=MASTER_IMPORT, items=len(batch))
+            results.extend(map_import_results(batch, response))
 
-            for item in root.findall(".//STOCKITEM"):
-                stock_items.append({
-                    "name": item.get("NAME"),
-                    "parent": item.findtext("PARENT"),
-                    "unit": item.findtext("BASEUNITS"),
-                    "closing_balance": item.findtext("CLOSINGBALANCE")
-                })
-
-            return stock_items
-        else:
-            return []
+        stock_items = await self.fetch_stock_items_async(company_name, [e["name"] for e in prepared]) if prepared else []
+        return self._merge_readback(prepared, results, stock_items)
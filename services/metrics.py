@@ -0,0 +1,222 @@
+import functools
+import math
+import threading
+import time
+from contextvars import ContextVar
+from services.tallyScheduler import queue_depths
+from services.circuitBreaker import CLOSED, breaker_states
+from services.tracing import tracer
+
+# API route template of the request being served; "background" for journal and sync work
+current_endpoint: ContextVar[str] = ContextVar("current_endpoint", default="background")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256 B .. 64 MiB
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """One metric family in the Prometheus text format, keyed by label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) for every series."""
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield "", key, (), value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(s["counts"]), s["sum"], s["count"]) for key, s in self.values.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", key, (("le", _format_value(bound)),), cumulative
+            yield "_bucket", key, (("le", "+Inf"),), count
+            yield "_sum", key, (), total
+            yield "_count", key, (), count
+
+
+class CallbackMetric(Metric):
+    """Gauge or counter whose series are read from collect() at scrape time."""
+
+    def __init__(self, name: str, help_text: str, labels, collect, kind="gauge"):
+        super().__init__(name, help_text, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield "", self._key(labels), (), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def callback(self, name, help_text, labels, collect, kind="gauge"):
+        return self.register(CallbackMetric(name, help_text, labels, collect, kind))
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+tally_request_seconds = registry.histogram(
+    "tally_request_duration_seconds", "Time from sending a request to Tally until its response arrived",
+    ("operation", "endpoint", "host"),
+)
+tally_request_bytes = registry.histogram(
+    "tally_request_bytes", "Size of XML envelopes sent to Tally", ("operation", "host"), BYTES_BUCKETS
+)
+tally_response_bytes = registry.histogram(
+    "tally_response_bytes", "Size of responses read from Tally", ("operation", "host"), BYTES_BUCKETS
+)
+tally_errors = registry.counter(
+    "tally_errors_total",
+    "Failed Tally requests by kind: connect, timeout, http_status or line_error",
+    ("kind", "operation", "host"),
+)
+xml_build_seconds = registry.histogram(
+    "tally_xml_build_seconds", "Time spent building request XML", ("builder",),
+    (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+xml_parse_seconds = registry.histogram(
+    "tally_xml_parse_seconds", "CPU time spent parsing a Tally response, excluding network waits", ("report",)
+)
+xml_parse_rows = registry.histogram(
+    "tally_xml_parse_rows", "Rows parsed out of one Tally response", ("report",), ROWS_BUCKETS
+)
+xml_parse_errors = registry.counter(
+    "tally_xml_parse_errors_total", "Tally responses that were not well-formed XML", ("report",)
+)
+
+registry.callback(
+    "tally_in_flight", "Requests currently running against each Tally host", ("host",),
+    lambda: [({"host": s["tally_url"]}, s["in_flight"]) for s in queue_depths()],
+)
+registry.callback(
+    "tally_queued", "Requests waiting for a slot on each Tally host", ("host",),
+    lambda: [({"host": s["tally_url"]}, s["queued"]) for s in queue_depths()],
+)
+registry.callback(
+    "tally_circuit_open", "1 while a host's circuit breaker is not closed", ("host",),
+    lambda: [({"host": s["tally_url"]}, int(s["state"] != CLOSED)) for s in breaker_states()],
+)
+registry.callback(
+    "tally_circuit_rejections_total", "Requests refused without contacting Tally because the circuit was open",
+    ("host",), lambda: [({"host": s["tally_url"]}, s["rejected"]) for s in breaker_states()], kind="counter",
+)
+
+
+def observe_build(func):
+    """
+    Decorator: time an XML builder into tally_xml_build_seconds, labelled
+    Class.method, and trace it as a build_xml span.
+    """
+    builder = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with tracer.span("build_xml", attributes={"xml.builder": builder}):
+                return func(*args, **kwargs)
+        finally:
+            xml_build_seconds.observe(time.perf_counter() - started, builder=builder)
+    return wrapper
+
+
+def render_metrics() -> str:
+    return registry.render()
@@ -0,0 +1,300 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# SQLite file holding the optional local mirror, e.g. "tally_mirror.db". Unset
+# (the default) keeps sync state in memory only and disables max_staleness reads.
+TALLY_MIRROR_PATH = os.getenv("TALLY_MIRROR_PATH", "")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mirror_state (
+    tally_url TEXT, company_name TEXT,
+    master_watermark INTEGER, voucher_watermark INTEGER, last_synced REAL,
+    PRIMARY KEY (tally_url, company_name)
+);
+CREATE TABLE IF NOT EXISTS groups (
+    tally_url TEXT, company_name TEXT, guid TEXT, name TEXT, parent TEXT,
+    is_revenue INTEGER, is_deemed_positive INTEGER, master_id INTEGER, alter_id INTEGER,
+    PRIMARY KEY (tally_url, company_name, guid)
+);
+CREATE TABLE IF NOT EXISTS ledgers (
+    tally_url TEXT, company_name TEXT, guid TEXT, name TEXT, parent TEXT,
+    opening_balance REAL, master_id INTEGER, alter_id INTEGER,
+    PRIMARY KEY (tally_url, company_name, guid)
+);
+CREATE TABLE IF NOT EXISTS stock_items (
+    tally_url TEXT, company_name TEXT, guid TEXT, name TEXT, parent TEXT, unit TEXT,
+    opening_balance TEXT, closing_balance TEXT, master_id INTEGER, alter_id INTEGER,
+    PRIMARY KEY (tally_url, company_name, guid)
+);
+CREATE TABLE IF NOT EXISTS vouchers (
+    tally_url TEXT, company_name TEXT, guid TEXT, remote_id TEXT, date TEXT,
+    voucher_type TEXT, voucher_number TEXT, narration TEXT,
+    is_cancelled INTEGER, is_optional INTEGER, master_id INTEGER, alter_id INTEGER,
+    PRIMARY KEY (tally_url, company_name, guid)
+);
+CREATE TABLE IF NOT EXISTS voucher_entries (
+    tally_url TEXT, company_name TEXT, voucher_guid TEXT, position INTEGER,
+    ledger TEXT, amount REAL,
+    PRIMARY KEY (tally_url, company_name, voucher_guid, position)
+);
+CREATE INDEX IF NOT EXISTS ix_ledgers_name ON ledgers (tally_url, company_name, name);
+CREATE INDEX IF NOT EXISTS ix_vouchers_date ON vouchers (tally_url, company_name, date);
+CREATE INDEX IF NOT EXISTS ix_vouchers_type ON vouchers (tally_url, company_name, voucher_type);
+CREATE INDEX IF NOT EXISTS ix_entries_ledger ON voucher_entries (tally_url, company_name, ledger);
+"""
+
+MASTER_COLUMNS = {
+    "groups": ("guid", "name", "parent", "is_revenue", "is_deemed_positive", "master_id", "alter_id"),
+    "ledgers": ("guid", "name", "parent", "opening_balance", "master_id", "alter_id"),
+    "stock_items": ("guid", "name", "parent", "unit", "opening_balance", "closing_balance", "master_id", "alter_id"),
+}
+VOUCHER_COLUMNS = (
+    "guid", "remote_id", "date", "voucher_type", "voucher_number", "narration",
+    "is_cancelled", "is_optional", "master_id", "alter_id"
+)
+
+_connections: dict[str, tuple[sqlite3.Connection, threading.Lock]] = {}
+_connections_lock = threading.Lock()
+
+
+def get_mirror_connection(path: str = TALLY_MIRROR_PATH):
+    """Return the shared connection and its lock for a mirror database file."""
+    with _connections_lock:
+        entry = _connections.get(path)
+        if entry is None:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            if path != ":memory:":
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            entry = _connections[path] = (conn, threading.Lock())
+        return entry
+
+
+def close_mirror_connections():
+    with _connections_lock:
+        for conn, lock in _connections.values():
+            with lock:
+                conn.close()
+        _connections.clear()
+
+
+def _tally_date(value: str) -> str:
+    """20250401 -> 1-Apr-25, the way Tally's Ledger Vouchers report prints dates."""
+    try:
+        parsed = datetime.strptime(value, "%Y%m%d")
+    except (TypeError, ValueError):
+        return value
+    return f"{parsed.day}-{parsed.strftime('%b-%y')}"
+
+
+class SqliteSyncStore:
+    """
+    Sync store that mirrors one company's masters and vouchers into SQLite.
+    Plugs into TallySyncEngine in place of MemorySyncStore and also answers
+    the read queries the report endpoints need.
+    """
+
+    def __init__(self, tally_url, company_name, path=TALLY_MIRROR_PATH):
+        self.tally_url = tally_url
+        self.company_name = company_name
+        self.conn, self.lock = get_mirror_connection(path)
+        self.key = (tally_url, company_name)
+
+    # ---------- Sync store interface ----------
+    def _state(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM mirror_state WHERE tally_url = ? AND company_name = ?", self.key
+            ).fetchone()
+
+    @property
+    def watermarks(self):
+        state = self._state()
+        if state is None:
+            return {"master": 0, "voucher": 0}
+        return {"master": state["master_watermark"], "voucher": state["voucher_watermark"]}
+
+    @property
+    def last_synced(self):
+        state = self._state()
+        return state["last_synced"] if state is not None else None
+
+    def apply_masters(self, kind, rows, replace=False):
+        columns = MASTER_COLUMNS[kind]
+        placeholders = ", ".join("?" for _ in range(len(columns) + 2))
+        with self.lock, self.conn:
+            if replace:
+                self.conn.execute(f"DELETE FROM {kind} WHERE tally_url = ? AND company_name = ?", self.key)
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {kind} (tally_url, company_name, {', '.join(columns)}) VALUES ({placeholders})",
+                [self.key + tuple(row.get(column) for column in columns) for row in rows]
+            )
+
+    def apply_vouchers(self, rows, replace=False):
+        placeholders = ", ".join("?" for _ in range(len(VOUCHER_COLUMNS) + 2))
+        with self.lock, self.conn:
+            if replace:
+                self.conn.execute("DELETE FROM vouchers WHERE tally_url = ? AND company_name = ?", self.key)
+                self.conn.execute("DELETE FROM voucher_entries WHERE tally_url = ? AND company_name = ?", self.key)
+            else:
+                self.conn.executemany(
+                    "DELETE FROM voucher_entries WHERE tally_url = ? AND company_name = ? AND voucher_guid = ?",
+                    [self.key + (row["guid"],) for row in rows]
+                )
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO vouchers (tally_url, company_name, {', '.join(VOUCHER_COLUMNS)}) "
+                f"VALUES ({placeholders})",
+                [self.key + tuple(row.get(column) for column in VOUCHER_COLUMNS) for row in rows]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO voucher_entries (tally_url, company_name, voucher_guid, position, ledger, amount) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [self.key + (row["guid"], position, entry["ledger"], entry["amount"])
+                 for row in rows for position, entry in enumerate(row.get("entries", []))]
+            )
+
+    def remove_vouchers(self, remote_ids):
+        """Drop vouchers (and their entries) by REMOTEID."""
+        keys = [self.key + (remote_id,) for remote_id in remote_ids]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM voucher_entries WHERE tally_url = ?1 AND company_name = ?2 AND voucher_guid IN ("
+                "SELECT guid FROM vouchers WHERE tally_url = ?1 AND company_name = ?2 AND remote_id = ?3)",
+                keys
+            )
+            self.conn.executemany(
+                "DELETE FROM vouchers WHERE tally_url = ? AND company_name = ? AND remote_id = ?", keys
+            )
+
+    def set_watermarks(self, master, voucher):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO mirror_state VALUES (?, ?, ?, ?, ?)",
+                self.key + (master, voucher, time.time())
+            )
+
+    def counts(self):
+        counts = {}
+        with self.lock:
+            for table in ("groups", "ledgers", "stock_items", "vouchers"):
+                counts[table] = self.conn.execute(
+                    f"SELECT COUNT(*) FROM {table} WHERE tally_url = ? AND company_name = ?", self.key
+                ).fetchone()[0]
+        return counts
+
+    # ---------- Reads ----------
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, self.key + tuple(params)).fetchall()
+
+    def ledger_closing_balances(self, to_date=None):
+        """
+        Closing balance per ledger: opening balance plus every entry of a
+        regular voucher dated on or before to_date (all of them if None).
+        Tally's sign convention holds: debit is negative.
+        """
+        rows = self._query("""
+            SELECT l.name, l.parent, COALESCE(l.opening_balance, 0) + COALESCE((
+                SELECT SUM(e.amount) FROM voucher_entries e
+                JOIN vouchers v ON v.tally_url = e.tally_url AND v.company_name = e.company_name
+                    AND v.guid = e.voucher_guid
+                WHERE e.tally_url = l.tally_url AND e.company_name = l.company_name AND e.ledger = l.name
+                    AND v.is_cancelled = 0 AND v.is_optional = 0 AND v.date <= COALESCE(?3, '99999999')
+            ), 0) AS closing
+            FROM ledgers l WHERE l.tally_url = ?1 AND l.company_name = ?2
+            ORDER BY l.name
+        """, (to_date,))
+        return [(row["name"], row["parent"], round(row["closing"], 2)) for row in rows]
+
+    def trial_balance(self, from_date=None, to_date=None):
+        """
+        Ledger-level trial balance in the shape parse_response returns. Closing
+        balances are cumulative, so only to_date changes the figures.
+        """
+        data = []
+        for name, _, closing in self.ledger_closing_balances(to_date):
+            if not closing:
+                continue
+            data.append({
+                "ledger_name": name,
+                "debit": closing if closing < 0 else 0.0,
+                "credit": closing if closing > 0 else 0.0
+            })
+        return data
+
+    def balance_sheet(self, from_date=None, to_date=None):
+        """
+        Balance sheet approximated from the mirror as of to_date: ledger balances
+        rolled up to their primary group, with revenue groups folded into Profit & Loss A/c.
+        """
+        groups = {row["name"]: row for row in self._query(
+            "SELECT name, parent, is_revenue FROM groups WHERE tally_url = ? AND company_name = ?"
+        )}
+
+        def primary(name):
+            seen = set()
+            while name in groups and groups[name]["parent"] in groups and name not in seen:
+                seen.add(name)
+                name = groups[name]["parent"]
+            return name
+
+        totals, profit_and_loss = {}, 0.0
+        for _, parent, closing in self.ledger_closing_balances(to_date):
+            top = primary(parent)
+            if top in groups and groups[top]["is_revenue"]:
+                profit_and_loss += closing
+            else:
+                totals[top] = totals.get(top, 0.0) + closing
+
+        balances = [{"account": name, "closing_balance": f"{amount:.2f}"}
+                    for name, amount in sorted(totals.items()) if round(amount, 2)]
+        if round(profit_and_loss, 2):
+            balances.append({"account": "Profit & Loss A/c", "closing_balance": f"{profit_and_loss:.2f}"})
+        return balances
+
+    def ledger_transactions(self, ledger_name, from_date=None, to_date=None):
+        """Rows shaped like parse_vouchers output for one ledger, in date order, optionally within a period."""
+        rows = self._query("""
+            SELECT v.guid, v.date, v.voucher_type, e.amount,
+                (SELECT o.ledger FROM voucher_entries o
+                 WHERE o.tally_url = e.tally_url AND o.company_name = e.company_name
+                    AND o.voucher_guid = e.voucher_guid AND o.ledger != e.ledger
+                 ORDER BY o.position LIMIT 1) AS other
+            FROM voucher_entries e
+            JOIN vouchers v ON v.tally_url = e.tally_url AND v.company_name = e.company_name
+                AND v.guid = e.voucher_guid
+            WHERE e.tally_url = ? AND e.company_name = ? AND e.ledger = ?
+                AND v.is_cancelled = 0 AND v.is_optional = 0
+                AND v.date >= COALESCE(?, '') AND v.date <= COALESCE(?, '99999999')
+            ORDER BY v.date, v.master_id
+        """, (ledger_name, from_date, to_date))
+        return [{
+            "date": _tally_date(row["date"]),
+            "ledger": row["other"] or ledger_name,
+            "voucher_type": row["voucher_type"],
+            "debit": f"{row['amount']:.2f}" if row["amount"] < 0 else "0",
+            "credit": f"{row['amount']:.2f}" if row["amount"] > 0 else "0",
+        } for row in rows]
+
+    def stock_items(self):
+        """Rows shaped like fetch_stock_items output."""
+        rows = self._query(
+            "SELECT name, parent, unit, closing_balance FROM stock_items "
+            "WHERE tally_url = ? AND company_name = ? ORDER BY name"
+        )
+        return [{"name": row["name"], "parent": row["parent"], "unit": row["unit"],
+                 "closing_balance": row["closing_balance"]} for row in rows]
+
+
+def drop_mirrored_vouchers(tally_url, company_name, remote_ids, path=TALLY_MIRROR_PATH):
+    """
+    Remove vouchers deleted through this gateway from the mirror. AlterID
+    syncs cannot see deletions, so without this max_staleness reads would
+    keep counting them until the next full sync. A no-op with the mirror off.
+    """
+    if path and remote_ids:
+        SqliteSyncStore(tally_url, company_name, path).remove_vouchers(remote_ids)
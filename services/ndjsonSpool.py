@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+import tempfile
+
+# Bytes of NDJSON kept in memory before the spool moves to a temporary file
+TALLY_SPOOL_MEMORY = int(os.getenv("TALLY_SPOOL_MEMORY", str(8 * 1024 * 1024)))
+# Bytes written to (and read back from) the spool per thread hop
+TALLY_SPOOL_CHUNK_SIZE = int(os.getenv("TALLY_SPOOL_CHUNK_SIZE", "262144"))
+
+
+async def spool_ndjson(rows, page=None, max_memory: int = TALLY_SPOOL_MEMORY):
+    """
+    Drain an async row iterator into an NDJSON spool and close it before
+    anything is sent to the client. The Tally export behind rows holds a
+    host scheduler slot; draining it at Tally's pace and then serving the
+    spool means a slow HTTP reader cannot keep that slot from voucher writes.
+
+    Rows are filtered through page like a streamed response would be, with a
+    trailing {"next_cursor": ...} line. The spool stays in memory up to
+    max_memory bytes and then moves to a temporary file; file writes run off
+    the event loop. Errors from the export propagate, so the caller can still
+    answer with an HTTP error status.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    buffer = bytearray()
+    try:
+        try:
+            async for row in rows:
+                if page is not None and not page.accept(row):
+                    break
+                if page is None or page.taken:
+                    buffer += (json.dumps(row) + "\n").encode("utf-8")
+                    if len(buffer) >= TALLY_SPOOL_CHUNK_SIZE:
+                        await asyncio.to_thread(spool.write, bytes(buffer))
+                        buffer.clear()
+        finally:
+            await rows.aclose()
+        if page is not None and page.next_cursor:
+            buffer += (json.dumps({"next_cursor": page.next_cursor}) + "\n").encode("utf-8")
+        await asyncio.to_thread(spool.write, bytes(buffer))
+        await asyncio.to_thread(spool.seek, 0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+async def iter_spool(spool):
+    """Stream a spool from spool_ndjson in chunks, closing (and deleting) it at the end."""
+    try:
+        while True:
+            chunk = await asyncio.to_thread(spool.read, TALLY_SPOOL_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        spool.close()
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a cached report stays valid, and how many reports are kept
+TALLY_REPORT_CACHE_TTL = float(os.getenv("TALLY_REPORT_CACHE_TTL", "30"))
+TALLY_REPORT_CACHE_SIZE = int(os.getenv("TALLY_REPORT_CACHE_SIZE", "256"))
+
+
+class ReportCache:
+    """
+    In-process LRU cache of parsed report results keyed by
+    (tally_url, company, report, params), with a TTL per entry.
+
+    Every company has a generation counter that writes bump. A result is only
+    stored if no write happened while it was being fetched, so a slow read
+    cannot put pre-write data back into the cache.
+    """
+
+    def __init__(self, ttl: float = TALLY_REPORT_CACHE_TTL, max_size: int = TALLY_REPORT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[tuple, tuple[float, object]] = OrderedDict()
+        self.generations: dict[tuple, int] = {}
+        self.host_generations: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tally_url, company_name, report, **params):
+        return (tally_url, company_name, report, tuple(sorted(params.items())))
+
+    def generation(self, tally_url, company_name) -> tuple[int, int]:
+        with self.lock:
+            return self._generation(tally_url, company_name)
+
+    def _generation(self, tally_url, company_name):
+        return self.host_generations.get(tally_url, 0), self.generations.get((tally_url, company_name), 0)
+
+    def get(self, key):
+        """Return (hit, value). Cached values are shared; treat them as read-only."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value, generation: tuple[int, int]):
+        with self.lock:
+            if self._generation(*key[:2]) != generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tally_url, company_name=None):
+        """Drop a company's reports, or every report of the host when company_name is None."""
+        with self.lock:
+            if company_name is None:
+                self.host_generations[tally_url] = self.host_generations.get(tally_url, 0) + 1
+                companies = {key[:2] for key in self.entries if key[0] == tally_url}
+            else:
+                self.generations[(tally_url, company_name)] = self.generations.get((tally_url, company_name), 0) + 1
+                companies = {(tally_url, company_name)}
+            for key in [key for key in self.entries if key[:2] in companies]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_size": self.max_size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses}
+
+
+report_cache = ReportCache()
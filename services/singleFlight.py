@@ -0,0 +1,105 @@
+import asyncio
+import threading
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = []  # (loop, future) of async callers
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution.
+    The first caller runs the work; everyone who arrives while it is in flight,
+    from a thread or from an event loop, gets the same result or exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights: dict[tuple, _Flight] = {}
+        self.coalesced = 0
+
+    def _join(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self.flights[key] = _Flight()
+            return flight, True
+
+    def _land(self, key, flight, result=None, error=None):
+        with self.lock:
+            self.flights.pop(key, None)
+            flight.result, flight.error = result, error
+            flight.done.set()
+            waiters, flight.waiters = flight.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._wake, future)
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def do(self, key, fn):
+        """Run fn() unless an identical call is already in flight; then wait for its result."""
+        flight, leader = self._join(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._land(key, flight, error=e)
+                raise
+            self._land(key, flight, result=result)
+            return result
+        flight.done.wait()
+        return flight.outcome()
+
+    async def do_async(self, key, fn):
+        """
+        Async variant of do; fn returns an awaitable. The work runs as its own
+        task, so a caller that goes away does not cancel it for the others.
+        """
+        flight, leader = self._join(key)
+        if leader:
+            task = asyncio.get_running_loop().create_task(fn())
+
+            def land(task):
+                if task.cancelled():
+                    self._land(key, flight, error=asyncio.CancelledError())
+                else:
+                    self._land(key, flight, result=task.result() if task.exception() is None else None,
+                               error=task.exception())
+
+            task.add_done_callback(land)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if flight.done.is_set():
+                future.set_result(None)
+            else:
+                flight.waiters.append((loop, future))
+        try:
+            await future
+        finally:
+            with self.lock:
+                if (loop, future) in flight.waiters:
+                    flight.waiters.remove((loop, future))
+        return flight.outcome()
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": len(self.flights), "coalesced": self.coalesced}
+
+
+report_flights = SingleFlight()
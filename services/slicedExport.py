@@ -0,0 +1,183 @@
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from services.tallyScheduler import TALLY_MAX_IN_FLIGHT
+from services.circuitBreaker import TallyUnavailableError
+
+# Width of one export slice: "month" for calendar months, a number of days, or
+# "adaptive" to size each slice from the rows per day earlier slices returned
+TALLY_SLICE_WINDOW = os.getenv("TALLY_SLICE_WINDOW", "month")
+# Rows an adaptive slice aims for
+TALLY_SLICE_TARGET_ROWS = int(os.getenv("TALLY_SLICE_TARGET_ROWS", "5000"))
+# Slices in flight per export; each still waits for a slot in the host scheduler
+TALLY_SLICE_PARALLELISM = int(os.getenv("TALLY_SLICE_PARALLELISM", str(TALLY_MAX_IN_FLIGHT)))
+# How many times a failing slice is split in half and retried before giving up
+TALLY_SLICE_RETRIES = int(os.getenv("TALLY_SLICE_RETRIES", "2"))
+
+
+def _parse(date: str) -> datetime:
+    return datetime.strptime(date, "%Y%m%d")
+
+
+def _format(date: datetime) -> str:
+    return date.strftime("%Y%m%d")
+
+
+class AdaptiveWindows:
+    """
+    Consecutive windows over from_date..to_date sized by row count. Tally
+    cannot count rows ahead of an export, so the rows per day are learned as
+    slices come back (iter_sliced reports each through record()), and every
+    next window spans about target_rows worth of days. Windows handed out
+    before the first slice returns are initial_days wide.
+    """
+
+    def __init__(self, from_date: str, to_date: str, target_rows: int = TALLY_SLICE_TARGET_ROWS,
+                 initial_days: int = 31, max_days: int = 366):
+        self.next_start, self.end = _parse(from_date), _parse(to_date)
+        self.target_rows = max(1, target_rows)
+        self.initial_days = initial_days
+        self.max_days = max_days
+        self.rows = 0
+        self.days = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple[str, str]:
+        if self.next_start > self.end:
+            raise StopIteration
+        if not self.days:
+            width = self.initial_days
+        elif not self.rows:
+            width = self.max_days
+        else:
+            width = int(self.target_rows * self.days / self.rows)
+        start = self.next_start
+        stop = min(self.end, start + timedelta(days=min(self.max_days, max(1, width)) - 1))
+        self.next_start = stop + timedelta(days=1)
+        return _format(start), _format(stop)
+
+    def record(self, window: tuple[str, str], rows: int):
+        start, end = window
+        self.days += (_parse(end) - _parse(start)).days + 1
+        self.rows += rows
+
+
+def date_windows(from_date: str, to_date: str, window=TALLY_SLICE_WINDOW):
+    """
+    Split from_date..to_date (YYYYMMDD, inclusive) into consecutive windows:
+    calendar months, fixed runs of days, or, for "adaptive", an
+    AdaptiveWindows that sizes each window as earlier ones return.
+    """
+    if not from_date or not to_date:
+        raise ValueError("Sliced export needs both from_date and to_date")
+    if str(window) == "adaptive":
+        return AdaptiveWindows(from_date, to_date)
+    start, end = _parse(from_date), _parse(to_date)
+    windows = []
+    while start <= end:
+        if str(window) == "month":
+            next_start = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        else:
+            next_start = start + timedelta(days=max(1, int(window)))
+        windows.append((_format(start), _format(min(end, next_start - timedelta(days=1)))))
+        start = next_start
+    return windows
+
+
+def bisect_window(start: str, end: str) -> list[tuple[str, str]]:
+    """Split a window into two halves; a single day cannot be split."""
+    first, last = _parse(start), _parse(end)
+    if first >= last:
+        return [(start, end)]
+    middle = first + (last - first) // 2
+    return [(start, _format(middle)), (_format(middle + timedelta(days=1)), end)]
+
+
+def _fetch_window(fetch, start, end, retries):
+    try:
+        return fetch(start, end)
+    except TallyUnavailableError:
+        # Splitting cannot help while the host is down
+        raise
+    except Exception:
+        if retries <= 0:
+            raise
+    rows = []
+    for half in bisect_window(start, end):
+        rows.extend(_fetch_window(fetch, *half, retries - 1))
+    return rows
+
+
+async def _fetch_window_async(fetch, start, end, retries):
+    try:
+        return await fetch(start, end)
+    except TallyUnavailableError:
+        # Splitting cannot help while the host is down
+        raise
+    except Exception:
+        if retries <= 0:
+            raise
+    rows = []
+    for half in bisect_window(start, end):
+        rows.extend(await _fetch_window_async(fetch, *half, retries - 1))
+    return rows
+
+
+def iter_sliced(windows, fetch, parallelism=TALLY_SLICE_PARALLELISM, retries=TALLY_SLICE_RETRIES):
+    """
+    Fetch every window with fetch(start, end) -> list, keeping up to
+    parallelism windows in flight, and yield (window, rows) in window order
+    as soon as each is ready. A failing window is split in half and retried,
+    up to retries times; if it still fails the error is raised and the
+    windows not yet started are abandoned. windows is consumed lazily, and
+    each window's row count goes to its record() method when it has one.
+    """
+    record = getattr(windows, "record", None)
+    pending = iter(windows)
+    running = deque()
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        try:
+            while True:
+                while len(running) < max(1, parallelism):
+                    window = next(pending, None)
+                    if window is None:
+                        break
+                    running.append((window, pool.submit(_fetch_window, fetch, *window, retries)))
+                if not running:
+                    return
+                window, future = running.popleft()
+                rows = future.result()
+                if record is not None:
+                    record(window, len(rows))
+                yield window, rows
+        finally:
+            for _, future in running:
+                future.cancel()
+
+
+async def aiter_sliced(windows, fetch, parallelism=TALLY_SLICE_PARALLELISM, retries=TALLY_SLICE_RETRIES):
+    """Async variant of iter_sliced; fetch(start, end) returns an awaitable."""
+    record = getattr(windows, "record", None)
+    pending = iter(windows)
+    running = deque()
+    try:
+        while True:
+            while len(running) < max(1, parallelism):
+                window = next(pending, None)
+                if window is None:
+                    break
+                running.append((window, asyncio.ensure_future(_fetch_window_async(fetch, *window, retries))))
+            if not running:
+                return
+            window, task = running.popleft()
+            rows = await task
+            if record is not None:
+                record(window, len(rows))
+            yield window, rows
+    finally:
+        for _, task in running:
+            task.cancel()
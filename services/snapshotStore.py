@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Directory of immutable report snapshots for closed periods, and its size budget
+TALLY_SNAPSHOT_DIR = os.getenv("TALLY_SNAPSHOT_DIR", "tally_snapshots")
+TALLY_SNAPSHOT_MAX_BYTES = int(os.getenv("TALLY_SNAPSHOT_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _canonical(value) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _day_before(date: str) -> str:
+    return (datetime.strptime(date, "%Y%m%d") - timedelta(days=1)).strftime("%Y%m%d")
+
+
+def validate_period(from_date=None, to_date=None):
+    """Check optional YYYYMMDD report period bounds."""
+    for label, value in (("from_date", from_date), ("to_date", to_date)):
+        if value is None:
+            continue
+        try:
+            datetime.strptime(str(value), "%Y%m%d")
+        except ValueError:
+            raise ValueError(f"{label} {value} must be in YYYYMMDD format")
+    if from_date and to_date and str(from_date) > str(to_date):
+        raise ValueError("from_date must not be after to_date")
+    return True
+
+
+class SnapshotStore:
+    """
+    On-disk store of report results for closed periods.
+
+    Each company has a "closed through" date; a report whose to_date falls on
+    or before it can no longer change, so its parsed result is written once
+    and served from disk afterwards. Results are stored content-addressed
+    under objects/ (identical results share one file) and looked up through
+    refs/ keyed by a hash of (tally_url, company, report, params). Refs are
+    evicted least-recently-read first once objects exceed max_bytes.
+
+    The refs and the bytes their objects use are read from disk once and then
+    kept in memory, so a put does not rescan the store. All of it is blocking
+    file I/O; async callers use get_async and put_async.
+    """
+
+    def __init__(self, root: str = TALLY_SNAPSHOT_DIR, max_bytes: int = TALLY_SNAPSHOT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.objects_dir = os.path.join(root, "objects")
+        self.refs_dir = os.path.join(root, "refs")
+        self.periods_path = os.path.join(root, "periods.json")
+        self._periods = None
+        self._index = None  # ref path -> ref record, with "read_at" for eviction order
+        self._sizes = {}  # object digest -> bytes on disk
+        self._holders = {}  # object digest -> refs pointing at it
+        self._used = 0
+
+    # ---------- Files ----------
+    def _ensure_dirs(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    def _write_atomic(self, path, data: bytes):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, f"{digest}.json")
+
+    def _ref_path(self, ref):
+        return os.path.join(self.refs_dir, f"{ref}.json")
+
+    def _refs(self):
+        """Yield (ref path, ref record) for every stored snapshot."""
+        if not os.path.isdir(self.refs_dir):
+            return
+        for name in os.listdir(self.refs_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.refs_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    yield path, json.loads(f.read())
+            except (OSError, ValueError):
+                continue
+
+    def _load_index(self):
+        """Read every ref once and drop objects no ref points to; afterwards the index is kept in memory."""
+        if self._index is not None:
+            return self._index
+        self._index, self._sizes, self._holders, self._used = {}, {}, {}, 0
+        for path, ref in self._refs():
+            try:
+                ref["read_at"] = os.path.getmtime(path)
+            except OSError:
+                continue
+            self._index[path] = ref
+            self._holders[ref["object"]] = self._holders.get(ref["object"], 0) + 1
+        if os.path.isdir(self.objects_dir):
+            for name in os.listdir(self.objects_dir):
+                path = os.path.join(self.objects_dir, name)
+                digest = name[:-5] if name.endswith(".json") else None
+                if digest in self._holders:
+                    self._sizes[digest] = os.path.getsize(path)
+                    self._used += self._sizes[digest]
+                else:
+                    os.remove(path)
+        return self._index
+
+    def _drop_ref(self, path):
+        """Delete a ref, and its object once no other ref holds it."""
+        ref = self._index.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if ref is not None:
+            self._release(ref["object"])
+
+    def _release(self, digest):
+        """One ref fewer holds digest; delete the object when none is left."""
+        self._holders[digest] = self._holders.get(digest, 1) - 1
+        if self._holders[digest] <= 0:
+            self._holders.pop(digest, None)
+            self._used -= self._sizes.pop(digest, 0)
+            try:
+                os.remove(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    # ---------- Periods ----------
+    def _load_periods(self):
+        if self._periods is None:
+            try:
+                with open(self.periods_path, "rb") as f:
+                    self._periods = {tuple(k.split("\n", 1)): v for k, v in json.loads(f.read()).items()}
+            except (OSError, ValueError):
+                self._periods = {}
+        return self._periods
+
+    def _save_periods(self):
+        os.makedirs(self.root, exist_ok=True)
+        self._write_atomic(self.periods_path, _canonical({"\n".join(k): v for k, v in self._periods.items()}))
+
+    def closed_through(self, tally_url, company_name):
+        with self.lock:
+            return self._load_periods().get((tally_url, company_name))
+
+    def close_period(self, tally_url, company_name, to_date: str):
+        """Mark everything up to and including to_date as closed."""
+        with self.lock:
+            periods = self._load_periods()
+            current = periods.get((tally_url, company_name))
+            periods[(tally_url, company_name)] = max(current or to_date, to_date)
+            self._save_periods()
+            return periods[(tally_url, company_name)]
+
+    def reopen_period(self, tally_url, company_name, from_date: str):
+        """Reopen the books from from_date on and purge every snapshot that depends on them."""
+        with self.lock:
+            periods = self._load_periods()
+            current = periods.get((tally_url, company_name))
+            if current is not None and current >= from_date:
+                closed = _day_before(from_date)
+                if closed < "19000101":
+                    periods.pop((tally_url, company_name))
+                else:
+                    periods[(tally_url, company_name)] = closed
+                self._save_periods()
+
+            purged = 0
+            for path, ref in list(self._load_index().items()):
+                if (ref["tally_url"], ref["company_name"]) == (tally_url, company_name) and ref["to_date"] >= from_date:
+                    self._drop_ref(path)
+                    purged += 1
+            return purged
+
+    def is_closed(self, tally_url, company_name, to_date) -> bool:
+        if not to_date:
+            return False
+        closed = self.closed_through(tally_url, company_name)
+        return closed is not None and to_date <= closed
+
+    # ---------- Snapshots ----------
+    def ref(self, tally_url, company_name, report, params: dict) -> str:
+        return _digest(_canonical([tally_url, company_name, report, params]))
+
+    def get(self, tally_url, company_name, report, params: dict):
+        """Return (hit, value) for a closed-period report."""
+        if not self.is_closed(tally_url, company_name, params.get("to_date")):
+            return False, None
+        ref_path = self._ref_path(self.ref(tally_url, company_name, report, params))
+        with self.lock:
+            try:
+                with open(ref_path, "rb") as f:
+                    digest = json.loads(f.read())["object"]
+                with open(self._object_path(digest), "rb") as f:
+                    data = f.read()
+            except (OSError, ValueError, KeyError):
+                return False, None
+            index = self._load_index()
+            if _digest(data) != digest:
+                # Corrupted on disk; drop it and refetch
+                self._drop_ref(ref_path)
+                return False, None
+            os.utime(ref_path)
+            if ref_path in index:
+                index[ref_path]["read_at"] = time.time()
+        return True, json.loads(data)
+
+    async def get_async(self, tally_url, company_name, report, params: dict):
+        """get without blocking the event loop on file reads."""
+        return await asyncio.to_thread(self.get, tally_url, company_name, report, params)
+
+    def put(self, tally_url, company_name, report, params: dict, value):
+        """
+        Store a closed-period report result; a no-op for open periods and for
+        empty results. Tally answers a mistyped ledger or a company that is
+        not loaded with HTTP 200 and an error body that parses to no rows, so
+        an empty result is left to the TTL cache rather than kept for good.
+        """
+        if not value or not self.is_closed(tally_url, company_name, params.get("to_date")):
+            return False
+        data = _canonical(value)
+        digest = _digest(data)
+        record = {"object": digest, "tally_url": tally_url, "company_name": company_name,
+                  "report": report, "params": params, "to_date": params["to_date"], "created": time.time()}
+        with self.lock:
+            closed = self._load_periods().get((tally_url, company_name))
+            if closed is None or params["to_date"] > closed:
+                return False
+            index = self._load_index()
+            self._ensure_dirs()
+            if digest not in self._sizes:
+                self._write_atomic(self._object_path(digest), data)
+                self._sizes[digest] = len(data)
+                self._used += len(data)
+            # Hold the new object before letting go of the one the ref pointed at before
+            self._holders[digest] = self._holders.get(digest, 0) + 1
+            ref_path = self._ref_path(self.ref(tally_url, company_name, report, params))
+            previous = index.pop(ref_path, None)
+            self._write_atomic(ref_path, _canonical(record))
+            index[ref_path] = {**record, "read_at": time.time()}
+            if previous is not None:
+                self._release(previous["object"])
+            self._evict()
+        return True
+
+    async def put_async(self, tally_url, company_name, report, params: dict, value):
+        """put without blocking the event loop on file writes."""
+        return await asyncio.to_thread(self.put, tally_url, company_name, report, params, value)
+
+    def _evict(self):
+        """Drop least-recently-read refs until the objects fit in max_bytes."""
+        if self._used <= self.max_bytes:
+            return
+        for path, _ in sorted(self._index.items(), key=lambda item: item[1]["read_at"]):
+            if self._used <= self.max_bytes:
+                break
+            self._drop_ref(path)
+
+    def stats(self, tally_url=None, company_name=None):
+        with self.lock:
+            refs = [ref for ref in self._load_index().values()
+                    if tally_url is None or (ref["tally_url"], ref["company_name"]) == (tally_url, company_name)]
+            used = self._used
+        return {"snapshots": len(refs), "bytes": used, "max_bytes": self.max_bytes}
+
+
+snapshot_store = SnapshotStore()
@@ -0,0 +1,443 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from xml.sax.saxutils import escape
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import COLLECTION_EXPORT
+from services.xmlStream import TALLY_STREAM_CHUNK_SIZE, iter_elements, aiter_elements
+from services.updateVoucherService import TallyVoucherUpdater
+from services.voucherIndex import get_voucher_index
+from services.mirrorStore import TALLY_MIRROR_PATH, SqliteSyncStore
+from services.metrics import observe_build
+from services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Seconds between background sync passes
+TALLY_SYNC_INTERVAL = float(os.getenv("TALLY_SYNC_INTERVAL", "30"))
+# Seconds between the full syncs a background loop runs to reconcile deletions; 0 disables
+TALLY_SYNC_FULL_INTERVAL = float(os.getenv("TALLY_SYNC_FULL_INTERVAL", "3600"))
+
+# kind -> (Tally object type, exported element tag, fields to fetch)
+MASTER_COLLECTIONS = {
+    "groups": ("Group", "GROUP", "Name,Parent,GUID,MasterID,AlterID,IsRevenue,IsDeemedPositive"),
+    "ledgers": ("Ledger", "LEDGER", "Name,Parent,GUID,MasterID,AlterID,OpeningBalance"),
+    "stock_items": ("Stock Item", "STOCKITEM", "Name,Parent,GUID,MasterID,AlterID,BaseUnits,OpeningBalance,ClosingBalance"),
+}
+VOUCHER_FETCH = (
+    "GUID,MasterID,AlterID,RemoteID,Date,VoucherTypeName,VoucherNumber,Narration,IsCancelled,IsOptional,"
+    "AllLedgerEntries.LedgerName,AllLedgerEntries.Amount"
+)
+
+
+def _text(elem, tag):
+    return (elem.findtext(tag) or "").strip()
+
+
+def _int(value, default=0):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+def _amount(value):
+    try:
+        return float(str(value).strip() or 0)
+    except ValueError:
+        return 0.0
+
+
+class MemorySyncStore:
+    """
+    Local view of one company kept current by the sync engine: masters by
+    kind and vouchers, each keyed by GUID, plus the AlterID watermarks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watermarks = {"master": 0, "voucher": 0}
+        self.masters = {kind: {} for kind in MASTER_COLLECTIONS}
+        self.vouchers = {}
+        self.last_synced = None
+
+    def apply_masters(self, kind, rows, replace=False):
+        with self.lock:
+            if replace:
+                self.masters[kind] = {}
+            for row in rows:
+                self.masters[kind][row["guid"]] = row
+
+    def apply_vouchers(self, rows, replace=False):
+        with self.lock:
+            if replace:
+                self.vouchers = {}
+            for row in rows:
+                self.vouchers[row["guid"]] = row
+
+    def set_watermarks(self, master, voucher):
+        with self.lock:
+            self.watermarks = {"master": master, "voucher": voucher}
+            self.last_synced = time.time()
+
+    def counts(self):
+        with self.lock:
+            counts = {kind: len(rows) for kind, rows in self.masters.items()}
+            counts["vouchers"] = len(self.vouchers)
+            return counts
+
+
+class TallySyncEngine:
+    """
+    Incremental sync for one company. Tally bumps a company-wide AlterID
+    counter on every change (one for masters, one for vouchers), so each pass
+    reads the two counters and pulls only objects whose AlterID is above the
+    last one seen. An unchanged company costs one tiny request.
+
+    AlterID filters cannot see deletions. Vouchers deleted through this
+    gateway are dropped from the mirror right away; anything deleted in Tally
+    itself stays until a full sync, which background mode runs every
+    TALLY_SYNC_FULL_INTERVAL seconds.
+    """
+
+    def __init__(self, tally_url, company_name, store=None):
+        self.tally_url = tally_url
+        self.company_name = company_name
+        self.client = get_tally_client(tally_url)
+        self.store = store or MemorySyncStore()
+        self.voucher_reader = TallyVoucherUpdater(tally_url)
+        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock()
+        self.last_result = None
+        self.last_error = None
+
+    # ---------- Requests ----------
+    @observe_build
+    def build_collection_xml(self, collection_name, object_type, fetch, formula=None):
+        """Build a TDL collection export, optionally filtered by a formula."""
+        filters_xml, formula_xml = "", ""
+        if formula:
+            filters_xml = f"\n                                <FILTERS>{collection_name}Filter</FILTERS>"
+            formula_xml = f"""
+                            <SYSTEM TYPE="Formulae" NAME="{collection_name}Filter">{formula}</SYSTEM>"""
+
+        return f"""
+        <ENVELOPE>
+            <HEADER>
+                <VERSION>1</VERSION>
+                <TALLYREQUEST>Export</TALLYREQUEST>
+                <TYPE>Collection</TYPE>
+                <ID>{collection_name}</ID>
+            </HEADER>
+            <BODY>
+                <DESC>
+                    <STATICVARIABLES>
+                        <SVCURRENTCOMPANY>{escape(self.company_name)}</SVCURRENTCOMPANY>
+                        <SVEXPORTFORMAT>XML</SVEXPORTFORMAT>
+                    </STATICVARIABLES>
+                    <TDL>
+                        <TDLMESSAGE>
+                            <COLLECTION NAME="{collection_name}" ISMODIFY="No" ISFIXED="No" ISINITIALIZE="No" ISOPTION="No" ISINTERNAL="No">
+                                <TYPE>{object_type}</TYPE>
+                                <FETCH>{fetch}</FETCH>{filters_xml}
+                            </COLLECTION>{formula_xml}
+                        </TDLMESSAGE>
+                    </TDL>
+                </DESC>
+            </BODY>
+        </ENVELOPE>
+        """
+
+    def build_watermark_xml(self):
+        name = escape(self.company_name).replace('"', "&quot;")
+        return self.build_collection_xml("SyncCompany", "Company", "Name,AltMstID,AltVchID", f'$Name = "{name}"')
+
+    def build_changes_xml(self, kind, since):
+        formula = f"$AlterID > {since}" if since else None
+        if kind == "vouchers":
+            return self.build_collection_xml("SyncVouchers", "Voucher", VOUCHER_FETCH, formula)
+        object_type, _, fetch = MASTER_COLLECTIONS[kind]
+        return self.build_collection_xml(f"Sync{object_type.replace(' ', '')}s", object_type, fetch, formula)
+
+    def _tag(self, kind):
+        return "VOUCHER" if kind == "vouchers" else MASTER_COLLECTIONS[kind][1]
+
+    def _pull(self, xml_request, tag):
+        with self.client.stream(
+            xml_request, operation=COLLECTION_EXPORT, company_name=self.company_name
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Tally returned {response.status_code} during sync")
+            chunks = response.iter_content(TALLY_STREAM_CHUNK_SIZE)
+            yield from iter_elements(chunks, [tag], response.encoding or "utf-8", report=f"sync_{tag.lower()}")
+
+    async def _pull_async(self, xml_request, tag):
+        async with get_async_tally_client(self.tally_url).stream(
+            xml_request, operation=COLLECTION_EXPORT, company_name=self.company_name
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Tally returned {response.status_code} during sync")
+            async for elem in aiter_elements(response.aiter_bytes(), [tag], response.encoding, report=f"sync_{tag.lower()}"):
+                yield elem
+
+    # ---------- Rows ----------
+    def build_watermarks(self, companies):
+        """Read (AltMstID, AltVchID) from the exported COMPANY element."""
+        if not companies:
+            raise RuntimeError(f"Company '{self.company_name}' is not open in Tally")
+        company = companies[0]
+        return _int(_text(company, "ALTMSTID")), _int(_text(company, "ALTVCHID"))
+
+    def build_master_row(self, kind, elem):
+        row = {
+            "guid": _text(elem, "GUID") or elem.get("NAME"),
+            "master_id": _int(_text(elem, "MASTERID")),
+            "alter_id": _int(_text(elem, "ALTERID")),
+            "name": elem.get("NAME") or _text(elem, "NAME"),
+            "parent": _text(elem, "PARENT"),
+        }
+        if kind == "groups":
+            row["is_revenue"] = _text(elem, "ISREVENUE") == "Yes"
+            row["is_deemed_positive"] = _text(elem, "ISDEEMEDPOSITIVE") == "Yes"
+        elif kind == "ledgers":
+            row["opening_balance"] = _amount(_text(elem, "OPENINGBALANCE"))
+        elif kind == "stock_items":
+            row["unit"] = _text(elem, "BASEUNITS")
+            row["opening_balance"] = _text(elem, "OPENINGBALANCE")
+            row["closing_balance"] = _text(elem, "CLOSINGBALANCE")
+        return row
+
+    def build_voucher_row(self, elem):
+        row = self.voucher_reader.voucher_details(elem, self.company_name)
+        row["remote_id"] = row["remote_id"] or _text(elem, "GUID")
+        row.update({
+            "guid": _text(elem, "GUID") or row["remote_id"],
+            "master_id": _int(_text(elem, "MASTERID")),
+            "alter_id": _int(_text(elem, "ALTERID")),
+            "is_cancelled": _text(elem, "ISCANCELLED") == "Yes",
+            "is_optional": _text(elem, "ISOPTIONAL") == "Yes",
+            "entries": [
+                {"ledger": _text(entry, "LEDGERNAME"), "amount": _amount(_text(entry, "AMOUNT"))}
+                for entry in elem.findall(".//ALLLEDGERENTRIES.LIST")
+            ],
+        })
+        return row
+
+    def _index_vouchers(self, rows, full):
+        index = get_voucher_index(self.tally_url, self.company_name)
+        if full:
+            index.rebuild([row for row in rows if not row["is_cancelled"]])
+            return
+        for row in rows:
+            if row["is_cancelled"]:
+                index.remove(row["remote_id"])
+            else:
+                index.add(row)
+
+    def _plan(self, target_master, target_voucher, full):
+        """Return (watermarks pulled from, [(kind, AlterID to pull above, replace)])."""
+        since = {"master": 0, "voucher": 0} if full else dict(self.store.watermarks)
+        masters_changed = full or target_master > since["master"]
+        vouchers_changed = full or target_voucher > since["voucher"]
+        plan = []
+        for kind in MASTER_COLLECTIONS:
+            if kind == "stock_items" and vouchers_changed:
+                # Closing quantities move with vouchers without bumping the item's AlterID
+                plan.append((kind, 0, True))
+            elif masters_changed:
+                plan.append((kind, since["master"], full))
+        if vouchers_changed:
+            plan.append(("vouchers", since["voucher"], full))
+        return since, plan
+
+    def _apply(self, kind, rows, replace):
+        if kind == "vouchers":
+            self.store.apply_vouchers(rows, replace=replace)
+            self._index_vouchers(rows, replace)
+        else:
+            self.store.apply_masters(kind, rows, replace=replace)
+
+    def _finish(self, since, targets, pulled, full, started):
+        # Only the pre-pull targets are safe. Groups, ledgers and stock items share
+        # the company's AltMstID but are pulled in separate passes, so an AlterID
+        # seen in a later pass can be above a change an earlier pass missed.
+        # Rows altered mid-pass are pulled again next time; the upserts absorb that.
+        master = max(since["master"], targets[0])
+        voucher = max(since["voucher"], targets[1])
+        self.store.set_watermarks(master, voucher)
+        self.last_error = None
+        self.last_result = {
+            "company_name": self.company_name,
+            "full": full,
+            "changed": {kind: len(rows) for kind, rows in pulled.items()},
+            "watermarks": {"master": master, "voucher": voucher},
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+        return self.last_result
+
+    # ---------- Sync ----------
+    def is_fresh(self, max_staleness):
+        last_synced = self.store.last_synced
+        return last_synced is not None and time.time() - last_synced <= max_staleness
+
+    def sync_now(self, full=False):
+        """Pull everything altered since the last watermarks (or everything, with full=True)."""
+        with self.lock:
+            started = time.monotonic()
+            try:
+                targets = self.build_watermarks(list(self._pull(self.build_watermark_xml(), "COMPANY")))
+                since, plan = self._plan(*targets, full)
+                pulled = {}
+                for kind, since_id, replace in plan:
+                    elems = self._pull(self.build_changes_xml(kind, since_id), self._tag(kind))
+                    if kind == "vouchers":
+                        pulled[kind] = [self.build_voucher_row(e) for e in elems]
+                    else:
+                        pulled[kind] = [self.build_master_row(kind, e) for e in elems]
+                    self._apply(kind, pulled[kind], replace)
+                return self._finish(since, targets, pulled, full, started)
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+
+    async def _sync_async(self, full):
+        started = time.monotonic()
+        try:
+            companies = [e async for e in self._pull_async(self.build_watermark_xml(), "COMPANY")]
+            targets = self.build_watermarks(companies)
+            # Store reads and writes may be SQLite commits; they run off the event loop
+            since, plan = await asyncio.to_thread(self._plan, *targets, full)
+            pulled = {}
+            for kind, since_id, replace in plan:
+                elems = self._pull_async(self.build_changes_xml(kind, since_id), self._tag(kind))
+                if kind == "vouchers":
+                    pulled[kind] = [self.build_voucher_row(e) async for e in elems]
+                else:
+                    pulled[kind] = [self.build_master_row(kind, e) async for e in elems]
+                await asyncio.to_thread(self._apply, kind, pulled[kind], replace)
+            return await asyncio.to_thread(self._finish, since, targets, pulled, full, started)
+        except Exception as e:
+            self.last_error = str(e)
+            raise
+
+    async def sync_now_async(self, full=False):
+        """Async variant of sync_now; concurrent calls for the same company run one after another."""
+        async with self.async_lock:
+            return await self._sync_async(full)
+
+    async def ensure_fresh_async(self, max_staleness):
+        """Sync only if the local view is older than max_staleness seconds; concurrent callers share one pass."""
+        if await asyncio.to_thread(self.is_fresh, max_staleness):
+            return None
+        async with self.async_lock:
+            if await asyncio.to_thread(self.is_fresh, max_staleness):
+                return None
+            return await self._sync_async(full=False)
+
+    def status(self):
+        return {
+            "company_name": self.company_name,
+            "watermarks": dict(self.store.watermarks),
+            "last_synced": self.store.last_synced,
+            "counts": self.store.counts(),
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+            "background": is_background_sync_running(self.tally_url, self.company_name),
+        }
+
+
+_engines: dict[tuple[str, str], TallySyncEngine] = {}
+_engines_lock = threading.Lock()
+_background: dict[tuple[str, str], asyncio.Task] = {}
+
+
+def get_sync_engine(tally_url: str, company_name: str) -> TallySyncEngine:
+    """Return the shared sync engine for a company on a Tally host."""
+    key = (tally_url, company_name)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            store = SqliteSyncStore(tally_url, company_name) if TALLY_MIRROR_PATH else None
+            engine = _engines[key] = TallySyncEngine(tally_url, company_name, store)
+        return engine
+
+
+async def read_mirror_async(tally_url: str, company_name: str, max_staleness: float, query: str, *args):
+    """
+    Answer a read from the local SQLite mirror, syncing first only when it is
+    older than max_staleness seconds. The bound covers new and altered
+    objects only: a voucher deleted directly in Tally is still counted until
+    the next full sync.
+    """
+    engine = get_sync_engine(tally_url, company_name)
+    if not isinstance(engine.store, SqliteSyncStore):
+        raise ValueError("Local mirror is disabled; set TALLY_MIRROR_PATH to enable it")
+    await engine.ensure_fresh_async(max(0.0, max_staleness))
+    return await asyncio.to_thread(getattr(engine.store, query), *args)
+
+
+def sync_engines() -> list[TallySyncEngine]:
+    with _engines_lock:
+        return list(_engines.values())
+
+
+async def _background_loop(engine: TallySyncEngine, interval: float, full_interval: float = TALLY_SYNC_FULL_INTERVAL):
+    # The first pass is full too, reconciling whatever was deleted while no loop ran
+    last_full = None
+    while True:
+        full = bool(full_interval) and (last_full is None or time.monotonic() - last_full >= full_interval)
+        try:
+            with tracer.span("background_sync", parent=None, attributes={
+                "server.address": engine.tally_url, "tally.company": engine.company_name, "sync.full": full,
+            }):
+                await engine.sync_now_async(full=full)
+            if full:
+                last_full = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Background sync failed for %s at %s", engine.company_name, engine.tally_url)
+        await asyncio.sleep(interval)
+
+
+def start_background_sync(tally_url: str, company_name: str, interval: float = TALLY_SYNC_INTERVAL):
+    """
+    Run sync_now_async for the company every interval seconds on the current
+    event loop, with a full sync first and then every TALLY_SYNC_FULL_INTERVAL seconds.
+    """
+    key = (tally_url, company_name)
+    task = _background.get(key)
+    if task is not None and not task.done():
+        return False
+    engine = get_sync_engine(tally_url, company_name)
+    # Created inside a fresh context, which keeps the loop out of the trace of the
+    # request that started it (create_task's context= argument needs Python 3.11)
+    _background[key] = contextvars.Context().run(
+        asyncio.get_running_loop().create_task, _background_loop(engine, max(1.0, interval))
+    )
+    return True
+
+
+def is_background_sync_running(tally_url: str, company_name: str) -> bool:
+    task = _background.get((tally_url, company_name))
+    return task is not None and not task.done()
+
+
+async def stop_background_sync(tally_url: str, company_name: str):
+    task = _background.pop((tally_url, company_name), None)
+    if task is None:
+        return False
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return True
+
+
+async def stop_all_background_syncs():
+    for tally_url, company_name in list(_background):
+        await stop_background_sync(tally_url, company_name)
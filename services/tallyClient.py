@@ -0,0 +1,518 @@
+import asyncio
+import os
+import re
+import threading
+import time
+import requests
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from services.tallyScheduler import (
+    COLLECTION_EXPORT, MASTER_IMPORT, REPORT_EXPORT, VOUCHER_IMPORT, get_host_scheduler
+)
+from services.circuitBreaker import TALLY_EXPORT_RETRIES, backoff_delay, get_circuit_breaker, is_retryable
+from services.timeoutPolicy import timeout_policy
+from services.metrics import current_endpoint, tally_errors, tally_request_bytes, tally_request_seconds, tally_response_bytes
+from services.reportCache import report_cache
+from services.tracing import CLIENT, tracer
+from services.xmlStream import TALLY_STREAM_CHUNK_SIZE
+
+# Pool and connect timeout defaults, overridable per deployment through the environment.
+# Read timeouts come from timeout_policy, per operation class and host.
+TALLY_POOL_SIZE = int(os.getenv("TALLY_POOL_SIZE", "10"))
+TALLY_CONNECT_TIMEOUT = float(os.getenv("TALLY_CONNECT_TIMEOUT", "5"))
+
+_DEFAULT = object()
+
+WRITE_OPERATIONS = (MASTER_IMPORT, VOUCHER_IMPORT)
+# Reads that are safe to send again after a connection failure
+EXPORT_OPERATIONS = (REPORT_EXPORT, COLLECTION_EXPORT)
+
+
+def attempts_for(operation) -> int:
+    return 1 + (TALLY_EXPORT_RETRIES if operation in EXPORT_OPERATIONS else 0)
+
+
+def record_latency(tally_url, operation, read_timeout, started, error=None, items=1):
+    """
+    Feed timeout_policy and the request metrics: a response's latency, or the
+    timeout itself when the read timed out, so a slowing host raises its own
+    timeout. Connection failures say nothing about latency and are only counted.
+    items is how many objects the request carried.
+    """
+    if error is None:
+        elapsed = time.monotonic() - started
+        timeout_policy.record(tally_url, operation, elapsed, items)
+        tally_request_seconds.observe(elapsed, operation=operation, endpoint=current_endpoint.get(), host=tally_url)
+        return
+    kind = "timeout" if isinstance(error, requests.exceptions.Timeout) else "connect"
+    tally_errors.inc(kind=kind, operation=operation, host=tally_url)
+    if isinstance(error, requests.exceptions.ReadTimeout) and read_timeout:
+        timeout_policy.record(tally_url, operation, read_timeout, items)
+
+
+def observe_response(tally_url, operation, request_size, response_size, status_code):
+    tally_request_bytes.observe(request_size, operation=operation, host=tally_url)
+    if response_size is not None:
+        tally_response_bytes.observe(response_size, operation=operation, host=tally_url)
+    if status_code != 200:
+        tally_errors.inc(kind="http_status", operation=operation, host=tally_url)
+
+
+def count_line_errors(tally_url, operation, content: bytes):
+    """Count the LINEERRORs Tally reported for an import."""
+    if operation in WRITE_OPERATIONS and content:
+        line_errors = content.count(b"<LINEERROR>")
+        if line_errors:
+            tally_errors.inc(line_errors, kind="line_error", operation=operation, host=tally_url)
+
+
+@contextmanager
+def request_span(tally_url, operation, company_name, request_size):
+    """
+    Trace one Tally call, from the breaker check through the slot wait to the
+    end of the response, as a CLIENT span. It is not made current: nothing
+    runs beneath it, and a streamed body is parsed by the caller.
+    """
+    span = tracer.start_span("tally.post", kind=CLIENT, attributes={
+        "server.address": tally_url,
+        "tally.operation": operation,
+        "tally.company": company_name or "",
+        "tally.request_bytes": request_size,
+    })
+    try:
+        yield span
+    except BaseException as e:
+        span.record_exception(e)
+        raise
+    finally:
+        span.end()
+
+
+def _note_attempt(span, attempt, started):
+    span.set_attribute("tally.attempts", attempt + 1)
+    span.set_attribute("tally.latency_seconds", round(time.monotonic() - started, 6))
+
+
+def invalidate_after_write(tally_url, operation, company_name, status_code):
+    """Drop cached reports of a company once Tally accepted an import for it."""
+    if operation in WRITE_OPERATIONS and status_code == 200:
+        report_cache.invalidate(tally_url, company_name)
+
+
+class TallyClient:
+    """
+    Long-lived HTTP transport for a single Tally XML server.
+    Keeps a keep-alive connection pool so every post reuses an open socket
+    instead of paying TCP setup and teardown on each call.
+    """
+
+    def __init__(self, tally_url: str, pool_size: int = TALLY_POOL_SIZE,
+                 connect_timeout: float = TALLY_CONNECT_TIMEOUT,
+                 read_timeout: float | None = None):
+        self.tally_url = tally_url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout  # None: adaptive, per operation class
+        self.scheduler = get_host_scheduler(tally_url)
+        self.breaker = get_circuit_breaker(tally_url)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/xml"})
+
+    def _timeout(self, timeout, operation, items=1):
+        """(connect, read) for a call; an explicit timeout argument wins over the policy."""
+        if timeout is _DEFAULT:
+            return (self.connect_timeout,
+                    self.read_timeout or timeout_policy.read_timeout(self.tally_url, operation, items))
+        return timeout
+
+    def _send(self, payload: bytes, timeout, operation, span, stream=False, items=1) -> requests.Response:
+        """
+        Post through the host's circuit breaker. Exports are retried with
+        jittered backoff after a connection failure, unless that failure
+        opened the circuit.
+        """
+        attempts = attempts_for(operation)
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        for attempt in range(attempts):
+            started = time.monotonic()
+            try:
+                with self.breaker.guard():
+                    response = self.session.post(self.tally_url, data=payload, timeout=timeout, stream=stream)
+                record_latency(self.tally_url, operation, read_timeout, started, items=items)
+                _note_attempt(span, attempt, started)
+                return response
+            except requests.exceptions.RequestException as e:
+                record_latency(self.tally_url, operation, read_timeout, started, e, items)
+                _note_attempt(span, attempt, started)
+                if attempt == attempts - 1 or not is_retryable(e):
+                    raise
+            time.sleep(backoff_delay(attempt))
+
+    def post(self, xml_string: str, timeout=_DEFAULT, operation=REPORT_EXPORT,
+             company_name=None, items=1) -> requests.Response:
+        """
+        Send an XML envelope to Tally and return the raw response.
+        The call waits for a slot from the host scheduler first; operation and
+        company_name decide its priority and round-robin lane. While the host's
+        circuit is open it raises TallyUnavailableError without queueing.
+        items is how many objects the envelope carries; it scales the read timeout.
+        """
+        timeout = self._timeout(timeout, operation, items)
+        payload = xml_string.encode("utf-8")
+        with request_span(self.tally_url, operation, company_name, len(payload)) as span:
+            self.breaker.check()
+            queued = time.monotonic()
+            with self.scheduler.slot(company_name, operation):
+                span.set_attribute("tally.queue_seconds", round(time.monotonic() - queued, 6))
+                response = self._send(payload, timeout, operation, span, items=items)
+            span.set_attribute("http.status_code", response.status_code)
+            span.set_attribute("tally.response_bytes", len(response.content))
+        observe_response(self.tally_url, operation, len(payload), len(response.content), response.status_code)
+        count_line_errors(self.tally_url, operation, response.content)
+        invalidate_after_write(self.tally_url, operation, company_name, response.status_code)
+        return response
+
+    @contextmanager
+    def stream(self, xml_string: str, timeout=_DEFAULT, operation=REPORT_EXPORT, company_name=None):
+        """
+        Like post, but yields the response with its body unread so it can be
+        parsed chunk by chunk via iter_content(). The host slot is held until
+        the context exits.
+        """
+        timeout = self._timeout(timeout, operation)
+        payload = xml_string.encode("utf-8")
+        with request_span(self.tally_url, operation, company_name, len(payload)) as span:
+            self.breaker.check()
+            queued = time.monotonic()
+            with self.scheduler.slot(company_name, operation):
+                span.set_attribute("tally.queue_seconds", round(time.monotonic() - queued, 6))
+                response = self._send(payload, timeout, operation, span, stream=True)
+                span.set_attribute("http.status_code", response.status_code)
+                try:
+                    yield response
+                finally:
+                    # Bytes actually pulled off the socket, however much of the body was read
+                    read = getattr(response.raw, "tell", None)
+                    read = read() if read else None
+                    span.set_attribute("tally.response_bytes", read)
+                    observe_response(self.tally_url, operation, len(payload), read, response.status_code)
+                    response.close()
+
+    def close(self):
+        self.session.close()
+
+
+_clients: dict[str, TallyClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_tally_client(tally_url: str) -> TallyClient:
+    """Return the shared client for tally_url, creating it on first use."""
+    client = _clients.get(tally_url)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(tally_url)
+            if client is None:
+                client = TallyClient(tally_url)
+                _clients[tally_url] = client
+    return client
+
+
+def close_all_clients():
+    """Close every pooled connection; called on application shutdown."""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+class AsyncTallyResponse:
+    """Minimal response object mirroring the parts of requests.Response the services use."""
+
+    def __init__(self, status_code: int, headers: dict, content: bytes = b""):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def encoding(self) -> str:
+        content_type = self.headers.get("content-type", "")
+        match = re.search(r"charset=([\w-]+)", content_type, re.IGNORECASE)
+        return match.group(1) if match else "utf-8"
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors="replace")
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error from Tally")
+
+
+class AsyncTallyStreamResponse(AsyncTallyResponse):
+    """Response whose body is read lazily through aiter_bytes()."""
+
+    def __init__(self, status_code: int, headers: dict, body):
+        super().__init__(status_code, headers)
+        self._body = body
+        self.consumed = False
+        self.bytes_read = 0
+
+    async def aiter_bytes(self):
+        async for chunk in self._body:
+            self.bytes_read += len(chunk)
+            yield chunk
+        self.consumed = True
+
+    async def read(self) -> bytes:
+        self.content = b"".join([chunk async for chunk in self.aiter_bytes()])
+        return self.content
+
+
+class AsyncTallyClient:
+    """
+    asyncio counterpart of TallyClient.
+    Speaks HTTP/1.1 over asyncio streams with its own keep-alive pool, so
+    in-flight Tally calls wait on the event loop instead of holding threads.
+    Transport failures are raised as requests exceptions so the services
+    handle both paths with the same except clauses.
+    """
+
+    def __init__(self, tally_url: str, pool_size: int = TALLY_POOL_SIZE,
+                 connect_timeout: float = TALLY_CONNECT_TIMEOUT,
+                 read_timeout: float | None = None):
+        self.tally_url = tally_url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout  # None: adaptive, per operation class
+        self.scheduler = get_host_scheduler(tally_url)
+        self.breaker = get_circuit_breaker(tally_url)
+
+        parts = urlsplit(tally_url)
+        self.scheme = parts.scheme or "http"
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or (443 if self.scheme == "https" else 80)
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def _connect(self, connect_timeout):
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.scheme == "https"),
+                timeout=connect_timeout
+            )
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ConnectTimeout(f"Connection to {self.tally_url} timed out")
+        except OSError as e:
+            raise requests.exceptions.ConnectionError(f"Failed to connect to {self.tally_url}: {e}")
+
+    async def _read(self, awaitable, read_timeout):
+        try:
+            return await asyncio.wait_for(awaitable, timeout=read_timeout)
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ReadTimeout(f"Read from {self.tally_url} timed out")
+
+    async def _read_head(self, reader, read_timeout):
+        status_line = await self._read(reader.readline(), read_timeout)
+        if not status_line:
+            raise ConnectionResetError("Connection closed by Tally")
+        try:
+            status_code = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise requests.exceptions.ConnectionError(f"Malformed status line from Tally: {status_line!r}")
+
+        headers = {}
+        while True:
+            line = await self._read(reader.readline(), read_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if "content-length" not in headers and headers.get("transfer-encoding", "").lower() != "chunked":
+            # Body runs until Tally closes the socket
+            headers["connection"] = "close"
+        return status_code, headers
+
+    async def _iter_body(self, reader, headers, read_timeout):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self._read(reader.readline(), read_timeout)
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    await self._read(reader.readline(), read_timeout)
+                    return
+                remaining = size
+                while remaining:
+                    chunk = await self._read(reader.read(min(remaining, TALLY_STREAM_CHUNK_SIZE)), read_timeout)
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b"", remaining)
+                    remaining -= len(chunk)
+                    yield chunk
+                await self._read(reader.readline(), read_timeout)
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining:
+                chunk = await self._read(reader.read(min(remaining, TALLY_STREAM_CHUNK_SIZE)), read_timeout)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await self._read(reader.read(TALLY_STREAM_CHUNK_SIZE), read_timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _request_bytes(self, xml_string: str) -> bytes:
+        body = xml_string.encode("utf-8")
+        request_head = (
+            f"POST {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/xml\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("latin-1")
+        return request_head + body
+
+    def _take_idle(self):
+        """A pooled socket Tally has not already closed, or None."""
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    async def _send(self, payload: bytes, connect_timeout, read_timeout, operation=REPORT_EXPORT):
+        """
+        Write the request and read the response head, reusing a pooled socket
+        when possible. A pooled socket may have been closed by Tally while
+        idle, so a failure on one is retried once on a fresh socket - but for
+        imports only while the request was not yet fully written: once Tally
+        has the bytes it may have applied them, and sending them again would
+        apply the import twice (the requests transport never retries a POST).
+        """
+        for attempt in range(2):
+            pooled = self._take_idle()
+            reused = pooled is not None
+            reader, writer = pooled if reused else await self._connect(connect_timeout)
+            written = False
+            try:
+                writer.write(payload)
+                await writer.drain()
+                written = True
+                status_code, headers = await self._read_head(reader, read_timeout)
+                return reader, writer, status_code, headers
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if reused and attempt == 0 and (not written or operation in EXPORT_OPERATIONS):
+                    continue
+                raise requests.exceptions.ConnectionError(f"Connection to {self.tally_url} failed: {e}")
+            except BaseException:
+                writer.close()
+                raise
+
+    async def _send_guarded(self, payload: bytes, connect_timeout, read_timeout, operation, span, items=1):
+        """_send through the circuit breaker, retrying exports after a connection failure."""
+        attempts = attempts_for(operation)
+        for attempt in range(attempts):
+            started = time.monotonic()
+            try:
+                with self.breaker.guard():
+                    sent = await self._send(payload, connect_timeout, read_timeout, operation)
+                # Time to the response head: what Tally spent producing the answer
+                record_latency(self.tally_url, operation, read_timeout, started, items=items)
+                _note_attempt(span, attempt, started)
+                return sent
+            except requests.exceptions.RequestException as e:
+                record_latency(self.tally_url, operation, read_timeout, started, e, items)
+                _note_attempt(span, attempt, started)
+                if attempt == attempts - 1 or not is_retryable(e):
+                    raise
+            await asyncio.sleep(backoff_delay(attempt))
+
+    def _finish(self, reader, writer, headers, clean: bool):
+        """Return the socket to the pool if the body was fully read and Tally keeps it open."""
+        if clean and headers.get("connection", "").lower() != "close":
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def _split_timeout(self, timeout, operation, items=1):
+        if timeout is _DEFAULT:
+            timeout = (self.connect_timeout,
+                       self.read_timeout or timeout_policy.read_timeout(self.tally_url, operation, items))
+        return timeout if isinstance(timeout, tuple) else (timeout, timeout)
+
+    async def post(self, xml_string: str, timeout=_DEFAULT, operation=REPORT_EXPORT,
+                   company_name=None, items=1) -> AsyncTallyResponse:
+        """Send an XML envelope to Tally through the host scheduler and return the buffered response."""
+        async with self.stream(xml_string, timeout, operation, company_name, items) as response:
+            await response.read()
+        count_line_errors(self.tally_url, operation, response.content)
+        invalidate_after_write(self.tally_url, operation, company_name, response.status_code)
+        return AsyncTallyResponse(response.status_code, response.headers, response.content)
+
+    @asynccontextmanager
+    async def stream(self, xml_string: str, timeout=_DEFAULT, operation=REPORT_EXPORT, company_name=None, items=1):
+        """
+        Like post, but yields the response before its body is read so it can be
+        parsed chunk by chunk via aiter_bytes(). The host slot is held until the
+        context exits.
+        """
+        connect_timeout, read_timeout = self._split_timeout(timeout, operation, items)
+        payload = self._request_bytes(xml_string)
+
+        with request_span(self.tally_url, operation, company_name, len(payload)) as span:
+            self.breaker.check()
+            queued = time.monotonic()
+            async with self.scheduler.slot_async(company_name, operation), self._slots:
+                span.set_attribute("tally.queue_seconds", round(time.monotonic() - queued, 6))
+                reader, writer, status_code, headers = await self._send_guarded(
+                    payload, connect_timeout, read_timeout, operation, span, items
+                )
+                span.set_attribute("http.status_code", status_code)
+                response = AsyncTallyStreamResponse(status_code, headers, self._iter_body(reader, headers, read_timeout))
+                try:
+                    yield response
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    response.consumed = False
+                    raise requests.exceptions.ConnectionError(f"Connection to {self.tally_url} failed: {e}")
+                finally:
+                    span.set_attribute("tally.response_bytes", response.bytes_read)
+                    observe_response(self.tally_url, operation, len(payload), response.bytes_read, status_code)
+                    self._finish(reader, writer, headers, response.consumed)
+
+    async def aclose(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+_async_clients: dict[tuple[str, int], AsyncTallyClient] = {}
+
+
+def get_async_tally_client(tally_url: str) -> AsyncTallyClient:
+    """Return the shared async client for tally_url on the running event loop."""
+    key = (tally_url, id(asyncio.get_running_loop()))
+    client = _async_clients.get(key)
+    if client is None:
+        client = AsyncTallyClient(tally_url)
+        _async_clients[key] = client
+    return client
+
+
+async def aclose_all_clients():
+    """Close every pooled asyncio connection; called on application shutdown."""
+    for client in list(_async_clients.values()):
+        await client.aclose()
+    _async_clients.clear()
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+import requests
+
+TALLY_MAX_IN_FLIGHT = int(os.getenv("TALLY_MAX_IN_FLIGHT", "2"))
+TALLY_QUEUE_TIMEOUT = float(os.getenv("TALLY_QUEUE_TIMEOUT", "60"))
+
+# Operation classes understood by the scheduler (and the rest of the transport layer)
+MASTER_IMPORT = "master_import"
+VOUCHER_IMPORT = "voucher_import"
+COLLECTION_EXPORT = "collection_export"
+REPORT_EXPORT = "report_export"
+
+# Lower number is served first: writes, then lean collection exports, then heavy reports
+PRIORITIES = {
+    MASTER_IMPORT: 0,
+    VOUCHER_IMPORT: 0,
+    COLLECTION_EXPORT: 1,
+    REPORT_EXPORT: 2,
+}
+PRIORITY_NAMES = {0: "write", 1: "collection_export", 2: "report_export"}
+
+
+class TallyQueueTimeout(requests.exceptions.Timeout):
+    """Raised when a request waits in the host queue longer than TALLY_QUEUE_TIMEOUT."""
+
+
+class _SyncWaiter:
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+    def wake(self):
+        self.granted = True
+        self.event.set()
+
+
+class _AsyncWaiter:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+
+    def wake(self):
+        self.granted = True
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class HostScheduler:
+    """
+    Admission control for one Tally host.
+    At most max_in_flight requests run at once; the rest wait in per-priority
+    queues and are served round-robin across companies within a priority.
+    """
+
+    def __init__(self, tally_url: str, max_in_flight: int = TALLY_MAX_IN_FLIGHT,
+                 queue_timeout: float = TALLY_QUEUE_TIMEOUT):
+        self.tally_url = tally_url
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._queues: dict[int, OrderedDict] = {p: OrderedDict() for p in sorted(set(PRIORITIES.values()))}
+
+    def _enqueue(self, waiter, company_name, operation):
+        """Grant a slot immediately if one is free, otherwise queue the waiter."""
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self.queued:
+                self.in_flight += 1
+                waiter.granted = True
+                return
+            queue = self._queues[PRIORITIES.get(operation, PRIORITIES[REPORT_EXPORT])]
+            queue.setdefault(company_name or "", deque()).append(waiter)
+            self.queued += 1
+
+    def _dequeue(self, waiter):
+        """Remove a waiter that gave up; returns False if it was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            for queue in self._queues.values():
+                for company, waiters in queue.items():
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+                        if not waiters:
+                            del queue[company]
+                        self.queued -= 1
+                        return True
+            return True
+
+    def release(self):
+        with self._lock:
+            for queue in self._queues.values():
+                if queue:
+                    company, waiters = next(iter(queue.items()))
+                    waiter = waiters.popleft()
+                    # Rotate so the next grant at this priority goes to another company
+                    if waiters:
+                        queue.move_to_end(company)
+                    else:
+                        del queue[company]
+                    self.queued -= 1
+                    waiter.wake()
+                    return
+            self.in_flight -= 1
+
+    @contextmanager
+    def slot(self, company_name=None, operation=REPORT_EXPORT):
+        """Block the calling thread until a request slot for this host is free."""
+        waiter = _SyncWaiter()
+        self._enqueue(waiter, company_name, operation)
+        if not waiter.granted and not waiter.event.wait(self.queue_timeout):
+            if self._dequeue(waiter):
+                raise TallyQueueTimeout(f"Timed out waiting in queue for {self.tally_url}")
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, company_name=None, operation=REPORT_EXPORT):
+        """Wait on the event loop until a request slot for this host is free."""
+        waiter = _AsyncWaiter()
+        self._enqueue(waiter, company_name, operation)
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(waiter.future, self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._dequeue(waiter):
+                    raise TallyQueueTimeout(f"Timed out waiting in queue for {self.tally_url}")
+            except asyncio.CancelledError:
+                # Granted while being cancelled: hand the slot straight back
+                if not self._dequeue(waiter):
+                    self.release()
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            by_priority = {}
+            by_company = {}
+            for operation_priority, queue in self._queues.items():
+                by_priority[PRIORITY_NAMES[operation_priority]] = sum(len(w) for w in queue.values())
+                for company, waiters in queue.items():
+                    by_company[company] = by_company.get(company, 0) + len(waiters)
+            return {
+                "tally_url": self.tally_url,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "queued_by_priority": by_priority,
+                "queued_by_company": by_company,
+            }
+
+
+_schedulers: dict[str, HostScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_host_scheduler(tally_url: str) -> HostScheduler:
+    """Return the shared scheduler for tally_url, creating it on first use."""
+    scheduler = _schedulers.get(tally_url)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.get(tally_url)
+            if scheduler is None:
+                scheduler = HostScheduler(tally_url)
+                _schedulers[tally_url] = scheduler
+    return scheduler
+
+
+def queue_depths() -> list[dict]:
+    """Snapshot of in-flight and queued requests for every known Tally host."""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return [scheduler.stats() for scheduler in schedulers]
@@ -0,0 +1,111 @@
+import math
+import os
+import threading
+from collections import deque
+from services.tallyScheduler import COLLECTION_EXPORT, MASTER_IMPORT, REPORT_EXPORT, VOUCHER_IMPORT
+
+# Read-timeout bounds in seconds per operation class, as "min,max". The
+# adaptive timeout stays inside them, and max is used until enough latency
+# samples exist for the host.
+TALLY_TIMEOUT_MASTER_IMPORT = os.getenv("TALLY_TIMEOUT_MASTER_IMPORT", "3,20")
+TALLY_TIMEOUT_VOUCHER_IMPORT = os.getenv("TALLY_TIMEOUT_VOUCHER_IMPORT", "3,30")
+TALLY_TIMEOUT_COLLECTION_EXPORT = os.getenv("TALLY_TIMEOUT_COLLECTION_EXPORT", "15,600")
+TALLY_TIMEOUT_REPORT_EXPORT = os.getenv("TALLY_TIMEOUT_REPORT_EXPORT", "10,180")
+# Read timeout = headroom * recent p99 latency, clamped to the class bounds
+TALLY_TIMEOUT_HEADROOM = float(os.getenv("TALLY_TIMEOUT_HEADROOM", "2"))
+# Latency samples kept per host and class, and how many are needed before adapting
+TALLY_TIMEOUT_WINDOW = int(os.getenv("TALLY_TIMEOUT_WINDOW", "200"))
+TALLY_TIMEOUT_MIN_SAMPLES = int(os.getenv("TALLY_TIMEOUT_MIN_SAMPLES", "20"))
+# Read-timeout ceiling in seconds for an import envelope carrying many objects
+TALLY_TIMEOUT_BULK_MAX = float(os.getenv("TALLY_TIMEOUT_BULK_MAX", "600"))
+
+
+def _bounds(spec: str) -> tuple[float, float]:
+    low, _, high = spec.partition(",")
+    low, high = float(low), float(high or low)
+    return min(low, high), max(low, high)
+
+
+BOUNDS = {
+    MASTER_IMPORT: _bounds(TALLY_TIMEOUT_MASTER_IMPORT),
+    VOUCHER_IMPORT: _bounds(TALLY_TIMEOUT_VOUCHER_IMPORT),
+    COLLECTION_EXPORT: _bounds(TALLY_TIMEOUT_COLLECTION_EXPORT),
+    REPORT_EXPORT: _bounds(TALLY_TIMEOUT_REPORT_EXPORT),
+}
+
+
+def percentile(sorted_samples: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_samples:
+        return 0.0
+    rank = min(len(sorted_samples), max(1, math.ceil(fraction * len(sorted_samples)))) - 1
+    return sorted_samples[rank]
+
+
+class TimeoutPolicy:
+    """
+    Read timeouts per (Tally host, operation class), tuned from the latency
+    of recent successful requests: headroom * p99, clamped to the class
+    bounds. A request that timed out is recorded at its timeout, so a host
+    that slows down pushes its own timeout up, at most to the class maximum.
+
+    Samples are per object imported or exported: a request that carried
+    items objects (a bulk import chunk) is recorded as its latency divided by
+    items, and its timeout is the per-object timeout times items, never less
+    than the class maximum and at most bulk_max. A 100-voucher chunk is not
+    held to the few seconds single-voucher imports have taught the policy.
+    """
+
+    def __init__(self, bounds=None, headroom: float = TALLY_TIMEOUT_HEADROOM,
+                 window: int = TALLY_TIMEOUT_WINDOW, min_samples: int = TALLY_TIMEOUT_MIN_SAMPLES,
+                 bulk_max: float = TALLY_TIMEOUT_BULK_MAX):
+        self.bounds = dict(bounds or BOUNDS)
+        self.headroom = headroom
+        self.window = max(1, window)
+        self.min_samples = max(1, min_samples)
+        self.bulk_max = bulk_max
+        self.lock = threading.Lock()
+        self.samples: dict[tuple[str, str], deque] = {}
+
+    def _class_bounds(self, operation):
+        return self.bounds.get(operation, self.bounds[REPORT_EXPORT])
+
+    def read_timeout(self, tally_url: str, operation, items: int = 1) -> float:
+        low, high = self._class_bounds(operation)
+        with self.lock:
+            samples = self.samples.get((tally_url, operation))
+            if samples is None or len(samples) < self.min_samples:
+                timeout = high
+            else:
+                timeout = min(high, max(low, self.headroom * percentile(sorted(samples), 0.99)))
+        if items > 1:
+            return min(max(high, timeout * items), max(high, self.bulk_max))
+        return timeout
+
+    def record(self, tally_url: str, operation, seconds: float, items: int = 1):
+        seconds /= max(1, items)
+        with self.lock:
+            samples = self.samples.get((tally_url, operation))
+            if samples is None:
+                samples = self.samples[(tally_url, operation)] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def stats(self) -> list[dict]:
+        with self.lock:
+            snapshot = {key: sorted(samples) for key, samples in self.samples.items()}
+        result = []
+        for (tally_url, operation), samples in snapshot.items():
+            low, high = self._class_bounds(operation)
+            result.append({
+                "tally_url": tally_url,
+                "operation": operation,
+                "samples": len(samples),
+                "p95": percentile(samples, 0.95),
+                "p99": percentile(samples, 0.99),
+                "bounds": [low, high],
+                "read_timeout": self.read_timeout(tally_url, operation),
+            })
+        return result
+
+
+timeout_policy = TimeoutPolicy()
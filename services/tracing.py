@@ -0,0 +1,323 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Span exporters, comma separated: "memory" keeps recent traces for
+# /api/tally/traces, "console" writes every finished span to stderr as one
+# JSON line. Empty keeps spans only for log correlation.
+TALLY_TRACE_EXPORTERS = os.getenv("TALLY_TRACE_EXPORTERS", "memory")
+# Finished spans the in-memory exporter keeps; whole traces are evicted oldest first
+TALLY_TRACE_BUFFER = int(os.getenv("TALLY_TRACE_BUFFER", "5000"))
+# Requests slower than this many seconds are logged with their span breakdown; 0 disables
+TALLY_TRACE_SLOW_SECONDS = float(os.getenv("TALLY_TRACE_SLOW_SECONDS", "5"))
+
+UNSET, OK, ERROR = "UNSET", "OK", "ERROR"
+INTERNAL, SERVER, CLIENT = "INTERNAL", "SERVER", "CLIENT"
+
+logger = logging.getLogger("tally.trace")
+
+# Span that new spans are parented to; set while a route or traced function runs
+current_span: ContextVar = ContextVar("current_span", default=None)
+
+_CURRENT = object()
+
+
+class Span:
+    """
+    One timed operation, modelled on the OpenTelemetry span: 128-bit trace id,
+    64-bit span id, parent id, kind, attributes and an UNSET/OK/ERROR status.
+    """
+
+    def __init__(self, name: str, trace_id: str, parent_id=None, kind=INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.status = UNSET
+        self.status_message = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        # True for the first span of a trace in this process, even when an
+        # incoming traceparent gave it a remote parent
+        self.local_root = False
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_exception(self, error: BaseException):
+        self.status = ERROR
+        self.status_message = f"{type(error).__name__}: {error}"
+
+    @property
+    def duration(self) -> float:
+        """Seconds from start to end, or to now while the span is still open."""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            tracer.export(self)
+
+    def to_dict(self) -> dict:
+        """The span in the JSON shape the OpenTelemetry SDK's console exporter prints."""
+        status = {"status_code": self.status}
+        if self.status_message:
+            status["description"] = self.status_message
+        return {
+            "name": self.name,
+            "context": {"trace_id": f"0x{self.trace_id}", "span_id": f"0x{self.span_id}"},
+            "kind": f"SpanKind.{self.kind}",
+            "parent_id": f"0x{self.parent_id}" if self.parent_id else None,
+            "start_time": _iso(self.start_ns),
+            "end_time": _iso(self.end_ns) if self.end_ns else None,
+            "status": status,
+            "attributes": self.attributes,
+        }
+
+
+def _iso(ns: int) -> str:
+    seconds, rest = divmod(ns, 1_000_000_000)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + f".{rest // 1000:06d}Z"
+
+
+class ConsoleExporter:
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            stream = self.stream or sys.stderr
+            stream.write(line + "\n")
+            stream.flush()
+
+
+class InMemoryExporter:
+    """Keeps the spans of recent traces, grouped by trace id, for offline inspection."""
+
+    def __init__(self, max_spans: int = TALLY_TRACE_BUFFER):
+        self.max_spans = max(1, max_spans)
+        self.lock = threading.Lock()
+        self.traces: OrderedDict[str, list[Span]] = OrderedDict()
+        self.size = 0
+
+    def export(self, span: Span):
+        with self.lock:
+            spans = self.traces.get(span.trace_id)
+            if spans is None:
+                spans = self.traces[span.trace_id] = []
+            spans.append(span)
+            self.size += 1
+            while self.size > self.max_spans and len(self.traces) > 1:
+                _, evicted = self.traces.popitem(last=False)
+                self.size -= len(evicted)
+
+    def spans(self, trace_id: str) -> list[Span]:
+        with self.lock:
+            return list(self.traces.get(trace_id, ()))
+
+    def recent(self, limit: int = 50) -> list[dict]:
+        """Newest traces first: root span name, duration, status and span count."""
+        with self.lock:
+            latest = list(self.traces.items())[-limit:] if limit > 0 else []
+        summaries = []
+        for trace_id, spans in reversed(latest):
+            root = _root(spans)
+            summaries.append({
+                "trace_id": trace_id,
+                "name": root.name,
+                "start_time": _iso(root.start_ns),
+                "duration_ms": round(root.duration * 1000, 3),
+                "status": root.status,
+                "spans": len(spans),
+            })
+        return summaries
+
+
+def _root(spans: list[Span]) -> Span:
+    return next((s for s in spans if s.local_root), min(spans, key=lambda s: s.start_ns))
+
+
+def span_tree(spans: list[Span]) -> list[dict]:
+    """
+    Nest spans under their parents. Each node carries its offset from the start
+    of the trace and its self time: its duration minus what its children took.
+    """
+    if not spans:
+        return []
+    origin = min(s.start_ns for s in spans)
+    ids = {s.span_id for s in spans}
+    children: dict = {}
+    for span in sorted(spans, key=lambda s: s.start_ns):
+        parent = span.parent_id if span.parent_id in ids else None
+        children.setdefault(parent, []).append(span)
+
+    def node(span):
+        kids = [node(child) for child in children.get(span.span_id, ())]
+        duration_ms = span.duration * 1000
+        return {
+            "name": span.name,
+            "span_id": span.span_id,
+            "kind": span.kind,
+            "offset_ms": round((span.start_ns - origin) / 1e6, 3),
+            "duration_ms": round(duration_ms, 3),
+            "self_ms": round(max(0.0, duration_ms - sum(k["duration_ms"] for k in kids)), 3),
+            "status": span.status,
+            **({"error": span.status_message} if span.status_message else {}),
+            "attributes": span.attributes,
+            "children": kids,
+        }
+
+    return [node(span) for span in children.get(None, ())]
+
+
+def breakdown(spans: list[Span]) -> list[dict]:
+    """Self time summed per span name, largest first: where a slow request spent its time."""
+    totals: dict = {}
+
+    def walk(nodes):
+        for n in nodes:
+            entry = totals.setdefault(n["name"], {"name": n["name"], "count": 0, "self_ms": 0.0})
+            entry["count"] += 1
+            entry["self_ms"] += n["self_ms"]
+            walk(n["children"])
+
+    walk(span_tree(spans))
+    return sorted(({**e, "self_ms": round(e["self_ms"], 3)} for e in totals.values()),
+                  key=lambda e: e["self_ms"], reverse=True)
+
+
+class Tracer:
+    def __init__(self, exporters=(), slow_seconds: float = TALLY_TRACE_SLOW_SECONDS):
+        self.exporters = list(exporters)
+        self.slow_seconds = slow_seconds
+        self.memory = next((e for e in self.exporters if isinstance(e, InMemoryExporter)), None)
+
+    def start_span(self, name: str, kind=INTERNAL, attributes=None, parent=_CURRENT,
+                   trace_id=None, parent_id=None) -> Span:
+        """
+        Start a span without making it current. It is a child of parent (the
+        current span by default); parent=None starts a new trace, continuing
+        trace_id/parent_id when they came from an incoming traceparent.
+        """
+        if parent is _CURRENT:
+            parent = current_span.get()
+        if parent is not None:
+            return Span(name, parent.trace_id, parent.span_id, kind, attributes)
+        span = Span(name, trace_id or f"{random.getrandbits(128):032x}", parent_id, kind, attributes)
+        span.local_root = True
+        return span
+
+    @contextmanager
+    def span(self, name: str, kind=INTERNAL, attributes=None, parent=_CURRENT, trace_id=None, parent_id=None):
+        """Run a block as the current span; an exception marks it ERROR and propagates."""
+        span = self.start_span(name, kind, attributes, parent, trace_id, parent_id)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            # Ended while still current, so a slow-request log line carries its trace id
+            span.end()
+            current_span.reset(token)
+
+    def export(self, span: Span):
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                logger.exception("Span exporter %s failed", type(exporter).__name__)
+        if span.local_root and self.slow_seconds and span.duration >= self.slow_seconds:
+            self._log_slow(span)
+
+    def _log_slow(self, root: Span):
+        parts = ""
+        if self.memory is not None:
+            top = breakdown(self.memory.spans(root.trace_id))[:6]
+            parts = ": " + ", ".join(f"{e['name']} x{e['count']} {e['self_ms'] / 1000:.2f}s" for e in top)
+        logger.warning("Slow %s took %.2fs (trace %s)%s", root.name, root.duration, root.trace_id, parts)
+
+
+def _exporters(spec: str) -> list:
+    exporters = []
+    for name in (part.strip().lower() for part in spec.split(",")):
+        if name == "memory":
+            exporters.append(InMemoryExporter())
+        elif name == "console":
+            exporters.append(ConsoleExporter())
+        elif name:
+            raise ValueError(f"Unknown TALLY_TRACE_EXPORTERS entry: {name}. Use 'memory' or 'console'.")
+    return exporters
+
+
+tracer = Tracer(_exporters(TALLY_TRACE_EXPORTERS))
+
+
+def traced(name=None):
+    """Decorator: run a function (sync or async) as a span named after it."""
+    def decorate(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def parse_traceparent(header):
+    """(trace_id, parent span id) from a W3C traceparent header, or (None, None) if it is absent or invalid."""
+    parts = (header or "").strip().lower().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        if int(parts[1], 16) == 0 or int(parts[2], 16) == 0:
+            return None, None
+    except ValueError:
+        return None, None
+    return parts[1], parts[2]
+
+
+def traceparent(span: Span) -> str:
+    return f"00-{span.trace_id}-{span.span_id}-01"
+
+
+def install_log_correlation():
+    """
+    Stamp every log record with trace_id and span_id of the current span ("-"
+    outside one), so log formats can include %(trace_id)s. Safe to call twice.
+    """
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "traced", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        span = current_span.get()
+        record.trace_id = span.trace_id if span else "-"
+        record.span_id = span.span_id if span else "-"
+        return record
+
+    record_factory.traced = True
+    logging.setLogRecordFactory(record_factory)
@@ -1,16 +1,119 @@
 import requests
 import xml.etree.ElementTree as ET
 import json
+import logging
+import os
+import base64
+from datetime import datetime
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import REPORT_EXPORT
+from services.reportCache import report_cache
+from services.singleFlight import report_flights
+from services.snapshotStore import snapshot_store, validate_period
+from services.slicedExport import date_windows, iter_sliced, aiter_sliced
+from services.xmlStream import TALLY_STREAM_CHUNK_SIZE, iter_rows, aiter_rows
+from services.metrics import observe_build
+
+logger = logging.getLogger(__name__)
+
+# Repeating sibling tags that together make one transaction row
+ROW_TAGS = ("DSPVCHDATE", "DSPVCHLEDACCOUNT", "DSPVCHTYPE", "DSPVCHDRAMT", "DSPVCHCRAMT")
+
+# Rows per page when a cursor is given without a limit
+TALLY_LEDGER_PAGE_SIZE = int(os.getenv("TALLY_LEDGER_PAGE_SIZE", "500"))
+
+
+def _row_date(value) -> str | None:
+    """1-Apr-25 (as Ledger Vouchers prints it) -> 20250401; None if unparseable."""
+    for fmt in ("%d-%b-%y", "%d-%b-%Y", "%Y%m%d"):
+        try:
+            return datetime.strptime(str(value).strip(), fmt).strftime("%Y%m%d")
+        except ValueError:
+            continue
+    return None
+
+
+def encode_cursor(date, skip) -> str:
+    return base64.urlsafe_b64encode(json.dumps([date, skip]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor) -> tuple:
+    """Return (date, skip) for a cursor; (None, 0) starts from the beginning."""
+    if not cursor:
+        return None, 0
+    try:
+        date, skip = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(skip, int) or skip < 0 or not (date is None or isinstance(date, str)):
+        raise ValueError("Invalid cursor")
+    return date, skip
+
+
+class CursorPage:
+    """
+    Collects one page of date-ordered transactions after a cursor.
+
+    A cursor is the date of the last row handed out plus how many rows of
+    that date were already seen, so the next page can ask Tally to start at
+    that date (SVFROMDATE) instead of re-exporting everything before it.
+    Feed rows with accept() until it returns False; taken tells whether the
+    last row belongs to the page. With collect=False the page rows are not
+    kept, for callers that pass them straight on.
+    """
+
+    def __init__(self, cursor=None, limit=None, collect=True):
+        self.start_date, self.skip = decode_cursor(cursor)
+        self.limit = TALLY_LEDGER_PAGE_SIZE if limit is None else limit
+        if self.limit < 1:
+            raise ValueError("limit must be at least 1")
+        self.collect = collect
+        self.rows = []
+        self.count = 0
+        self.taken = False
+        self.next_cursor = None
+        self._date, self._run, self._last = self.start_date, 0, None
+
+    def accept(self, row) -> bool:
+        self.taken = False
+        date = _row_date(row.get("date")) or self._date
+        if date != self._date:
+            self._date, self._run = date, 0
+        self._run += 1
+        if self.start_date is not None and date is not None and date < self.start_date:
+            return True
+        if date == self.start_date and self._run <= self.skip:
+            return True
+        if self.count == self.limit:
+            self.next_cursor = encode_cursor(*self._last)
+            return False
+        if self.collect:
+            self.rows.append(row)
+        self.count += 1
+        self.taken = True
+        self._last = (self._date, self._run)
+        return True
+
+    def from_date(self, from_date=None):
+        """The SVFROMDATE to request: the later of from_date and the cursor's date."""
+        return max(filter(None, (from_date, self.start_date)), default=None)
 
 
 class TallyLedgerFetcher:
     def __init__(self, tally_url: str):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
         
-    def _get_ledger_vouchers_xml(self,company_name:str,ledger_name: str) -> str:
+    @observe_build
+    def _get_ledger_vouchers_xml(self,company_name:str,ledger_name: str, from_date=None, to_date=None) -> str:
         """
-        Creates XML request to fetch all transactions for a specific ledger.
+        Creates XML request to fetch all transactions for a specific ledger,
+        limited to SVFROMDATE..SVTODATE when a period is given.
         """
+        period_xml = "".join(
+            f"\n                    <{tag}>{value}</{tag}>"
+            for tag, value in (("SVFROMDATE", from_date), ("SVTODATE", to_date)) if value
+        )
         return f"""
 <ENVELOPE>
     <HEADER>
@@ -22,7 +125,7 @@ class TallyLedgerFetcher:
                 <REPORTNAME>Ledger Vouchers</REPORTNAME>
                 <STATICVARIABLES>
                     <SVCURRENTCOMPANY>{company_name}</SVCURRENTCOMPANY>
-                    <LEDGERNAME>{ledger_name}</LEDGERNAME>
+                    <LEDGERNAME>{ledger_name}</LEDGERNAME>{period_xml}
                     <SVEXPORTFORMAT>$$SysName:XML</SVEXPORTFORMAT>
                 </STATICVARIABLES>
             </REQUESTDESC>
@@ -36,58 +139,350 @@ class TallyLedgerFetcher:
         Send request to Tally and fetch ledger vouchers XML.
         """
         xml_request = self._get_ledger_vouchers_xml(company_name,ledger_name)
-        headers = {"Content-Type": "application/xml"}
+        try:
+            response = self.client.post(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            )
+            if response.status_code == 200:
+                return response.text
+            else:
+                logger.warning("Error from Tally: %s %s", response.status_code, response.text)
+                return None
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to communicate with Tally server: %s", e)
+            return None
 
+    async def fetch_ledger_vouchers_async(self, company_name:str,ledger_name: str) -> str | None:
+        """
+        Async variant of fetch_ledger_vouchers.
+        """
+        xml_request = self._get_ledger_vouchers_xml(company_name,ledger_name)
         try:
-            response = requests.post(
-                self.tally_url, 
-                data=xml_request.encode("utf-8"), 
-                headers=headers, 
-                timeout=10
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
             )
             if response.status_code == 200:
                 return response.text
             else:
-                print("Error from Tally:", response.status_code, response.text)
+                logger.warning("Error from Tally: %s %s", response.status_code, response.text)
                 return None
         except requests.exceptions.RequestException as e:
-            print("Failed to communicate with Tally server:", e)
+            logger.warning("Failed to communicate with Tally server: %s", e)
             return None
 
+    def build_transaction(self, date, account, vch_type, dr_amount, cr_amount) -> dict:
+        """
+        Turn one row of repeating DSPVCH* elements into a transaction dict.
+        """
+        return {
+            "date": date.text,
+            "ledger": account.text,
+            "voucher_type": vch_type.text,
+            "debit": dr_amount.text if dr_amount.text else "0",
+            "credit": cr_amount.text if cr_amount.text else "0",
+        }
+
+    def iter_transactions(self, chunks, encoding="utf-8"):
+        """
+        Yield transactions from Ledger Vouchers XML chunks as each row completes.
+        """
+        for row in iter_rows(chunks, ROW_TAGS, encoding, report="ledger_vouchers"):
+            yield self.build_transaction(*row)
+
+    async def aiter_transactions(self, chunks, encoding="utf-8"):
+        """
+        Async variant of iter_transactions.
+        """
+        async for row in aiter_rows(chunks, ROW_TAGS, encoding, report="ledger_vouchers"):
+            yield self.build_transaction(*row)
+
     def parse_vouchers(self, xml_response: str) -> list[dict]:
         """
         Parse XML response and return a list of transactions in JSON-like dicts.
         """
         transactions = []
         try:
-            root = ET.fromstring(xml_response)
-            # Iterate over repeating tags
-            dates = root.findall("DSPVCHDATE")
-            accounts = root.findall("DSPVCHLEDACCOUNT")
-            types = root.findall("DSPVCHTYPE")
-            dr_amounts = root.findall("DSPVCHDRAMT")
-            cr_amounts = root.findall("DSPVCHCRAMT")
-
-            for i in range(len(dates)):
-                transaction = {
-                    "date": dates[i].text,
-                    "ledger": accounts[i].text,
-                    "voucher_type": types[i].text,
-                    "debit": dr_amounts[i].text if dr_amounts[i].text else "0",
-                    "credit": cr_amounts[i].text if cr_amounts[i].text else "0",
-                }
+            for transaction in self.iter_transactions([xml_response]):
                 transactions.append(transaction)
         except ET.ParseError as e:
-            print("Error parsing XML:", e)
+            logger.warning("Error parsing XML: %s", e)
+
+        return transactions
+
+    def get_ledger_transactions(self, company_name: str, ledger_name: str,
+                                  from_date=None, to_date=None) -> list[dict]:
+        """
+        Fetch transactions for a ledger and return list of dicts, parsing the
+        response while it streams in.
+        """
+        validate_period(from_date, to_date)
+        params = {"ledger_name": ledger_name, "from_date": from_date, "to_date": to_date}
+        hit, snapshot = snapshot_store.get(self.tally_url, company_name, "ledger_vouchers", params)
+        if hit:
+            return snapshot
+        key = report_cache.key(self.tally_url, company_name, "ledger_vouchers", **params)
+        hit, cached = report_cache.get(key)
+        if hit:
+            return cached
+        return report_flights.do(
+            key + (report_cache.generation(self.tally_url, company_name),),
+            lambda: self._load_ledger_transactions(company_name, key, params)
+        )
 
+    def _load_ledger_transactions(self, company_name: str, key, params):
+        """
+        Fetch and parse one ledger's vouchers; shared by every coalesced caller.
+        """
+        generation = report_cache.generation(self.tally_url, company_name)
+        xml_request = self._get_ledger_vouchers_xml(
+            company_name, params["ledger_name"], params["from_date"], params["to_date"]
+        )
+        transactions = []
+        try:
+            with self.client.stream(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            ) as response:
+                if response.status_code != 200:
+                    logger.warning("Error from Tally: %s %s", response.status_code, response.text)
+                    return []
+                chunks = response.iter_content(TALLY_STREAM_CHUNK_SIZE)
+                for transaction in self.iter_transactions(chunks, response.encoding or "utf-8"):
+                    transactions.append(transaction)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to communicate with Tally server: %s", e)
+            return []
+        except ET.ParseError as e:
+            logger.warning("Error parsing XML: %s", e)
+            return transactions
+        report_cache.put(key, transactions, generation)
+        snapshot_store.put(self.tally_url, company_name, "ledger_vouchers", params, transactions)
         return transactions
 
-    def get_ledger_transactions(self, company_name: str, ledger_name: str) -> list[dict]:
+    async def get_ledger_transactions_async(self, company_name: str, ledger_name: str,
+                                        from_date=None, to_date=None) -> list[dict]:
         """
-        Fetch transactions for a ledger and return list of dicts.
+        Async variant of get_ledger_transactions.
         """
-        xml_response = self.fetch_ledger_vouchers(company_name, ledger_name)
-        if xml_response:
-            return self.parse_vouchers(xml_response)
-        return []
+        validate_period(from_date, to_date)
+        params = {"ledger_name": ledger_name, "from_date": from_date, "to_date": to_date}
+        hit, snapshot = await snapshot_store.get_async(self.tally_url, company_name, "ledger_vouchers", params)
+        if hit:
+            return snapshot
+        key = report_cache.key(self.tally_url, company_name, "ledger_vouchers", **params)
+        hit, cached = report_cache.get(key)
+        if hit:
+            return cached
+        return await report_flights.do_async(
+            key + (report_cache.generation(self.tally_url, company_name),),
+            lambda: self._load_ledger_transactions_async(company_name, key, params)
+        )
 
+    async def _load_ledger_transactions_async(self, company_name: str, key, params):
+        """
+        Async variant of _load_ledger_transactions.
+        """
+        generation = report_cache.generation(self.tally_url, company_name)
+        xml_request = self._get_ledger_vouchers_xml(
+            company_name, params["ledger_name"], params["from_date"], params["to_date"]
+        )
+        transactions = []
+        try:
+            async with get_async_tally_client(self.tally_url).stream(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            ) as response:
+                if response.status_code != 200:
+                    await response.read()
+                    logger.warning("Error from Tally: %s %s", response.status_code, response.text)
+                    return []
+                async for transaction in self.aiter_transactions(response.aiter_bytes(), response.encoding):
+                    transactions.append(transaction)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to communicate with Tally server: %s", e)
+            return []
+        except ET.ParseError as e:
+            logger.warning("Error parsing XML: %s", e)
+            return transactions
+        report_cache.put(key, transactions, generation)
+        await snapshot_store.put_async(self.tally_url, company_name, "ledger_vouchers", params, transactions)
+        return transactions
+
+    def _cached_transactions(self, company_name: str, params: dict):
+        """Return (hit, rows) from the snapshot store or report cache without calling Tally."""
+        hit, rows = snapshot_store.get(self.tally_url, company_name, "ledger_vouchers", params)
+        if hit:
+            return hit, rows
+        return report_cache.get(report_cache.key(self.tally_url, company_name, "ledger_vouchers", **params))
+
+    async def _cached_transactions_async(self, company_name: str, params: dict):
+        """Async variant of _cached_transactions; the snapshot read runs off the event loop."""
+        hit, rows = await snapshot_store.get_async(self.tally_url, company_name, "ledger_vouchers", params)
+        if hit:
+            return hit, rows
+        return report_cache.get(report_cache.key(self.tally_url, company_name, "ledger_vouchers", **params))
+
+    def iter_ledger_transactions(self, company_name: str, ledger_name: str, from_date=None, to_date=None):
+        """
+        Yield a ledger's transactions straight off the Tally response, without
+        buffering or caching them. Closing the generator early drops the export.
+        """
+        validate_period(from_date, to_date)
+        xml_request = self._get_ledger_vouchers_xml(company_name, ledger_name, from_date, to_date)
+        try:
+            with self.client.stream(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            ) as response:
+                if response.status_code != 200:
+                    raise Exception(f"Tally returned {response.status_code}: {response.text}")
+                chunks = response.iter_content(TALLY_STREAM_CHUNK_SIZE)
+                yield from self.iter_transactions(chunks, response.encoding or "utf-8")
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to communicate with Tally server: {e}")
+        except ET.ParseError as e:
+            raise Exception(f"Error parsing XML: {e}")
+
+    async def aiter_ledger_transactions(self, company_name: str, ledger_name: str, from_date=None, to_date=None):
+        """
+        Async variant of iter_ledger_transactions.
+        """
+        validate_period(from_date, to_date)
+        xml_request = self._get_ledger_vouchers_xml(company_name, ledger_name, from_date, to_date)
+        try:
+            async with get_async_tally_client(self.tally_url).stream(
+                xml_request, operation=REPORT_EXPORT, company_name=company_name
+            ) as response:
+                if response.status_code != 200:
+                    await response.read()
+                    raise Exception(f"Tally returned {response.status_code}: {response.text}")
+                async for transaction in self.aiter_transactions(response.aiter_bytes(), response.encoding):
+                    yield transaction
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to communicate with Tally server: {e}")
+        except ET.ParseError as e:
+            raise Exception(f"Error parsing XML: {e}")
+
+    def get_ledger_transactions_page(self, company_name: str, ledger_name: str, from_date=None, to_date=None,
+                                     cursor=None, limit=None) -> tuple[list[dict], str | None]:
+        """
+        Return (transactions, next_cursor) for one page of a ledger. A cached
+        full result is sliced; otherwise Tally is asked to export from the
+        cursor's date on and the response is dropped once the page is full.
+        """
+        validate_period(from_date, to_date)
+        page = CursorPage(cursor, limit)
+        params = {"ledger_name": ledger_name, "from_date": from_date, "to_date": to_date}
+        hit, cached = self._cached_transactions(company_name, params)
+        if hit:
+            rows = iter(cached)
+        else:
+            rows = self.iter_ledger_transactions(company_name, ledger_name, page.from_date(from_date), to_date)
+        try:
+            for row in rows:
+                if not page.accept(row):
+                    break
+        finally:
+            if not hit:
+                rows.close()
+        return page.rows, page.next_cursor
+
+    async def get_ledger_transactions_page_async(self, company_name: str, ledger_name: str, from_date=None,
+                                                 to_date=None, cursor=None, limit=None) -> tuple[list[dict], str | None]:
+        """
+        Async variant of get_ledger_transactions_page.
+        """
+        validate_period(from_date, to_date)
+        page = CursorPage(cursor, limit)
+        params = {"ledger_name": ledger_name, "from_date": from_date, "to_date": to_date}
+        hit, cached = await self._cached_transactions_async(company_name, params)
+        if hit:
+            for row in cached:
+                if not page.accept(row):
+                    break
+            return page.rows, page.next_cursor
+        rows = self.aiter_ledger_transactions(company_name, ledger_name, page.from_date(from_date), to_date)
+        try:
+            async for row in rows:
+                if not page.accept(row):
+                    break
+        finally:
+            await rows.aclose()
+        return page.rows, page.next_cursor
+
+    def _load_window(self, company_name: str, ledger_name: str, from_date: str, to_date: str) -> list[dict]:
+        """
+        One slice of a sliced export. Failures raise so the slice can be
+        retried; results are cached per window, so closed months come from
+        their snapshots on the next pull.
+        """
+        params = {"ledger_name": ledger_name, "from_date": from_date, "to_date": to_date}
+        hit, cached = self._cached_transactions(company_name, params)
+        if hit:
+            return cached
+        generation = report_cache.generation(self.tally_url, company_name)
+        transactions = list(self.iter_ledger_transactions(company_name, ledger_name, from_date, to_date))
+        report_cache.put(report_cache.key(self.tally_url, company_name, "ledger_vouchers", **params),
+                         transactions, generation)
+        snapshot_store.put(self.tally_url, company_name, "ledger_vouchers", params, transactions)
+        return transactions
+
+    async def _load_window_async(self, company_name: str, ledger_name: str, from_date: str, to_date: str) -> list[dict]:
+        """
+        Async variant of _load_window.
+        """
+        params = {"ledger_name": ledger_name, "from_date": from_date, "to_date": to_date}
+        hit, cached = await self._cached_transactions_async(company_name, params)
+        if hit:
+            return cached
+        generation = report_cache.generation(self.tally_url, company_name)
+        transactions = [
+            transaction async for transaction in
+            self.aiter_ledger_transactions(company_name, ledger_name, from_date, to_date)
+        ]
+        report_cache.put(report_cache.key(self.tally_url, company_name, "ledger_vouchers", **params),
+                         transactions, generation)
+        await snapshot_store.put_async(self.tally_url, company_name, "ledger_vouchers", params, transactions)
+        return transactions
+
+    def iter_ledger_transactions_sliced(self, company_name: str, ledger_name: str, from_date: str, to_date: str):
+        """
+        Yield a ledger's transactions for from_date..to_date, exported as
+        date windows fetched in parallel and handed out in date order.
+        """
+        validate_period(from_date, to_date)
+        windows = date_windows(from_date, to_date)
+        for _, transactions in iter_sliced(
+            windows, lambda start, end: self._load_window(company_name, ledger_name, start, end)
+        ):
+            yield from transactions
+
+    async def aiter_ledger_transactions_sliced(self, company_name: str, ledger_name: str, from_date: str, to_date: str):
+        """
+        Async variant of iter_ledger_transactions_sliced.
+        """
+        validate_period(from_date, to_date)
+        windows = date_windows(from_date, to_date)
+        slices = aiter_sliced(
+            windows, lambda start, end: self._load_window_async(company_name, ledger_name, start, end)
+        )
+        try:
+            async for _, transactions in slices:
+                for transaction in transactions:
+                    yield transaction
+        finally:
+            await slices.aclose()
+
+    def get_ledger_transactions_sliced(self, company_name: str, ledger_name: str,
+                                       from_date: str, to_date: str) -> list[dict]:
+        """
+        Fetch a long date range as parallel date-window exports and merge them in date order.
+        """
+        return list(self.iter_ledger_transactions_sliced(company_name, ledger_name, from_date, to_date))
+
+    async def get_ledger_transactions_sliced_async(self, company_name: str, ledger_name: str,
+                                                   from_date: str, to_date: str) -> list[dict]:
+        """
+        Async variant of get_ledger_transactions_sliced.
+        """
+        return [
+            transaction async for transaction in
+            self.aiter_ledger_transactions_sliced(company_name, ledger_name, from_date, to_date)
+        ]
@@ -1,21 +1,40 @@
 import requests
 import xml.etree.ElementTree as ET
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import REPORT_EXPORT
+from services.reportCache import report_cache
+from services.singleFlight import report_flights
+from services.snapshotStore import snapshot_store, validate_period
+from services.xmlStream import TALLY_STREAM_CHUNK_SIZE, iter_rows, aiter_rows
+from services.metrics import observe_build
+from services.tracing import traced
+
+# Sibling elements that together make one trial balance row
+ROW_TAGS = ("DSPACCNAME", "DSPACCINFO")
 
 class TallyTrialBalanceManager:
     def __init__(self, tally_url: str):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
         self.required_fields = ["company_name"]
-        self.all_fields = ["company_name"]
+        self.all_fields = ["company_name", "from_date", "to_date"]
 
+    @traced()
     def validate_input(self, data: dict):
         """Validate required input before making request."""
         for field in self.required_fields:
             if field not in data or not data[field]:
                 raise ValueError(f"Missing required field: {field}")
+        validate_period(data.get("from_date"), data.get("to_date"))
         return True
 
+    @observe_build
     def build_xml(self, data: dict):
-        """Builds the XML for Trial Balance request."""
+        """Builds the XML for Trial Balance request, optionally for a SVFROMDATE/SVTODATE period."""
+        period_xml = "".join(
+            f"\n                    <{tag}>{data[field]}</{tag}>"
+            for tag, field in (("SVFROMDATE", "from_date"), ("SVTODATE", "to_date")) if data.get(field)
+        )
         return f"""
 <ENVELOPE>
     <HEADER>
@@ -28,7 +47,7 @@ class TallyTrialBalanceManager:
                 <STATICVARIABLES>
                     <SVCURRENTCOMPANY>{data['company_name']}</SVCURRENTCOMPANY>
                     <SVEXPORTFORMAT>$$SysName:XML</SVEXPORTFORMAT>
-                    <EXPLODEFLAG>Yes</EXPLODEFLAG>
+                    <EXPLODEFLAG>Yes</EXPLODEFLAG>{period_xml}
                 </STATICVARIABLES>
             </REQUESTDESC>
         </EXPORTDATA>
@@ -36,15 +55,11 @@ class TallyTrialBalanceManager:
 </ENVELOPE>
 """.strip()
 
-    def post_to_tally(self, xml_string):
+    def post_to_tally(self, xml_string, company_name=None):
         """Send XML to Tally and return response text."""
-        headers = {"Content-Type": "application/xml"}
         try:
-            response = requests.post(
-                self.tally_url,
-                data=xml_string.encode("utf-8"),
-                headers=headers,
-                timeout=10
+            response = self.client.post(
+                xml_string, operation=REPORT_EXPORT, company_name=company_name
             )
             if response.status_code == 200:
                 return response.text
@@ -53,36 +68,121 @@ class TallyTrialBalanceManager:
         except requests.exceptions.RequestException as e:
             raise Exception(f"Failed to communicate with Tally server: {e}")
 
-    def parse_response(self, xml_string):
-        """Parses Trial Balance XML into JSON list."""
+    async def post_to_tally_async(self, xml_string, company_name=None):
+        """Send XML to Tally over the async transport and return response text."""
         try:
-            root = ET.fromstring(xml_string)
-            data = []
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=REPORT_EXPORT, company_name=company_name
+            )
+            if response.status_code == 200:
+                return response.text
+            else:
+                raise Exception(f"Tally returned {response.status_code}: {response.text}")
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to communicate with Tally server: {e}")
 
-            acc_names = root.findall(".//DSPACCNAME/DSPDISPNAME")
-            acc_infos = root.findall(".//DSPACCINFO")
+    def build_row(self, name_elem, info_elem) -> dict:
+        """Turn one DSPACCNAME/DSPACCINFO pair into a trial balance row."""
+        disp_name = name_elem.find("DSPDISPNAME")
+        ledger_name = disp_name.text.strip() if disp_name is not None and disp_name.text else ""
+        debit_elem = info_elem.find(".//DSPCLDRAMTA")
+        credit_elem = info_elem.find(".//DSPCLCRAMTA")
 
-            for name_elem, info_elem in zip(acc_names, acc_infos):
-                ledger_name = name_elem.text.strip() if name_elem.text else ""
-                debit_elem = info_elem.find(".//DSPCLDRAMTA")
-                credit_elem = info_elem.find(".//DSPCLCRAMTA")
+        debit = debit_elem.text.strip() if debit_elem is not None and debit_elem.text else "0"
+        credit = credit_elem.text.strip() if credit_elem is not None and credit_elem.text else "0"
 
-                debit = debit_elem.text.strip() if debit_elem is not None and debit_elem.text else "0"
-                credit = credit_elem.text.strip() if credit_elem is not None and credit_elem.text else "0"
+        return {
+            "ledger_name": ledger_name,
+            "debit": float(debit) if debit else 0.0,
+            "credit": float(credit) if credit else 0.0
+        }
 
-                data.append({
-                    "ledger_name": ledger_name,
-                    "debit": float(debit) if debit else 0.0,
-                    "credit": float(credit) if credit else 0.0
-                })
+    def parse_stream(self, chunks, encoding="utf-8"):
+        """Parses Trial Balance XML chunks into JSON list as they arrive."""
+        try:
+            return [self.build_row(*row) for row in iter_rows(chunks, ROW_TAGS, encoding, report="trial_balance")]
+        except ET.ParseError as e:
+            raise Exception(f"Error parsing XML: {e}")
 
-            return data
+    async def parse_stream_async(self, chunks, encoding="utf-8"):
+        """Async variant of parse_stream for an async iterable of chunks."""
+        try:
+            return [self.build_row(*row) async for row in aiter_rows(chunks, ROW_TAGS, encoding, report="trial_balance")]
         except ET.ParseError as e:
             raise Exception(f"Error parsing XML: {e}")
 
+    def parse_response(self, xml_string):
+        """Parses Trial Balance XML into JSON list."""
+        return self.parse_stream([xml_string])
+
     def get_trial_balance(self, data: dict):
-        """Validate, build request, fetch from Tally, and parse JSON."""
+        """
+        Validate, build request, fetch from Tally, and parse JSON while the response streams in.
+        Served from the report cache until it expires or the company is written to.
+        """
+        self.validate_input(data)
+        params = {"from_date": data.get("from_date"), "to_date": data.get("to_date")}
+        hit, snapshot = snapshot_store.get(self.tally_url, data["company_name"], "trial_balance", params)
+        if hit:
+            return snapshot
+        key = report_cache.key(self.tally_url, data["company_name"], "trial_balance", **params)
+        hit, cached = report_cache.get(key)
+        if hit:
+            return cached
+        return report_flights.do(
+            key + (report_cache.generation(self.tally_url, data["company_name"]),),
+            lambda: self._load_trial_balance(data, key, params)
+        )
+
+    def _load_trial_balance(self, data: dict, key, params):
+        """Fetch and parse the report from Tally; runs once for all coalesced callers."""
+        generation = report_cache.generation(self.tally_url, data["company_name"])
+        xml_request = self.build_xml(data)
+        try:
+            with self.client.stream(
+                xml_request, operation=REPORT_EXPORT, company_name=data["company_name"]
+            ) as response:
+                if response.status_code != 200:
+                    raise Exception(f"Tally returned {response.status_code}: {response.text}")
+                result = self.parse_stream(
+                    response.iter_content(TALLY_STREAM_CHUNK_SIZE), response.encoding or "utf-8"
+                )
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to communicate with Tally server: {e}")
+        report_cache.put(key, result, generation)
+        snapshot_store.put(self.tally_url, data["company_name"], "trial_balance", params, result)
+        return result
+
+    async def get_trial_balance_async(self, data: dict):
+        """Async variant of get_trial_balance."""
         self.validate_input(data)
+        params = {"from_date": data.get("from_date"), "to_date": data.get("to_date")}
+        hit, snapshot = await snapshot_store.get_async(self.tally_url, data["company_name"], "trial_balance", params)
+        if hit:
+            return snapshot
+        key = report_cache.key(self.tally_url, data["company_name"], "trial_balance", **params)
+        hit, cached = report_cache.get(key)
+        if hit:
+            return cached
+        return await report_flights.do_async(
+            key + (report_cache.generation(self.tally_url, data["company_name"]),),
+            lambda: self._load_trial_balance_async(data, key, params)
+        )
+
+    async def _load_trial_balance_async(self, data: dict, key, params):
+        """Async variant of _load_trial_balance."""
+        generation = report_cache.generation(self.tally_url, data["company_name"])
         xml_request = self.build_xml(data)
-        xml_response = self.post_to_tally(xml_request)
-        return self.parse_response(xml_response)
+        try:
+            async with get_async_tally_client(self.tally_url).stream(
+                xml_request, operation=REPORT_EXPORT, company_name=data["company_name"]
+            ) as response:
+                if response.status_code != 200:
+                    await response.read()
+                    raise Exception(f"Tally returned {response.status_code}: {response.text}")
+                result = await self.parse_stream_async(response.aiter_bytes(), response.encoding)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to communicate with Tally server: {e}")
+        report_cache.put(key, result, generation)
+        await snapshot_store.put_async(self.tally_url, data["company_name"], "trial_balance", params, result)
+        return result
@@ -1,14 +1,37 @@
+import asyncio
 import requests
 import re
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from services.tallyClient import get_tally_client, get_async_tally_client
+from services.tallyScheduler import COLLECTION_EXPORT, REPORT_EXPORT, VOUCHER_IMPORT
+from services.xmlStream import TALLY_STREAM_CHUNK_SIZE, iter_elements, aiter_elements
+from services.voucherIndex import details_from_voucher_data, details_match, get_voucher_index
+from services.slicedExport import date_windows, iter_sliced, aiter_sliced
+from services.bulkImport import TALLY_BULK_CHUNK_SIZE, chunked, map_import_results, parse_import_response, summarize_results
+from services.snapshotStore import validate_period
+from services.mirrorStore import drop_mirrored_vouchers
+from services.metrics import observe_build
+from services.tracing import traced
+
+# Only what voucher_details reads; the Voucher Register renders far more
+LOOKUP_FETCH = (
+    "RemoteID,VoucherTypeName,VoucherNumber,Date,Narration,"
+    "AllLedgerEntries.LedgerName,AllLedgerEntries.Amount"
+)
+
+def _attr(value):
+    return escape(str(value or ""), {'"': "&quot;"})
 
 class TallyVoucherUpdater:
     def __init__(self, tally_url="http://localhost:9000"):
         self.tally_url = tally_url
+        self.client = get_tally_client(tally_url)
 
     def build_voucher_guid(self, from_ledger, to_ledger, amount, voucher_type, date):
         return f"{from_ledger}_{to_ledger}_{amount}_{voucher_type}_{date}"
 
+    @traced()
     def validate_voucher_data(self, data: dict, required_fields: list):
         for field in required_fields:
             if field not in data or not data[field]:
@@ -25,6 +48,14 @@ class TallyVoucherUpdater:
         return True
 
     def build_delete_xml(self, company_name, remote_id, voucher_type):
+        return self.build_bulk_delete_xml(company_name, [(remote_id, voucher_type)])
+
+    @observe_build
+    def build_bulk_delete_xml(self, company_name, vouchers):
+        """Delete many vouchers, given as (remote_id, voucher_type) pairs, with sibling VOUCHER elements."""
+        vouchers_xml = "".join(f"""
+                    <VOUCHER REMOTEID="{_attr(remote_id)}" VCHTYPE="{_attr(voucher_type)}" ACTION="Delete" OBJVIEW="Accounting Voucher View">
+                    </VOUCHER>""" for remote_id, voucher_type in vouchers)
         return f"""
 <ENVELOPE>
     <HEADER>
@@ -39,9 +70,7 @@ class TallyVoucherUpdater:
                 </STATICVARIABLES>
             </REQUESTDESC>
             <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <VOUCHER REMOTEID="{remote_id}" VCHTYPE="{voucher_type}" ACTION="Delete" OBJVIEW="Accounting Voucher View">
-                    </VOUCHER>
+                <TALLYMESSAGE xmlns:UDF="TallyUDF">{vouchers_xml}
                 </TALLYMESSAGE>
             </REQUESTDATA>
         </IMPORTDATA>
@@ -50,10 +79,18 @@ class TallyVoucherUpdater:
 """.strip()
 
     def build_create_xml(self, data: dict):
-        narration = data["narration"] or f"Transfer from {data['from_ledger']} to {data['to_ledger']}"
         new_remote_id = self.build_voucher_guid(
             data["from_ledger"], data["to_ledger"], data["amount"], data["voucher_type"], data["date"]
         )
+        return self.build_voucher_xml(data, new_remote_id, "Create")
+
+    def build_alter_xml(self, remote_id, data: dict):
+        """Rewrite the voucher addressed by remote_id in place; it keeps its REMOTEID."""
+        return self.build_voucher_xml(data, remote_id, "Alter")
+
+    @observe_build
+    def build_voucher_xml(self, data: dict, remote_id, action):
+        narration = data["narration"] or f"Transfer from {data['from_ledger']} to {data['to_ledger']}"
 
         return f"""
 <ENVELOPE>
@@ -70,7 +107,7 @@ class TallyVoucherUpdater:
             </REQUESTDESC>
             <REQUESTDATA>
                 <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <VOUCHER REMOTEID="{new_remote_id}" VCHTYPE="{data['voucher_type']}" ACTION="Create" OBJVIEW="Accounting Voucher View">
+                    <VOUCHER REMOTEID="{remote_id}" VCHTYPE="{data['voucher_type']}" ACTION="{action}" OBJVIEW="Accounting Voucher View">
                         <DATE>{data['date']}</DATE> 
                         <EFFECTIVEDATE>{data['date']}</EFFECTIVEDATE>
                         <VOUCHERTYPENAME>{data['voucher_type']}</VOUCHERTYPENAME>
@@ -97,24 +134,25 @@ class TallyVoucherUpdater:
 </ENVELOPE>
 """.strip()
 
-    def post_to_tally(self, xml_string):
-        headers = {"Content-Type": "application/xml"}
+    def post_to_tally(self, xml_string, company_name=None):
         try:
-            response = requests.post(
-                self.tally_url,
-                data=xml_string.encode("utf-8"),
-                headers=headers,
-                timeout=10
-            )
-           
+            response = self.client.post(xml_string, operation=VOUCHER_IMPORT, company_name=company_name)
             return response
         except requests.exceptions.RequestException as e:
             raise RuntimeError(f"Failed to communicate with Tally server: {e}")
 
+    async def post_to_tally_async(self, xml_string, company_name=None):
+        try:
+            return await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=VOUCHER_IMPORT, company_name=company_name
+            )
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Failed to communicate with Tally server: {e}")
    
-    def fetch_vouchers(self, company_name):
-        """Fetch all vouchers from Tally for a given company."""
-        xml_request = f"""
+    @observe_build
+    def build_vouchers_export_xml(self, company_name):
+        """Build the Voucher Register export request for a company."""
+        return f"""
         <ENVELOPE>
             <HEADER>
                 <TALLYREQUEST>Export Data</TALLYREQUEST>
@@ -132,11 +170,128 @@ class TallyVoucherUpdater:
             </BODY>
         </ENVELOPE>
         """
-        response = requests.post(self.tally_url, data=xml_request.encode("utf-8"))
-        if response.status_code != 200:
-            raise RuntimeError(f"Failed to fetch vouchers: {response.status_code}")
-        return ET.fromstring(response.text)
 
+    def iter_vouchers(self, company_name):
+        """Stream the Voucher Register for a company, yielding each VOUCHER element as it completes."""
+        with self.client.stream(
+            self.build_vouchers_export_xml(company_name),
+            operation=REPORT_EXPORT, company_name=company_name
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to fetch vouchers: {response.status_code}")
+            chunks = response.iter_content(TALLY_STREAM_CHUNK_SIZE)
+            yield from iter_elements(chunks, ["VOUCHER"], response.encoding or "utf-8", report="voucher_register")
+
+    async def aiter_vouchers(self, company_name):
+        """Async variant of iter_vouchers."""
+        async with get_async_tally_client(self.tally_url).stream(
+            self.build_vouchers_export_xml(company_name),
+            operation=REPORT_EXPORT, company_name=company_name
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to fetch vouchers: {response.status_code}")
+            async for voucher in aiter_elements(response.aiter_bytes(), ["VOUCHER"], response.encoding, report="voucher_register"):
+                yield voucher
+
+    @observe_build
+    def build_lookup_xml(self, company_name, from_date=None, to_date=None):
+        """
+        Build a TDL Voucher collection export carrying only the LOOKUP_FETCH fields.
+        Voucher collections follow the current period, so YYYYMMDD from/to
+        dates limit the export to those days.
+        """
+        period_xml = "".join(
+            f"\n                        <{tag}>{value}</{tag}>"
+            for tag, value in (("SVFROMDATE", from_date), ("SVTODATE", to_date))
+            if value and re.fullmatch(r"\d{8}", str(value))
+        )
+
+        return f"""
+        <ENVELOPE>
+            <HEADER>
+                <VERSION>1</VERSION>
+                <TALLYREQUEST>Export</TALLYREQUEST>
+                <TYPE>Collection</TYPE>
+                <ID>VoucherLookup</ID>
+            </HEADER>
+            <BODY>
+                <DESC>
+                    <STATICVARIABLES>
+                        <SVCURRENTCOMPANY>{escape(company_name)}</SVCURRENTCOMPANY>
+                        <SVEXPORTFORMAT>XML</SVEXPORTFORMAT>{period_xml}
+                    </STATICVARIABLES>
+                    <TDL>
+                        <TDLMESSAGE>
+                            <COLLECTION NAME="VoucherLookup" ISMODIFY="No" ISFIXED="No" ISINITIALIZE="No" ISOPTION="No" ISINTERNAL="No">
+                                <TYPE>Voucher</TYPE>
+                                <FETCH>{LOOKUP_FETCH}</FETCH>
+                            </COLLECTION>
+                        </TDLMESSAGE>
+                    </TDL>
+                </DESC>
+            </BODY>
+        </ENVELOPE>
+        """
+
+    def iter_lookup_vouchers(self, company_name, from_date=None, to_date=None):
+        """Stream the lean lookup collection, yielding each VOUCHER element as it completes."""
+        with self.client.stream(
+            self.build_lookup_xml(company_name, from_date, to_date),
+            operation=COLLECTION_EXPORT, company_name=company_name
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to fetch vouchers: {response.status_code}")
+            chunks = response.iter_content(TALLY_STREAM_CHUNK_SIZE)
+            yield from iter_elements(chunks, ["VOUCHER"], response.encoding or "utf-8", report="voucher_lookup")
+
+    async def aiter_lookup_vouchers(self, company_name, from_date=None, to_date=None):
+        """Async variant of iter_lookup_vouchers."""
+        async with get_async_tally_client(self.tally_url).stream(
+            self.build_lookup_xml(company_name, from_date, to_date),
+            operation=COLLECTION_EXPORT, company_name=company_name
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to fetch vouchers: {response.status_code}")
+            async for voucher in aiter_elements(response.aiter_bytes(), ["VOUCHER"], response.encoding, report="voucher_lookup"):
+                yield voucher
+
+    def iter_lookup_vouchers_sliced(self, company_name, from_date, to_date):
+        """
+        iter_lookup_vouchers for from_date..to_date as parallel date-window
+        exports (see slicedExport), yielded in date order slice by slice.
+        """
+        for _, vouchers in iter_sliced(
+            date_windows(from_date, to_date),
+            lambda start, end: list(self.iter_lookup_vouchers(company_name, start, end))
+        ):
+            yield from vouchers
+
+    async def aiter_lookup_vouchers_sliced(self, company_name, from_date, to_date):
+        """Async variant of iter_lookup_vouchers_sliced."""
+        async def load(start, end):
+            return [voucher async for voucher in self.aiter_lookup_vouchers(company_name, start, end)]
+
+        slices = aiter_sliced(date_windows(from_date, to_date), load)
+        try:
+            async for _, vouchers in slices:
+                for voucher in vouchers:
+                    yield voucher
+        finally:
+            await slices.aclose()
+
+    def fetch_vouchers(self, company_name):
+        """Fetch all vouchers from Tally for a given company."""
+        root = ET.Element("VOUCHERS")
+        root.extend(self.iter_vouchers(company_name))
+        return root
+
+    async def fetch_vouchers_async(self, company_name):
+        """Fetch all vouchers from Tally for a given company over the async transport."""
+        root = ET.Element("VOUCHERS")
+        root.extend([voucher async for voucher in self.aiter_vouchers(company_name)])
+        return root
+
+    @traced()
     def find_remote_id(self, company_name, search_criteria: dict):
         """
         Find RemoteID of a voucher by matching info.
@@ -149,78 +304,123 @@ class TallyVoucherUpdater:
             "to_ledger": "SBI",
             "amount": "70000"
         }
+        Answered from the company's voucher index; Tally is only scanned,
+        through the lean lookup collection, when the index has no answer.
         """
-        root = self.fetch_vouchers(company_name)
-        
-        
-
+        matched = get_voucher_index(self.tally_url, company_name).lookup(search_criteria)
+        if matched is None:
+            matched = self.scan_vouchers(company_name, search_criteria)
+        return self.select_single_match(matched)
+
+    @traced()
+    async def find_remote_id_async(self, company_name, search_criteria: dict):
+        """Async variant of find_remote_id."""
+        matched = get_voucher_index(self.tally_url, company_name).lookup(search_criteria)
+        if matched is None:
+            matched = await self.scan_vouchers_async(company_name, search_criteria)
+        return self.select_single_match(matched)
+
+    @traced()
+    def scan_vouchers(self, company_name, search_criteria: dict):
+        """
+        Scan Tally for vouchers matching search_criteria and return them. With a
+        date only that day is exported and the index answers for that day from
+        then on; without one every voucher is exported and the index is rebuilt.
+        """
+        date = search_criteria.get("date")
+        vouchers = [self.voucher_details(voucher, company_name)
+                    for voucher in self.iter_lookup_vouchers(company_name, date, date)]
+        self._index_scan(company_name, vouchers, date)
+        return [details for details in vouchers if details_match(details, search_criteria)]
+
+    @traced()
+    async def scan_vouchers_async(self, company_name, search_criteria: dict):
+        """Async variant of scan_vouchers."""
+        date = search_criteria.get("date")
+        vouchers = [self.voucher_details(voucher, company_name)
+                    async for voucher in self.aiter_lookup_vouchers(company_name, date, date)]
+        self._index_scan(company_name, vouchers, date)
+        return [details for details in vouchers if details_match(details, search_criteria)]
+
+    def _index_scan(self, company_name, vouchers, date):
+        """A dateless scan rebuilds the index; a dated one makes that day authoritative."""
+        index = get_voucher_index(self.tally_url, company_name)
+        if date:
+            index.load_date(date, vouchers)
+        else:
+            index.rebuild(vouchers)
+
+    def match_single_voucher(self, root, company_name, search_criteria: dict):
+        """Scan an exported voucher tree and return the one voucher matching search_criteria."""
         matched = []
-        
-        for voucher in root.findall(".//VOUCHER"):
-            # Extract basic voucher info
-            vch_type = voucher.get("VCHTYPE", "")
-            vch_number = voucher.findtext("VOUCHERNUMBER", "")
-            vch_date = voucher.findtext("DATE", "")
-            
-            # --- Step 1: Basic filters ---
-            if "voucher_type" in search_criteria and search_criteria["voucher_type"] != vch_type and  search_criteria["voucher_type"] != None:
-                continue
-            if "voucher_number" in search_criteria and search_criteria["voucher_number"] != vch_number and search_criteria["voucher_number"] != None:
-                continue
-            if "date" in search_criteria and search_criteria["date"] != vch_date and search_criteria["date"] != None:
-                continue
-    
-            # --- Step 2: Ledger filters ---
-            ledgers = []
-            for ledger_entry in voucher.findall(".//ALLLEDGERENTRIES.LIST"):
-                name = ledger_entry.findtext("LEDGERNAME", "")
-                amount = ledger_entry.findtext("AMOUNT", "")
-                print(name,amount,search_criteria)
-                ledgers.append((name, amount))
-            
-            # Separate debit/credit (negative = from_ledger, positive = to_ledger)
-            from_ledger = next((l for l, amt in ledgers if amt.startswith("-")), None)
-            to_ledger = next((l for l, amt in ledgers if not amt.startswith("-")), None)
-            abs_amount = next((amt.replace("-", "") for _, amt in ledgers if amt), None)
-        
-            if "from_ledger" in search_criteria and search_criteria["from_ledger"] != from_ledger and search_criteria["from_ledger"] != None:
-                continue
-            if "to_ledger" in search_criteria and search_criteria["to_ledger"] != to_ledger and search_criteria["to_ledger"] != None:
-                continue
-            if "amount" in search_criteria and search_criteria["amount"] != None:
-                criteria_amount = round(float(search_criteria["amount"]), 2)
-                voucher_amount = round(float(abs_amount), 2)
-
-                if criteria_amount != voucher_amount:
-                    continue
-
-            matched.append({
-            "remote_id": voucher.get("REMOTEID"),
+        for voucher in root.iter("VOUCHER"):
+            match = self.match_voucher(voucher, company_name, search_criteria)
+            if match:
+                matched.append(match)
+        return self.select_single_match(matched)
+
+    def voucher_details(self, voucher, company_name):
+        """Extract the lookup fields of one exported VOUCHER element."""
+        ledgers = []
+        for ledger_entry in voucher.findall(".//ALLLEDGERENTRIES.LIST"):
+            ledgers.append((ledger_entry.findtext("LEDGERNAME", ""), ledger_entry.findtext("AMOUNT", "")))
+
+        # Separate debit/credit (negative = from_ledger, positive = to_ledger)
+        from_ledger = next((l for l, amt in ledgers if amt.startswith("-")), None)
+        to_ledger = next((l for l, amt in ledgers if not amt.startswith("-")), None)
+        abs_amount = next((amt.replace("-", "") for _, amt in ledgers if amt), None)
+
+        # Report exports carry these as attributes, collection exports as child elements
+        return {
+            "remote_id": voucher.get("REMOTEID") or voucher.findtext("REMOTEID"),
             "company_name": company_name,
-            "voucher_type": vch_type,
-            "voucher_number": vch_number,
-            "date": vch_date,
+            "voucher_type": voucher.get("VCHTYPE") or voucher.findtext("VOUCHERTYPENAME", ""),
+            "voucher_number": voucher.findtext("VOUCHERNUMBER", ""),
+            "date": voucher.findtext("DATE", ""),
             "from_ledger": from_ledger,
             "to_ledger": to_ledger,
             "amount": abs_amount,
             "narration": voucher.findtext("NARRATION", "")
-            })
-            
-        print(len(matched),matched)
-        
+        }
+
+    def match_voucher(self, voucher, company_name, search_criteria: dict):
+        """Return the voucher's details if it matches search_criteria, else None."""
+        details = self.voucher_details(voucher, company_name)
+        return details if details_match(details, search_criteria) else None
+
+    def select_single_match(self, matched: list[dict]):
+        """Return the only match, or raise if there is none or more than one."""
         if len(matched) > 1:
             raise ValueError("More than one voucher matched the given criteria.")
         elif len(matched) < 1:
-            raise ValueError("No voucher found matching the given criteria.")    
-        
+            raise ValueError("No voucher found matching the given criteria.")
+
         return matched[0]
 
-        
+    def _forget(self, company_name, remote_id):
+        get_voucher_index(self.tally_url, company_name).remove(remote_id)
 
-   
-    
-    def fetch_voucher_by_remote_id(self, remote_id: str, company_name: str):
-        xml_payload = f"""
+    def _deleted(self, company_name, remote_ids):
+        """Drop vouchers Tally deleted from the voucher index and the local mirror."""
+        for remote_id in remote_ids:
+            self._forget(company_name, remote_id)
+        drop_mirrored_vouchers(self.tally_url, company_name, remote_ids)
+
+    async def _deleted_async(self, company_name, remote_ids):
+        """_deleted with the mirror's SQLite write off the event loop."""
+        await asyncio.to_thread(self._deleted, company_name, remote_ids)
+
+    def _remember(self, data: dict, remote_id=None):
+        remote_id = remote_id or self.build_voucher_guid(
+            data["from_ledger"], data["to_ledger"], data["amount"], data["voucher_type"], data["date"]
+        )
+        get_voucher_index(self.tally_url, data["company_name"]).add(
+            details_from_voucher_data(data["company_name"], remote_id, data)
+        )
+
+    @observe_build
+    def build_voucher_by_remote_id_xml(self, remote_id: str, company_name: str):
+        return f"""
         <ENVELOPE>
           <HEADER>
             <TALLYREQUEST>Export Data</TALLYREQUEST>
@@ -239,17 +439,124 @@ class TallyVoucherUpdater:
           </BODY>
         </ENVELOPE>
         """
-        response = requests.post(self.tally_url, data=xml_payload)
+
+    def fetch_voucher_by_remote_id(self, remote_id: str, company_name: str):
+        xml_payload = self.build_voucher_by_remote_id_xml(remote_id, company_name)
+        response = self.client.post(
+            xml_payload, operation=REPORT_EXPORT, company_name=company_name
+        )
+        response.raise_for_status()
+        return response.text
+
+    async def fetch_voucher_by_remote_id_async(self, remote_id: str, company_name: str):
+        xml_payload = self.build_voucher_by_remote_id_xml(remote_id, company_name)
+        response = await get_async_tally_client(self.tally_url).post(
+            xml_payload, operation=REPORT_EXPORT, company_name=company_name
+        )
         response.raise_for_status()
         return response.text
     
-    def update_voucher(self, old_lookup: dict, new_data: dict):
+    def update_voucher(self, old_lookup: dict, new_data: dict, mode: str = "alter"):
         """
-        Update voucher transactionally: delete old, create new, restore if needed.
+        Update a voucher. By default this is one ACTION="Alter" import addressed
+        by REMOTEID, taken from old_lookup["remote_id"] or resolved through the
+        voucher index. mode="replace", a move to another company, or an alter
+        that Tally does not apply falls back to delete old, create new,
+        restore if needed.
         """
-
-        # Validate only the new data
         self.validate_voucher_data(new_data, ["company_name", "from_ledger", "to_ledger", "amount", "voucher_type", "date"])
+        self._check_mode(mode)
+
+        company_name = old_lookup["company_name"]
+        remote_id, old_voucher_full = old_lookup.get("remote_id"), None
+        if not remote_id:
+            old_voucher_full = self._resolve_old_voucher(self.find_remote_id(company_name, old_lookup))
+            remote_id = old_voucher_full["remote_id"]
+
+        if mode == "alter" and new_data["company_name"] == company_name:
+            alter_response = self.post_to_tally(self.build_alter_xml(remote_id, new_data), company_name)
+            if self._altered(alter_response):
+                self._forget(company_name, remote_id)
+                self._remember(new_data, remote_id)
+                return {"response": "Voucher updated successfully", "mode": "alter"}
+
+        if old_voucher_full is None:
+            old_voucher_full = self._resolve_old_voucher(self._known_voucher(company_name, remote_id))
+        return self._replace_voucher(old_voucher_full, new_data)
+
+    @traced()
+    def _replace_voucher(self, old_voucher_full: dict, new_data: dict):
+        """Delete old, create new, restore the old voucher if the create fails."""
+        company_name, remote_id = old_voucher_full["company_name"], old_voucher_full["remote_id"]
+
+        # Step 1: Delete old voucher
+        delete_xml = self.build_delete_xml(company_name, remote_id, old_voucher_full["voucher_type"])
+        delete_response = self.post_to_tally(delete_xml, company_name)
+
+        if not delete_response or delete_response.status_code != 200:
+            raise RuntimeError("Failed to connect to Tally during deletion.")
+
+        if "<DELETED>0</DELETED>" in delete_response.text:
+            # The index entry is stale; drop it so the next lookup rescans
+            self._forget(company_name, remote_id)
+            raise RuntimeError("Voucher not found or could not be deleted. Aborting update.")
+
+        self._deleted(company_name, [remote_id])
+
+
+        # Step 2: Create new voucher
+        create_xml = self.build_create_xml(new_data)
+        create_response = self.post_to_tally(create_xml, new_data["company_name"])
+
+        if not create_response or create_response.status_code != 200:
+            restore_xml = self.build_create_xml(old_voucher_full)  #  use original full voucher
+            self.post_to_tally(restore_xml, company_name)
+            raise RuntimeError("Failed to create updated voucher. Old voucher restored.")
+
+        if "<CREATED>0</CREATED>" in create_response.text:
+            restore_xml = self.build_create_xml(old_voucher_full)  #  use original full voucher
+            self.post_to_tally(restore_xml, company_name)
+            raise RuntimeError("Updated voucher creation failed. Old voucher restored.")
+
+        self._remember(new_data)
+        return {"response": "Voucher updated successfully", "mode": "replace"}
+
+    def _check_mode(self, mode):
+        if mode not in ("alter", "replace"):
+            raise ValueError(f"Unknown update mode: {mode}. Use 'alter' or 'replace'.")
+
+    def _resolve_old_voucher(self, old_voucher_full):
+        if not old_voucher_full:
+            raise RuntimeError("Could not resolve old voucher. Aborting update.")
+        if not old_voucher_full["remote_id"]:
+            raise RuntimeError("Could not resolve RemoteID for old voucher. Aborting update.")
+        return old_voucher_full
+
+    def _altered(self, response) -> bool:
+        return response is not None and response.status_code == 200 and \
+            parse_import_response(response.text)["altered"] > 0
+
+    @traced()
+    def _known_voucher(self, company_name, remote_id):
+        """Full details of a voucher known only by REMOTEID: from the index, else one lookup scan."""
+        details = get_voucher_index(self.tally_url, company_name).get(remote_id)
+        if details is None:
+            details = next((d for d in self.scan_vouchers(company_name, {}) if d["remote_id"] == remote_id), None)
+        return details
+
+    @traced()
+    async def _known_voucher_async(self, company_name, remote_id):
+        """Async variant of _known_voucher."""
+        details = get_voucher_index(self.tally_url, company_name).get(remote_id)
+        if details is None:
+            vouchers = await self.scan_vouchers_async(company_name, {})
+            details = next((d for d in vouchers if d["remote_id"] == remote_id), None)
+        return details
+   
+    def delete_voucher(self, old_lookup: dict):
+        """
+        Update voucher transactionally: delete old, create new, restore if needed.
+        """
 
         # Step 1: Resolve RemoteID and fetch full old voucher details
         old_voucher_full = self.find_remote_id(old_lookup["company_name"], old_lookup)
@@ -265,56 +572,265 @@ class TallyVoucherUpdater:
 
         # Step 2: Delete old voucher
         delete_xml = self.build_delete_xml(old_lookup["company_name"], remote_id, old_lookup["voucher_type"])
-        delete_response = self.post_to_tally(delete_xml)
+        delete_response = self.post_to_tally(delete_xml, old_lookup["company_name"])
+
+        if not delete_response or delete_response.status_code != 200:
+            raise RuntimeError("Failed to connect to Tally during deletion.")
+
+        if "<DELETED>0</DELETED>" in delete_response.text:
+            # The index entry is stale; drop it so the next lookup rescans
+            self._forget(old_lookup["company_name"], remote_id)
+            raise RuntimeError("Voucher not found or could not be deleted. Aborting update.")
+
+        self._deleted(old_lookup["company_name"], [remote_id])
+
+        return {"response": "Voucher deleted successfully"}
+
+    async def update_voucher_async(self, old_lookup: dict, new_data: dict, mode: str = "alter"):
+        """
+        Async variant of update_voucher: alter in place by REMOTEID, falling back to delete and create.
+        """
+        self.validate_voucher_data(new_data, ["company_name", "from_ledger", "to_ledger", "amount", "voucher_type", "date"])
+        self._check_mode(mode)
+
+        company_name = old_lookup["company_name"]
+        remote_id, old_voucher_full = old_lookup.get("remote_id"), None
+        if not remote_id:
+            old_voucher_full = self._resolve_old_voucher(await self.find_remote_id_async(company_name, old_lookup))
+            remote_id = old_voucher_full["remote_id"]
+
+        if mode == "alter" and new_data["company_name"] == company_name:
+            alter_response = await self.post_to_tally_async(self.build_alter_xml(remote_id, new_data), company_name)
+            if self._altered(alter_response):
+                self._forget(company_name, remote_id)
+                self._remember(new_data, remote_id)
+                return {"response": "Voucher updated successfully", "mode": "alter"}
+
+        if old_voucher_full is None:
+            old_voucher_full = self._resolve_old_voucher(await self._known_voucher_async(company_name, remote_id))
+        return await self._replace_voucher_async(old_voucher_full, new_data)
+
+    @traced()
+    async def _replace_voucher_async(self, old_voucher_full: dict, new_data: dict):
+        """Async variant of _replace_voucher."""
+        company_name, remote_id = old_voucher_full["company_name"], old_voucher_full["remote_id"]
+
+        delete_xml = self.build_delete_xml(company_name, remote_id, old_voucher_full["voucher_type"])
+        delete_response = await self.post_to_tally_async(delete_xml, company_name)
 
         if not delete_response or delete_response.status_code != 200:
             raise RuntimeError("Failed to connect to Tally during deletion.")
 
         if "<DELETED>0</DELETED>" in delete_response.text:
+            # The index entry is stale; drop it so the next lookup rescans
+            self._forget(company_name, remote_id)
             raise RuntimeError("Voucher not found or could not be deleted. Aborting update.")
 
+        await self._deleted_async(company_name, [remote_id])
 
-        # Step 3: Create new voucher
         create_xml = self.build_create_xml(new_data)
-        create_response = self.post_to_tally(create_xml)
+        create_response = await self.post_to_tally_async(create_xml, new_data["company_name"])
 
         if not create_response or create_response.status_code != 200:
             restore_xml = self.build_create_xml(old_voucher_full)  #  use original full voucher
-            self.post_to_tally(restore_xml)
+            await self.post_to_tally_async(restore_xml, company_name)
             raise RuntimeError("Failed to create updated voucher. Old voucher restored.")
 
         if "<CREATED>0</CREATED>" in create_response.text:
             restore_xml = self.build_create_xml(old_voucher_full)  #  use original full voucher
-            self.post_to_tally(restore_xml)
+            await self.post_to_tally_async(restore_xml, company_name)
             raise RuntimeError("Updated voucher creation failed. Old voucher restored.")
 
-        return {"response": "Voucher updated successfully"}
-   
-    def delete_voucher(self, old_lookup: dict):
+        self._remember(new_data)
+        return {"response": "Voucher updated successfully", "mode": "replace"}
+
+    async def delete_voucher_async(self, old_lookup: dict):
         """
-        Update voucher transactionally: delete old, create new, restore if needed.
+        Async variant of delete_voucher.
         """
+        old_voucher_full = await self.find_remote_id_async(old_lookup["company_name"], old_lookup)
 
-        # Step 1: Resolve RemoteID and fetch full old voucher details
-        old_voucher_full = self.find_remote_id(old_lookup["company_name"], old_lookup)
-        
         if not old_voucher_full:
             raise RuntimeError("Could not resolve old voucher. Aborting update.")
 
         remote_id = old_voucher_full["remote_id"]
-        
+
         if not remote_id:
             raise RuntimeError("Could not resolve RemoteID for old voucher. Aborting update.")
 
-
-        # Step 2: Delete old voucher
         delete_xml = self.build_delete_xml(old_lookup["company_name"], remote_id, old_lookup["voucher_type"])
-        delete_response = self.post_to_tally(delete_xml)
+        delete_response = await self.post_to_tally_async(delete_xml, old_lookup["company_name"])
 
         if not delete_response or delete_response.status_code != 200:
             raise RuntimeError("Failed to connect to Tally during deletion.")
 
         if "<DELETED>0</DELETED>" in delete_response.text:
+            # The index entry is stale; drop it so the next lookup rescans
+            self._forget(old_lookup["company_name"], remote_id)
             raise RuntimeError("Voucher not found or could not be deleted. Aborting update.")
 
+        await self._deleted_async(old_lookup["company_name"], [remote_id])
+
         return {"response": "Voucher deleted successfully"}
+
+    # ---------- Bulk delete ----------
+    def _post_batch(self, xml_string, company_name, items=1):
+        """Post one import envelope, answering in the shape map_import_results expects."""
+        try:
+            response = self.client.post(xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items)
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    async def _post_batch_async(self, xml_string, company_name, items=1):
+        try:
+            response = await get_async_tally_client(self.tally_url).post(
+                xml_string, operation=VOUCHER_IMPORT, company_name=company_name, items=items
+            )
+            return {"status": response.status_code, "response": response.text}
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e)}
+
+    def _check_filters(self, from_date=None, to_date=None, voucher_type=None, ledger_name=None):
+        if not any((from_date, to_date, voucher_type, ledger_name)):
+            raise ValueError("At least one filter is required: from_date, to_date, voucher_type or ledger_name")
+        validate_period(from_date, to_date)
+
+    def _filter_match(self, voucher, details, from_date=None, to_date=None, voucher_type=None, ledger_name=None):
+        if from_date and (details["date"] or "") < from_date:
+            return False
+        if to_date and (details["date"] or "") > to_date:
+            return False
+        if voucher_type and details["voucher_type"] != voucher_type:
+            return False
+        if ledger_name and ledger_name not in (
+            entry.findtext("LEDGERNAME", "") for entry in voucher.findall(".//ALLLEDGERENTRIES.LIST")
+        ):
+            return False
+        return True
+
+    def select_vouchers(self, company_name, from_date=None, to_date=None, voucher_type=None, ledger_name=None):
+        """
+        Vouchers in from_date..to_date of voucher_type with an entry for
+        ledger_name (each filter optional, at least one required), found
+        with one lookup export over the period, or a sliced export when both
+        dates are given.
+        """
+        filters = {"from_date": from_date, "to_date": to_date, "voucher_type": voucher_type, "ledger_name": ledger_name}
+        self._check_filters(**filters)
+        if from_date and to_date:
+            vouchers = self.iter_lookup_vouchers_sliced(company_name, from_date, to_date)
+        else:
+            vouchers = self.iter_lookup_vouchers(company_name, from_date, to_date)
+        matched = []
+        for voucher in vouchers:
+            details = self.voucher_details(voucher, company_name)
+            if self._filter_match(voucher, details, **filters):
+                matched.append(details)
+        return matched
+
+    async def select_vouchers_async(self, company_name, from_date=None, to_date=None, voucher_type=None,
+                                    ledger_name=None):
+        """Async variant of select_vouchers."""
+        filters = {"from_date": from_date, "to_date": to_date, "voucher_type": voucher_type, "ledger_name": ledger_name}
+        self._check_filters(**filters)
+        if from_date and to_date:
+            vouchers = self.aiter_lookup_vouchers_sliced(company_name, from_date, to_date)
+        else:
+            vouchers = self.aiter_lookup_vouchers(company_name, from_date, to_date)
+        matched = []
+        async for voucher in vouchers:
+            details = self.voucher_details(voucher, company_name)
+            if self._filter_match(voucher, details, **filters):
+                matched.append(details)
+        return matched
+
+    def _known_vouchers(self, company_name, remote_ids, scanned=None):
+        """Pair each REMOTEID with its details from the index, or from one lookup scan when given."""
+        index = get_voucher_index(self.tally_url, company_name)
+        by_id = {details["remote_id"]: details for details in scanned or []}
+        return [(remote_id, index.get(remote_id) or by_id.get(remote_id)) for remote_id in remote_ids]
+
+    def _resolve_targets(self, company_name, remote_ids):
+        targets = self._known_vouchers(company_name, remote_ids)
+        if any(details is None for _, details in targets):
+            targets = self._known_vouchers(company_name, remote_ids, self.scan_vouchers(company_name, {}))
+        return targets
+
+    async def _resolve_targets_async(self, company_name, remote_ids):
+        targets = self._known_vouchers(company_name, remote_ids)
+        if any(details is None for _, details in targets):
+            targets = self._known_vouchers(company_name, remote_ids, await self.scan_vouchers_async(company_name, {}))
+        return targets
+
+    def _plan_bulk_delete(self, targets):
+        """Split targets into deletable items and the outcomes already known without asking Tally."""
+        prepared, results, seen = [], [], set()
+        for index, (remote_id, details) in enumerate(targets):
+            if details is None or not remote_id:
+                results.append({"index": index, "remote_id": remote_id, "status": "not_found",
+                                "error": "No voucher found with this REMOTEID"})
+            elif remote_id in seen:
+                results.append({"index": index, "remote_id": remote_id, "status": "skipped",
+                                "error": "Duplicate REMOTEID in request"})
+            else:
+                seen.add(remote_id)
+                prepared.append({"index": index, "remote_id": remote_id, "details": details,
+                                 "identifiers": [remote_id, details.get("voucher_number")]})
+        return prepared, results
+
+    def _deleted_ids(self, outcomes):
+        return [outcome["remote_id"] for outcome in outcomes if outcome["status"] == "deleted"]
+
+    def _bulk_delete_xml(self, company_name, batch):
+        return self.build_bulk_delete_xml(
+            company_name, [(entry["remote_id"], entry["details"]["voucher_type"]) for entry in batch]
+        )
+
+    def _dry_run(self, prepared, results):
+        results.extend({"index": entry["index"], "remote_id": entry["remote_id"], "status": "matched",
+                        "voucher": entry["details"]} for entry in prepared)
+        return summarize_results(results)
+
+    def delete_vouchers_bulk(self, company_name, remote_ids=None, filters=None,
+                             chunk_size=TALLY_BULK_CHUNK_SIZE, dry_run=False):
+        """
+        Delete many vouchers, chosen by a REMOTEID list or by filters (see
+        select_vouchers), with one multi-VOUCHER envelope per chunk.
+        Returns per-voucher outcomes; dry_run only reports what would go.
+        """
+        if (remote_ids is None) == (filters is None):
+            raise ValueError("Pass either remote_ids or filters")
+        if remote_ids is not None:
+            targets = self._resolve_targets(company_name, remote_ids)
+        else:
+            targets = [(details["remote_id"], details) for details in self.select_vouchers(company_name, **filters)]
+        prepared, results = self._plan_bulk_delete(targets)
+        if dry_run:
+            return self._dry_run(prepared, results)
+        for batch in chunked(prepared, chunk_size):
+            response = self._post_batch(self._bulk_delete_xml(company_name, batch), company_name, len(batch))
+            outcomes = map_import_results(batch, response, success_keys=("deleted",))
+            self._deleted(company_name, self._deleted_ids(outcomes))
+            results.extend(outcomes)
+        return summarize_results(results)
+
+    async def delete_vouchers_bulk_async(self, company_name, remote_ids=None, filters=None,
+                                         chunk_size=TALLY_BULK_CHUNK_SIZE, dry_run=False):
+        """Async variant of delete_vouchers_bulk."""
+        if (remote_ids is None) == (filters is None):
+            raise ValueError("Pass either remote_ids or filters")
+        if remote_ids is not None:
+            targets = await self._resolve_targets_async(company_name, remote_ids)
+        else:
+            targets = [(details["remote_id"], details)
+                       for details in await self.select_vouchers_async(company_name, **filters)]
+        prepared, results = self._plan_bulk_delete(targets)
+        if dry_run:
+            return self._dry_run(prepared, results)
+        for batch in chunked(prepared, chunk_size):
+            response = await self._post_batch_async(self._bulk_delete_xml(company_name, batch), company_name, len(batch))
+            outcomes = map_import_results(batch, response, success_keys=("deleted",))
+            await self._deleted_async(company_name, self._deleted_ids(outcomes))
+            results.extend(outcomes)
+        return summarize_results(results)
@@ -0,0 +1,169 @@
+import threading
+
+# Fields a voucher lookup can filter on
+INDEX_FIELDS = ("voucher_type", "date", "voucher_number", "from_ledger", "to_ledger", "amount")
+
+
+def _normalize(field, value):
+    if value is None:
+        return None
+    if field == "amount":
+        try:
+            return round(float(value), 2)
+        except (TypeError, ValueError):
+            return None
+    return str(value)
+
+
+def details_match(details: dict, search_criteria: dict) -> bool:
+    """True when every criterion that is present and not None equals the voucher's value."""
+    for field in INDEX_FIELDS:
+        wanted = search_criteria.get(field)
+        if wanted is None:
+            continue
+        actual = _normalize(field, details.get(field))
+        if actual is None or actual != _normalize(field, wanted):
+            return False
+    return True
+
+
+def details_from_voucher_data(company_name, remote_id, data: dict) -> dict:
+    """Index entry for a voucher we created ourselves; Tally assigns the number, so it is unknown."""
+    return {
+        "remote_id": remote_id,
+        "company_name": company_name,
+        "voucher_type": data.get("voucher_type"),
+        "voucher_number": data.get("voucher_number"),
+        "date": data.get("date"),
+        "from_ledger": data.get("from_ledger"),
+        "to_ledger": data.get("to_ledger"),
+        "amount": str(data.get("amount")),
+        "narration": data.get("narration") or "",
+    }
+
+
+class VoucherIndex:
+    """
+    In-memory index of one company's vouchers, keyed by each lookup field and
+    mapping to REMOTEID. Lookups intersect the per-field sets instead of
+    walking the Voucher Register.
+
+    A full scan (rebuild) makes the whole index authoritative. Until then a
+    scan of a single day (load_date) makes that day authoritative, so dated
+    lookups, the usual case for updates and deletes, are answered without
+    exporting the company's whole register first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: dict[str, dict] = {}
+        self.by_field: dict[str, dict] = {field: {} for field in INDEX_FIELDS}
+        self.built = False
+        self.dates: set[str] = set()  # days fully scanned while not built
+
+    def _add(self, details: dict):
+        remote_id = details.get("remote_id")
+        if not remote_id:
+            return
+        self._remove(remote_id)
+        self.entries[remote_id] = details
+        for field in INDEX_FIELDS:
+            key = _normalize(field, details.get(field))
+            self.by_field[field].setdefault(key, set()).add(remote_id)
+
+    def _remove(self, remote_id):
+        details = self.entries.pop(remote_id, None)
+        if details is None:
+            return
+        for field in INDEX_FIELDS:
+            key = _normalize(field, details.get(field))
+            ids = self.by_field[field].get(key)
+            if ids is not None:
+                ids.discard(remote_id)
+                if not ids:
+                    del self.by_field[field][key]
+
+    def rebuild(self, vouchers):
+        """Replace the index with the given voucher details, e.g. from a full register scan."""
+        with self.lock:
+            self.entries = {}
+            self.by_field = {field: {} for field in INDEX_FIELDS}
+            for details in vouchers:
+                self._add(details)
+            self.built = True
+            self.dates = set()
+
+    def load_date(self, date, vouchers):
+        """Replace one day's entries with a scan of that whole day and answer lookups for it from now on."""
+        date = _normalize("date", date)
+        with self.lock:
+            for remote_id in list(self.by_field["date"].get(date, ())):
+                self._remove(remote_id)
+            for details in vouchers:
+                self._add(details)
+            if not self.built:
+                self.dates.add(date)
+
+    def _covers(self, date) -> bool:
+        return self.built or (date is not None and _normalize("date", date) in self.dates)
+
+    def add(self, details: dict):
+        """Index a created or altered voucher if its day is covered; otherwise just drop any stale entry."""
+        with self.lock:
+            if self._covers(details.get("date")):
+                self._add(details)
+            elif details.get("remote_id"):
+                self._remove(details["remote_id"])
+
+    def remove(self, remote_id):
+        with self.lock:
+            self._remove(remote_id)
+
+    def get(self, remote_id):
+        """Details of one indexed voucher, or None."""
+        with self.lock:
+            details = self.entries.get(remote_id)
+            return dict(details) if details is not None else None
+
+    def lookup(self, search_criteria: dict):
+        """
+        Return the vouchers matching search_criteria, or None when the index
+        cannot answer: neither built nor covering the criteria's date, nothing
+        to filter on, no hit, or a candidate whose value for a filtered field
+        is unknown.
+        """
+        fields = [f for f in INDEX_FIELDS if search_criteria.get(f) is not None]
+        with self.lock:
+            if not self._covers(search_criteria.get("date")) or not fields:
+                return None
+
+            candidate_sets = []
+            for field in fields:
+                values = self.by_field[field]
+                ids = values.get(_normalize(field, search_criteria[field]), set()) | values.get(None, set())
+                candidate_sets.append(ids)
+            candidate_sets.sort(key=len)
+            candidates = set.intersection(*candidate_sets)
+
+            matched = []
+            for remote_id in candidates:
+                details = self.entries[remote_id]
+                if any(details.get(field) is None for field in fields):
+                    return None
+                if details_match(details, search_criteria):
+                    matched.append(dict(details))
+        return matched or None
+
+
+_indexes: dict[tuple[str, str], VoucherIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_voucher_index(tally_url: str, company_name: str) -> VoucherIndex:
+    """Return the shared voucher index for a company on a Tally host."""
+    key = (tally_url, company_name)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = VoucherIndex()
+        return index
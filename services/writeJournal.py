@@ -0,0 +1,358 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from services.bulkImport import TALLY_BULK_CHUNK_SIZE, chunked, map_import_results
+from services.circuitBreaker import TallyUnavailableError
+from services.createVoucherService import TallyVoucherManager
+from services.createInventoryVoucherService import TallyInventoryVoucherManager
+from services.inventorySalesVoucherService import TallySalesVoucherManager
+from services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Append-only journal of vouchers accepted for async submission; one per process
+TALLY_JOURNAL_PATH = os.getenv("TALLY_JOURNAL_PATH", "tally_journal/journal.jsonl")
+# Vouchers packed into one import envelope when the journal is drained
+TALLY_JOURNAL_BATCH_SIZE = int(os.getenv("TALLY_JOURNAL_BATCH_SIZE", str(TALLY_BULK_CHUNK_SIZE)))
+# Seconds the worker waits after a wake-up so concurrent submissions share an envelope
+TALLY_JOURNAL_LINGER = float(os.getenv("TALLY_JOURNAL_LINGER", "0.05"))
+# Attempts before a job whose batch keeps failing to reach Tally is marked failed
+TALLY_JOURNAL_MAX_ATTEMPTS = int(os.getenv("TALLY_JOURNAL_MAX_ATTEMPTS", "8"))
+# Seconds a finished job stays queryable; also bounds how much history the journal keeps
+TALLY_JOURNAL_RETENTION = float(os.getenv("TALLY_JOURNAL_RETENTION", "86400"))
+# Finished records appended before the journal is rewritten without the expired ones
+TALLY_JOURNAL_COMPACT_EVERY = int(os.getenv("TALLY_JOURNAL_COMPACT_EVERY", "1000"))
+
+# Job kinds and the manager that validates and builds their <VOUCHER> elements
+MANAGERS = {
+    "voucher": TallyVoucherManager,
+    "sales_voucher": TallySalesVoucherManager,
+    "inventory_voucher": TallyInventoryVoucherManager,
+}
+
+QUEUED, SUCCEEDED, FAILED = "queued", "succeeded", "failed"
+SUCCESS_STATUSES = ("created", "altered", "combined")
+
+
+def _manager(kind, tally_url):
+    if kind not in MANAGERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    return MANAGERS[kind](tally_url)
+
+
+def _public(job):
+    return {key: value for key, value in job.items() if key not in ("data", "retry_at")}
+
+
+class WriteJournal:
+    """
+    Write-behind queue for voucher creation.
+
+    submit() validates a voucher, appends it to the journal with an fsync and
+    returns a job at once; a worker task on the event loop drains queued jobs
+    in submission order, packing each (kind, tally_url, company) run into
+    multi-voucher envelopes of up to batch_size. Per-voucher outcomes are
+    appended as finish records. On start the journal is replayed, so jobs
+    accepted before a crash or restart are posted again; delivery is
+    at-least-once, and a batch that was in flight at the crash is re-sent
+    with the same REMOTEIDs.
+
+    A batch that never reached Tally (connection error or non-200) is
+    retried with exponential backoff, up to max_attempts.
+    """
+
+    def __init__(self, path=TALLY_JOURNAL_PATH, batch_size=TALLY_JOURNAL_BATCH_SIZE,
+                 linger=TALLY_JOURNAL_LINGER, max_attempts=TALLY_JOURNAL_MAX_ATTEMPTS,
+                 retention=TALLY_JOURNAL_RETENTION, compact_every=TALLY_JOURNAL_COMPACT_EVERY):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self.max_attempts = max(1, max_attempts)
+        self.retention = retention
+        self.compact_every = max(1, compact_every)
+        self.lock = threading.Lock()
+        self.jobs: dict[str, dict] = {}
+        self.pending: deque[str] = deque()  # queued job ids in submission order
+        self.loaded = False
+        self.file = None
+        self.finished_since_compact = 0
+        self.batches = 0
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    # ---------- Journal file ----------
+    def _write(self, records):
+        """Append records and fsync; the caller holds self.lock."""
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+        for record in records:
+            self.file.write(json.dumps(record, separators=(",", ":"), default=str) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _expired(self, job, now):
+        return job["status"] != QUEUED and job.get("finished_at", now) + self.retention < now
+
+    def _compact(self):
+        """Rewrite the journal with only queued and retained jobs; the caller holds self.lock."""
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if self._expired(job, now)]:
+            del self.jobs[job_id]
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job in self.jobs.values():
+                state = {key: value for key, value in job.items() if key != "retry_at"}
+                f.write(json.dumps({"op": "job", "job": state}, separators=(",", ":"), default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.finished_since_compact = 0
+
+    def load(self):
+        """Replay the journal once: unfinished jobs are queued again, finished ones stay queryable."""
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # A torn final line from a crash mid-append; the submit was never acknowledged
+                            continue
+                        if record.get("op") == "job":
+                            self.jobs[record["job"]["id"]] = record["job"]
+                        elif record.get("op") == "finish" and record.get("id") in self.jobs:
+                            job = self.jobs[record["id"]]
+                            job.pop("data", None)
+                            job.update({k: v for k, v in record.items() if k not in ("op", "id")})
+            for job_id, job in self.jobs.items():
+                if job["status"] == QUEUED:
+                    self.pending.append(job_id)
+            self._compact()
+
+    # ---------- Submission ----------
+    def submit(self, kind, tally_url, data: dict):
+        """Validate one voucher and journal it; return the queued job. Raises ValueError on bad input."""
+        manager = _manager(kind, tally_url)
+        manager.validate_input(data)
+        self.load()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "tally_url": tally_url,
+            "company_name": data["company_name"],
+            "remote_id": manager._remote_id(data),
+            "status": QUEUED,
+            "attempts": 0,
+            "submitted_at": time.time(),
+            "data": data,
+        }
+        with self.lock:
+            self._write([{"op": "job", "job": job}])
+            self.jobs[job["id"]] = job
+            self.pending.append(job["id"])
+        self._wake()
+        return _public(job)
+
+    async def submit_async(self, kind, tally_url, data: dict):
+        # The fsync stays off the event loop
+        job = await asyncio.to_thread(self.submit, kind, tally_url, data)
+        self.start()
+        return job
+
+    def job_status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return _public(job) if job is not None else None
+
+    # ---------- Worker ----------
+    def _wake(self):
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self):
+        """Start the drain worker on the running event loop (no-op if it is already running)."""
+        if self._task is not None and not self._task.done():
+            return False
+        self.load()
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        # Created inside a fresh context, so the worker does not inherit the span of the
+        # request that started it (create_task's context= argument needs Python 3.11)
+        self._task = contextvars.Context().run(self._loop.create_task, self._run())
+        return True
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _next_delay(self):
+        """Seconds until the earliest queued job is due, or None when nothing is queued."""
+        with self.lock:
+            if not self.pending:
+                return None
+            now = time.monotonic()
+            return max(0.0, min(self.jobs[job_id].get("retry_at", 0) for job_id in self.pending) - now)
+
+    async def _run(self):
+        while True:
+            delay = self._next_delay()
+            try:
+                if delay is None:
+                    await self._wakeup.wait()
+                elif delay > 0:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.linger > 0:
+                await asyncio.sleep(self.linger)
+            try:
+                await self.drain_once()
+            except Exception:
+                # _drain_group re-queues its own jobs; this only keeps the worker alive
+                logger.exception("Voucher journal drain failed")
+
+    def _take_due(self):
+        """Pop due jobs off the queue, grouped by (kind, tally_url, company) in submission order."""
+        groups: dict[tuple, list] = {}
+        with self.lock:
+            now = time.monotonic()
+            waiting = deque()
+            for job_id in self.pending:
+                job = self.jobs[job_id]
+                if job.get("retry_at", 0) > now:
+                    waiting.append(job_id)
+                    continue
+                job["attempts"] += 1
+                groups.setdefault((job["kind"], job["tally_url"], job["company_name"]), []).append(job)
+            self.pending = waiting
+        return groups
+
+    async def drain_once(self):
+        """Post every job that is due; groups for different companies or hosts go out concurrently."""
+        groups = self._take_due()
+        await asyncio.gather(*(self._drain_group(key, jobs) for key, jobs in groups.items()))
+
+    async def _drain_group(self, key, jobs):
+        kind, tally_url, company_name = key
+        manager = _manager(kind, tally_url)
+        posted = 0
+        try:
+            for batch in chunked(jobs, self.batch_size):
+                # A root span per batch: the worker outlives the request that woke it
+                with tracer.span("journal.batch", parent=None, attributes={
+                    "journal.kind": kind, "tally.company": company_name, "journal.vouchers": len(batch),
+                }):
+                    items = [
+                        {"index": i, "remote_id": job["remote_id"], "identifiers": manager._identifiers(job["data"])}
+                        for i, job in enumerate(batch)
+                    ]
+                    try:
+                        xml_payload = manager.build_envelope(
+                            company_name, "".join(manager.build_voucher_element(job["data"]) for job in batch)
+                        )
+                        response = await manager.post_to_tally_async(xml_payload, company_name, len(batch))
+                    except TallyUnavailableError as e:
+                        # Nothing was sent; wait out the open circuit without using up attempts
+                        self._defer(jobs[posted:], e.retry_after, str(e))
+                        return
+                    except Exception as e:
+                        # Keep the worker alive; the batch is retried like any other failed post
+                        response = {"error": str(e)}
+                    outcomes = map_import_results(items, response)
+                    if kind == "voucher":
+                        manager._track_bulk(company_name, [
+                            {"index": i, "remote_id": job["remote_id"], "data": job["data"]} for i, job in enumerate(batch)
+                        ], outcomes)
+                    await asyncio.to_thread(self._settle, batch, outcomes, "error" in response or response.get("status") != 200)
+                    posted += len(batch)
+        except Exception as e:
+            # Building the envelope or journaling the outcome failed (bad data, a full
+            # disk); without this the taken jobs would sit unqueued until a restart
+            logger.exception("Voucher journal batch failed for %s at %s", company_name, tally_url)
+            await asyncio.to_thread(self._recover, jobs[posted:], f"{type(e).__name__}: {e}")
+
+    def _defer(self, jobs, delay, error):
+        with self.lock:
+            for job in jobs:
+                job["attempts"] -= 1
+                job["retry_at"] = time.monotonic() + delay
+                job["last_error"] = error
+            self.pending.extendleft(reversed([job["id"] for job in jobs]))
+
+    def _recover(self, jobs, error):
+        """Settle jobs a failed drain left behind as a transient failure: retried with backoff, up to max_attempts."""
+        with self.lock:
+            queued = set(self.pending)
+            unsettled = [job for job in jobs if job["status"] == QUEUED and job["id"] not in queued]
+        if not unsettled:
+            return
+        try:
+            self._settle(unsettled, [{"status": "error", "error": error} for _ in unsettled], True)
+        except Exception:
+            logger.exception("Could not journal the outcome of %d vouchers; they replay on restart", len(unsettled))
+
+    def _settle(self, batch, outcomes, transient):
+        """Record the batch's outcomes, or re-queue it with backoff when it never reached Tally."""
+        records = []
+        with self.lock:
+            self.batches += 1
+            retry = []
+            for job, outcome in zip(batch, outcomes):
+                result = {k: v for k, v in outcome.items() if k != "index"}
+                if transient and job["attempts"] < self.max_attempts:
+                    job["retry_at"] = time.monotonic() + min(60.0, 2.0 ** (job["attempts"] - 1))
+                    job["last_error"] = outcome.get("error")
+                    retry.append(job["id"])
+                    continue
+                status = SUCCEEDED if outcome["status"] in SUCCESS_STATUSES else FAILED
+                finished_at = time.time()
+                job.pop("data", None)
+                job.pop("retry_at", None)
+                job.update({"status": status, "result": result, "finished_at": finished_at})
+                records.append({"op": "finish", "id": job["id"], "status": status, "result": result,
+                                "attempts": job["attempts"], "finished_at": finished_at})
+            # Retried jobs keep their place ahead of later submissions
+            self.pending.extendleft(reversed(retry))
+            if records:
+                self._write(records)
+                self.finished_since_compact += len(records)
+                if self.finished_since_compact >= self.compact_every:
+                    self._compact()
+
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {"path": self.path, "queued": len(self.pending), "jobs": counts, "batches": self.batches,
+                    "batch_size": self.batch_size, "running": self._task is not None and not self._task.done()}
+
+
+write_journal = WriteJournal()
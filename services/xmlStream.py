@@ -0,0 +1,210 @@
+import codecs
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from services.metrics import xml_parse_errors, xml_parse_rows, xml_parse_seconds
+from services.tracing import tracer
+
+# Bytes pulled off the socket per parser feed
+TALLY_STREAM_CHUNK_SIZE = int(os.getenv("TALLY_STREAM_CHUNK_SIZE", "65536"))
+
+_CONTROL_ENTITY = re.compile(r"&#\d+;")
+# Longest possible tail of an entity split across chunks, e.g. "&#1234567"
+_MAX_PARTIAL_ENTITY = 12
+
+
+class ControlEntityStripper:
+    """
+    Strips the invalid XML control entities (like &#4;) Tally sometimes sends.
+    Decodes byte chunks and drops &#N; entities, holding back a trailing
+    partial entity until the next chunk completes it.
+    """
+
+    def __init__(self, encoding="utf-8"):
+        self.decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+        self.pending = ""
+
+    def feed(self, data) -> str:
+        text = self.pending + (self.decoder.decode(data) if isinstance(data, bytes) else data)
+        self.pending = ""
+        amp = text.rfind("&", max(0, len(text) - _MAX_PARTIAL_ENTITY))
+        if amp != -1 and ";" not in text[amp:]:
+            text, self.pending = text[:amp], text[amp:]
+        return _CONTROL_ENTITY.sub("", text)
+
+    def close(self) -> str:
+        text = self.pending + self.decoder.decode(b"", final=True)
+        self.pending = ""
+        return _CONTROL_ENTITY.sub("", text)
+
+
+class XmlElementStream:
+    """
+    Push parser that hands back each completed element whose tag is in tags.
+    Everything outside a wanted element is detached from the tree as soon as
+    it completes, so memory stays bounded by the largest single row rather
+    than by the size of the export.
+    """
+
+    def __init__(self, tags, encoding="utf-8"):
+        self.tags = set(tags)
+        self.stripper = ControlEntityStripper(encoding)
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.stack = []
+        self.target_depth = 0
+        self.parse_seconds = 0.0  # time inside feed()/close(), not waiting for the network
+
+    def _drain(self) -> list:
+        completed = []
+        for event, elem in self.parser.read_events():
+            if event == "start":
+                self.stack.append(elem)
+                if elem.tag in self.tags:
+                    self.target_depth += 1
+                continue
+
+            self.stack.pop()
+            is_target = elem.tag in self.tags
+            if is_target:
+                self.target_depth -= 1
+            if self.target_depth == 0:
+                if is_target:
+                    completed.append(elem)
+                if self.stack:
+                    self.stack[-1].remove(elem)
+        return completed
+
+    def feed(self, data) -> list:
+        """Feed a bytes or str chunk; return the wanted elements it completed."""
+        started = time.perf_counter()
+        try:
+            text = self.stripper.feed(data)
+            if text:
+                self.parser.feed(text)
+            return self._drain()
+        finally:
+            self.parse_seconds += time.perf_counter() - started
+
+    def close(self) -> list:
+        started = time.perf_counter()
+        try:
+            tail = self.stripper.close()
+            if tail:
+                self.parser.feed(tail)
+            self.parser.close()
+            return self._drain()
+        finally:
+            self.parse_seconds += time.perf_counter() - started
+
+
+class ParseObserver:
+    """
+    Reports one response's parse time and row count to the metrics once the
+    iteration ends (also when the consumer stops early), and counts
+    malformed responses. The iteration is also traced as an xml.parse span;
+    it is never made current, since a generator's context belongs to its
+    consumer.
+    """
+
+    def __init__(self, stream: XmlElementStream, report):
+        self.stream = stream
+        self.report = report
+        self.rows = 0
+        self.span = None
+
+    def __enter__(self):
+        self.span = tracer.start_span("xml.parse", attributes={"tally.report": self.report})
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if isinstance(exc, ET.ParseError):
+            xml_parse_errors.inc(report=self.report)
+            self.span.record_exception(exc)
+        xml_parse_seconds.observe(self.stream.parse_seconds, report=self.report)
+        xml_parse_rows.observe(self.rows, report=self.report)
+        # The span's duration includes waiting for chunks; parse_seconds is the CPU part
+        self.span.set_attribute("xml.parse_seconds", round(self.stream.parse_seconds, 6))
+        self.span.set_attribute("xml.rows", self.rows)
+        self.span.end()
+        return False
+
+
+def _report_label(tags, report):
+    return report or "+".join(tags)
+
+
+class ZipRows:
+    """
+    Groups sibling elements into rows the way zip() over findall() lists did:
+    the i-th element of every tag forms row i. Rows are emitted as soon as
+    each tag has contributed an element.
+    """
+
+    def __init__(self, tags):
+        self.tags = list(tags)
+        self.pending = {tag: deque() for tag in self.tags}
+
+    def push(self, elements) -> list[tuple]:
+        rows = []
+        for elem in elements:
+            if elem.tag in self.pending:
+                self.pending[elem.tag].append(elem)
+            while all(self.pending[tag] for tag in self.tags):
+                rows.append(tuple(self.pending[tag].popleft() for tag in self.tags))
+        return rows
+
+
+def iter_elements(chunks, tags, encoding="utf-8", report=None):
+    """Yield wanted elements from an iterable of response chunks; report labels the parse metrics."""
+    stream = XmlElementStream(tags, encoding)
+    with ParseObserver(stream, _report_label(tags, report)) as observed:
+        for chunk in chunks:
+            for elem in stream.feed(chunk):
+                observed.rows += 1
+                yield elem
+        for elem in stream.close():
+            observed.rows += 1
+            yield elem
+
+
+async def aiter_elements(chunks, tags, encoding="utf-8", report=None):
+    """Async counterpart of iter_elements for an async iterable of chunks."""
+    stream = XmlElementStream(tags, encoding)
+    with ParseObserver(stream, _report_label(tags, report)) as observed:
+        async for chunk in chunks:
+            for elem in stream.feed(chunk):
+                observed.rows += 1
+                yield elem
+        for elem in stream.close():
+            observed.rows += 1
+            yield elem
+
+
+def iter_rows(chunks, tags, encoding="utf-8", report=None):
+    """Yield zipped rows of sibling elements from an iterable of response chunks."""
+    rows = ZipRows(tags)
+    stream = XmlElementStream(tags, encoding)
+    with ParseObserver(stream, _report_label(tags, report)) as observed:
+        for chunk in chunks:
+            for row in rows.push(stream.feed(chunk)):
+                observed.rows += 1
+                yield row
+        for row in rows.push(stream.close()):
+            observed.rows += 1
+            yield row
+
+
+async def aiter_rows(chunks, tags, encoding="utf-8", report=None):
+    """Async counterpart of iter_rows."""
+    rows = ZipRows(tags)
+    stream = XmlElementStream(tags, encoding)
+    with ParseObserver(stream, _report_label(tags, report)) as observed:
+        async for chunk in chunks:
+            for row in rows.push(stream.feed(chunk)):
+                observed.rows += 1
+                yield row
+        for row in rows.push(stream.close()):
+            observed.rows += 1
+            yield row